@@ -0,0 +1,240 @@
+"""
+
+A benchmark which runs LogsDownloader end to end against local stand-in servers
+
+For each combination of file mode, file size and sinks, the stand-ins are started, and the downloader is run in a
+separate process with a fresh config folder until all the files reach the sinks. The results are the number of
+files, MB and lines handled per second, the p50/p99 per-file latency and the peak memory of the downloader process.
+
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(BENCHMARK_DIR, "..", "config", "Settings.Config.Template")
+SCRIPT_DIR = os.path.join(BENCHMARK_DIR, "..", "script")
+
+# the settings of each sink, the sinks of a scenario are joined with '+'
+SINK_SETTINGS = {
+    "local": {"SAVE_LOCALLY": "YES"},
+    "syslog": {"SYSLOG_ENABLE": "YES"},
+    "sftp": {"SAVE_LOCALLY": "YES", "SFTP_TRANSFER": "YES"},
+    "http": {"HTTP_SINK_ENABLE": "YES"},
+}
+
+SIZE_UNITS = {"KB": 1024, "MB": 1024 * 1024, "GB": 1024 * 1024 * 1024}
+
+
+"""
+Parses a size such as 100KB or 10MB to a number of bytes
+"""
+def parse_size(size):
+    size = size.strip().upper()
+    for unit, multiplier in SIZE_UNITS.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * multiplier)
+    return int(size)
+
+
+"""
+Gets a percentile of a sorted list of values
+"""
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+"""
+Writes the Settings.Config file of a scenario, based on the settings template
+"""
+def write_settings(config_path, settings):
+    lines = []
+    remaining_settings = dict(settings)
+    for line in open(TEMPLATE_PATH).read().splitlines():
+        name = line.split("=", 1)[0]
+        if name in remaining_settings:
+            line = "%s=%s" % (name, remaining_settings.pop(name))
+        lines.append(line)
+    lines.extend("%s=%s" % (name, value) for name, value in sorted(remaining_settings.items()))
+    with open(os.path.join(config_path, "Settings.Config"), "w") as settings_file:
+        settings_file.write("\n".join(lines) + "\n")
+
+
+"""
+Runs a single scenario, returns its results
+"""
+def run_scenario(args, mode, file_size, sinks):
+    import StandInServers
+    work_dir = tempfile.mkdtemp(prefix="logs_downloader_benchmark_")
+    try:
+        config_path = os.path.join(work_dir, "config")
+        process_dir = os.path.join(work_dir, "logs")
+        sftp_root = os.path.join(work_dir, "sftp")
+        os.makedirs(config_path)
+        generator = StandInServers.LogFileGenerator(1, file_size, mode == "encrypted", args.seed)
+        generator.save_private_key(config_path)
+        logs_api = StandInServers.FakeLogsApi(generator, args.files, args.not_found_rate, args.rate_limit_rate, args.latency, args.seed)
+        logs_api.start()
+        settings = {
+            "APIID": "benchmark",
+            "APIKEY": "benchmark",
+            "BASEURL": logs_api.base_url,
+            "PROCESS_DIR": process_dir,
+            "SAVE_LOCALLY": "NO",
+            "SYSLOG_ENABLE": "NO",
+            "SFTP_TRANSFER": "NO",
+            "POLL_MIN_DELAY": "1",
+        }
+        syslog_collector = None
+        sftp_server = None
+        http_collector = None
+        for sink in sinks:
+            settings.update(SINK_SETTINGS[sink])
+        if "syslog" in sinks:
+            syslog_collector = StandInServers.FakeSyslogCollector()
+            syslog_collector.start()
+            settings.update({"SYSLOG_ADDRESS": "127.0.0.1", "SYSLOG_PORT": str(syslog_collector.port)})
+        if "sftp" in sinks:
+            sftp_server = StandInServers.FakeSftpServer(sftp_root, "benchmark", "benchmark")
+            sftp_server.start()
+            settings.update({"SFTP_HOSTNAME": "127.0.0.1", "SFTP_PORT": str(sftp_server.port), "SFTP_USERNAME": "benchmark",
+                             "SFTP_PASSWORD": "benchmark", "SFTP_REMOTEDIR": "/upload"})
+        if "http" in sinks:
+            http_collector = StandInServers.FakeHttpCollector(args.collector_busy_rate, args.collector_latency, args.seed)
+            http_collector.start()
+            settings.update({"HTTP_SINK_URL": http_collector.url})
+        settings.update(args.settings)
+        write_settings(config_path, settings)
+        # the downloader runs in its own process, so its memory usage is measured alone
+        downloader_output_path = os.path.join(work_dir, "downloader.out")
+        with open(downloader_output_path, "w") as downloader_output:
+            downloader_process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run-downloader", config_path, str(args.files)],
+                                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=downloader_output)
+        start_line = downloader_process.stdout.readline()
+        if not start_line:
+            raise Exception("The downloader failed to start:\n%s" % open(downloader_output_path).read())
+        start_time = float(start_line)
+        # the scenario is complete once every sink got all of the files
+        deadline = start_time + args.timeout
+        while time.time() < deadline and downloader_process.poll() is None:
+            completion_times = []
+            if syslog_collector is not None:
+                completion_times.append(syslog_collector.last_receive_time if syslog_collector.received_lines >= logs_api.line_count else None)
+            if sftp_server is not None:
+                completion_times.append(sftp_server.last_upload_time if sftp_server.uploaded_files >= args.files else None)
+            if http_collector is not None:
+                completion_times.append(http_collector.last_receive_time if http_collector.received_lines >= logs_api.line_count else None)
+            if settings["SAVE_LOCALLY"] == "YES":
+                completed_files = [name for name in os.listdir(process_dir) if name.endswith(".gz")] if os.path.exists(process_dir) else []
+                completion_times.append(time.time() if len(completed_files) >= args.files else None)
+            if None not in completion_times:
+                break
+            time.sleep(0.01)
+        else:
+            completion_times = [None]
+        downloader_process.stdin.write("stop\n")
+        downloader_process.stdin.flush()
+        downloader_results = json.loads(downloader_process.stdout.read())
+        downloader_process.wait()
+        if None in completion_times:
+            raise Exception("The scenario did not complete within %s seconds" % args.timeout)
+        # the downloader reports when all of the files were handled, which is enough when there is no sink
+        end_time = max(completion_times + [downloader_results["handled_time"]])
+        elapsed = end_time - start_time
+        latencies = sorted(downloader_results["latencies"])
+        for server in (logs_api, syslog_collector, sftp_server, http_collector):
+            if server is not None:
+                server.stop()
+        return {
+            "files_per_second": args.files / elapsed,
+            "mb_per_second": logs_api.content_bytes / elapsed / SIZE_UNITS["MB"],
+            "lines_per_second": logs_api.line_count / elapsed,
+            "p50_latency": percentile(latencies, 0.5),
+            "p99_latency": percentile(latencies, 0.99),
+            "peak_rss": downloader_results["peak_rss"],
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+"""
+Runs the downloader until all the files are handled and the benchmark asks it to stop, then reports the results
+"""
+def run_downloader(config_path, file_count):
+    sys.path.insert(0, SCRIPT_DIR)
+    import LogsDownloader
+    downloader = LogsDownloader.LogsDownloader(config_path, os.path.join(config_path, "system_logs"), "ERROR")
+    latencies = []
+    handle_file = downloader.handle_file
+
+    # the latency of a file is the time from the start of its download until it is written to all the sinks
+    def timed_handle_file(logfile, wait_time=3):
+        start_time = time.time()
+        success = handle_file(logfile, wait_time)
+        if success:
+            latencies.append(time.time() - start_time)
+        return success
+    downloader.handle_file = timed_handle_file
+    process_thread = threading.Thread(target=downloader.get_log_files, name="process_thread")
+    process_thread.daemon = True
+    sys.stdout.write("%r\n" % time.time())
+    sys.stdout.flush()
+    process_thread.start()
+    handled_time = None
+    stop_thread = threading.Thread(target=sys.stdin.readline)
+    stop_thread.daemon = True
+    stop_thread.start()
+    while stop_thread.is_alive():
+        if handled_time is None and len(latencies) >= file_count:
+            handled_time = time.time()
+        stop_thread.join(0.01)
+    downloader.running = False
+    process_thread.join(5)
+    sys.stdout.write(json.dumps({
+        "handled_time": handled_time if handled_time is not None else time.time(),
+        "latencies": latencies,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--run-downloader":
+        run_downloader(sys.argv[2], int(sys.argv[3]))
+    parser = argparse.ArgumentParser(description="Runs LogsDownloader end to end against local stand-in servers")
+    parser.add_argument("--files", type=int, default=20, help="the number of log files of each scenario")
+    parser.add_argument("--sizes", default="100KB,1MB,10MB", help="the uncompressed sizes of the log files")
+    parser.add_argument("--modes", default="encrypted,plain", help="the file modes - encrypted and/or plain")
+    parser.add_argument("--sinks", default="local,syslog,sftp,local+syslog", help="the sink combinations, the sinks of a combination are joined with '+', the sinks are local, syslog, sftp and http")
+    parser.add_argument("--not-found-rate", type=float, default=0.0, help="the fraction of log file requests answered with 404")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="the fraction of log file requests answered with 429")
+    parser.add_argument("--latency", type=float, default=0.0, help="the seconds the logs API waits before answering each request")
+    parser.add_argument("--collector-busy-rate", type=float, default=0.0, help="the fraction of HTTP collector requests answered with 503")
+    parser.add_argument("--collector-latency", type=float, default=0.0, help="the seconds the HTTP collector waits before answering each request")
+    parser.add_argument("--set", dest="settings", action="append", default=[], metavar="NAME=VALUE", help="a setting to add to Settings.Config, can be given a few times")
+    parser.add_argument("--timeout", type=float, default=600, help="the maximum number of seconds of each scenario")
+    parser.add_argument("--seed", type=int, default=0, help="the seed of the generated content and the injected errors")
+    args = parser.parse_args()
+    args.settings = dict(setting.split("=", 1) for setting in args.settings)
+    sys.path.insert(0, BENCHMARK_DIR)
+    print("%-10s %-8s %-16s %10s %10s %12s %10s %10s %10s" % ("mode", "size", "sinks", "files/s", "MB/s", "lines/s", "p50 ms", "p99 ms", "RSS MB"))
+    for mode in args.modes.split(","):
+        for size in args.sizes.split(","):
+            for sinks in args.sinks.split(","):
+                results = run_scenario(args, mode, parse_size(size), sinks.split("+"))
+                print("%-10s %-8s %-16s %10.2f %10.2f %12.0f %10.1f %10.1f %10.1f" % (
+                    mode, size, sinks, results["files_per_second"], results["mb_per_second"], results["lines_per_second"],
+                    results["p50_latency"] * 1000, results["p99_latency"] * 1000, float(results["peak_rss"]) / SIZE_UNITS["MB"]))
+                sys.stdout.flush()
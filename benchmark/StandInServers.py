@@ -0,0 +1,513 @@
+"""
+
+Local stand-ins for the Incapsula logs API, a syslog collector and an SFTP server, used by the benchmark
+
+"""
+
+import BaseHTTPServer
+import SocketServer
+import base64
+import hashlib
+import os
+import random
+import socket
+import threading
+import time
+import zlib
+
+import M2Crypto
+import paramiko
+from Crypto.Cipher import AES
+
+
+"""
+
+LogFileGenerator - A class for generating log files in the format of the Incapsula logs API
+
+"""
+
+
+class LogFileGenerator:
+
+    # the id of the test key pair, the private key is saved under keys/<id>/Private.key
+    PUBLIC_KEY_ID = "1"
+
+    def __init__(self, account_id, file_size, encrypted, seed=0):
+        self.account_id = account_id
+        self.file_size = file_size
+        self.encrypted = encrypted
+        self.random = random.Random(seed)
+        self.rsa_key = None
+        if encrypted:
+            self.rsa_key = M2Crypto.RSA.gen_key(2048, 65537, lambda *args: None)
+
+    """
+    Saves the private key of the test key pair under the keys folder of a config folder
+    """
+    def save_private_key(self, config_path):
+        if self.rsa_key is None:
+            return
+        key_directory = os.path.join(config_path, "keys", LogFileGenerator.PUBLIC_KEY_ID)
+        if not os.path.exists(key_directory):
+            os.makedirs(key_directory)
+        self.rsa_key.save_key(os.path.join(key_directory, "Private.key"), cipher=None)
+
+    """
+    Generates the CEF lines of a log file, returns the content and the number of lines
+    """
+    def generate_content(self, log_id):
+        lines = []
+        size = 0
+        while size < self.file_size:
+            line = "CEF:0|Incapsula|SIEM|1.0|1|Normal|0| fileId=%s_%d sourceServiceName=site%d.example.com siteid=%d " \
+                   "suid=%d requestClientApplication=Mozilla/5.0 cs2=true cs2Label=Javascript Support " \
+                   "request=site.example.com/page/%d src=10.%d.%d.%d requestMethod=GET cn1=200 " \
+                   "start=%d in=%d xff=10.%d.%d.%d" % (
+                       self.account_id, log_id, self.random.randint(1, 50), self.random.randint(1000, 9999),
+                       self.random.randint(1, 10 ** 6), self.random.randint(1, 10 ** 5), self.random.randint(0, 255),
+                       self.random.randint(0, 255), self.random.randint(0, 255), int(time.time() * 1000),
+                       self.random.randint(100, 10000), self.random.randint(0, 255), self.random.randint(0, 255),
+                       self.random.randint(0, 255))
+            lines.append(line)
+            size += len(line) + 1
+        return "\n".join(lines) + "\n", len(lines)
+
+    """
+    Generates a whole log file - the header section, the |==| mark and the compressed and optionally encrypted content
+    """
+    def generate_file(self, log_id):
+        content, line_count = self.generate_content(log_id)
+        compressed_content = zlib.compress(content)
+        if not self.encrypted:
+            header = "accountId:%s\nconfigId:1\n" % self.account_id
+            return header + "|==|\n" + compressed_content, len(content), line_count
+        # each file is encrypted with its own symmetric key, which is encrypted with the public key
+        sym_key = os.urandom(16)
+        padded_content = compressed_content + "\x00" * (-len(compressed_content) % AES.block_size)
+        encrypted_content = AES.new(sym_key, AES.MODE_CBC, 16 * "\x00").encrypt(padded_content)
+        encrypted_sym_key = base64.b64encode(self.rsa_key.public_encrypt(base64.b64encode(sym_key), M2Crypto.RSA.pkcs1_padding))
+        header = "accountId:%s\nconfigId:1\nchecksum:%s\nkey:%s\npublicKeyId:%s\n" % (
+            self.account_id, hashlib.md5(content).hexdigest(), encrypted_sym_key, LogFileGenerator.PUBLIC_KEY_ID)
+        return header + "|==|\n" + encrypted_content, len(content), line_count
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+"""
+
+FakeLogsApi - A class for serving logs.index and generated log files, with injectable errors and latency
+
+"""
+
+
+class FakeLogsApi:
+
+    def __init__(self, generator, file_count, not_found_rate=0.0, rate_limit_rate=0.0, latency=0.0, seed=0):
+        self.file_count = file_count
+        self.not_found_rate = not_found_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        # the files are generated up front, so generating them is not measured
+        self.files = {}
+        self.content_bytes = 0
+        self.line_count = 0
+        for log_id in range(1, file_count + 1):
+            file_name = "%s_%d.log" % (generator.account_id, log_id)
+            self.files[file_name], content_bytes, line_count = generator.generate_file(log_id)
+            self.content_bytes += content_bytes
+            self.line_count += line_count
+        self.index = "".join("%s_%d.log\n" % (generator.account_id, log_id) for log_id in range(1, file_count + 1))
+        self.index_etag = '"%s"' % hashlib.md5(self.index).hexdigest()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.create_handler())
+        self.port = self.server.server_address[1]
+        self.base_url = "http://127.0.0.1:%d/" % self.port
+
+    """
+    Decides whether to inject an error, returns the injected status code or None
+    """
+    def injected_error(self):
+        with self.lock:
+            self.requests += 1
+            draw = self.random.random()
+        if draw < self.rate_limit_rate:
+            return 429
+        if draw < self.rate_limit_rate + self.not_found_rate:
+            return 404
+        return None
+
+    def create_handler(self):
+        api = self
+
+        class LogsApiRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if api.latency > 0:
+                    time.sleep(api.latency)
+                file_name = self.path.rsplit("/", 1)[-1]
+                if file_name == "logs.index":
+                    if self.headers.get("If-None-Match") == api.index_etag:
+                        self.send_body(304, "")
+                    else:
+                        self.send_body(200, api.index, {"ETag": api.index_etag})
+                    return
+                if file_name not in api.files:
+                    self.send_body(404, "Not Found")
+                    return
+                injected_error = api.injected_error()
+                if injected_error == 429:
+                    self.send_body(429, "Too Many Requests", {"Retry-After": "1"})
+                elif injected_error == 404:
+                    self.send_body(404, "Not Found")
+                else:
+                    self.send_body(200, api.files[file_name])
+
+            def send_body(self, status_code, body, headers=None):
+                self.send_response(status_code)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return LogsApiRequestHandler
+
+    def start(self):
+        server_thread = threading.Thread(target=self.server.serve_forever, name="fake_logs_api_thread")
+        server_thread.daemon = True
+        server_thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+"""
+
+FakeSyslogCollector - A class for receiving syslog lines over TCP and counting them
+
+"""
+
+
+class FakeSyslogCollector:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received_bytes = 0
+        self.received_lines = 0
+        self.last_receive_time = None
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind(("127.0.0.1", 0))
+        self.listen_socket.listen(16)
+        self.port = self.listen_socket.getsockname()[1]
+        self.running = True
+
+    def start(self):
+        accept_thread = threading.Thread(target=self.accept_connections, name="fake_syslog_accept_thread")
+        accept_thread.daemon = True
+        accept_thread.start()
+
+    def accept_connections(self):
+        while self.running:
+            try:
+                connection_socket, address = self.listen_socket.accept()
+            except socket.error:
+                return
+            receive_thread = threading.Thread(target=self.receive, args=(connection_socket,), name="fake_syslog_receive_thread")
+            receive_thread.daemon = True
+            receive_thread.start()
+
+    def receive(self, connection_socket):
+        pending_data = ""
+        try:
+            while True:
+                data = connection_socket.recv(1 << 16)
+                if not data:
+                    return
+                pending_data, line_count = FakeSyslogCollector.split_frames(pending_data + data)
+                with self.lock:
+                    self.received_bytes += len(data)
+                    self.received_lines += line_count
+                    self.last_receive_time = time.time()
+        except socket.error:
+            return
+        finally:
+            connection_socket.close()
+
+    """
+    Counts the complete messages framed with their octet count, returns the incomplete rest and the count
+    """
+    @staticmethod
+    def split_frames(data):
+        line_count = 0
+        position = 0
+        while True:
+            separator = data.find(" ", position)
+            if separator == -1:
+                break
+            frame_end = separator + 1 + int(data[position:separator])
+            if frame_end > len(data):
+                break
+            line_count += 1
+            position = frame_end
+        return data[position:], line_count
+
+    def stop(self):
+        self.running = False
+        self.listen_socket.close()
+
+
+"""
+
+FakeHttpCollector - A class for accepting bulk requests of log lines, such as a Splunk HTTP Event Collector, and counting the lines.
+The requests can be answered with 503 and delayed, to exercise the retries and the batch size of the HTTP sink
+
+"""
+
+
+class FakeHttpCollector:
+
+    def __init__(self, busy_rate=0.0, latency=0.0, seed=0):
+        self.busy_rate = busy_rate
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.busy_responses = 0
+        self.received_bytes = 0
+        self.received_lines = 0
+        self.last_receive_time = None
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.create_handler())
+        self.port = self.server.server_address[1]
+        self.url = "http://127.0.0.1:%d/services/collector/event" % self.port
+
+    def create_handler(self):
+        collector = self
+
+        class CollectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+                if collector.latency > 0:
+                    time.sleep(collector.latency)
+                with collector.lock:
+                    collector.requests += 1
+                    busy = collector.random.random() < collector.busy_rate
+                    if busy:
+                        collector.busy_responses += 1
+                if busy:
+                    self.send_body(503, '{"text":"Server is busy","code":9}', {"Retry-After": "1"})
+                    return
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                # each event is a line of JSON
+                line_count = body.count("\n")
+                with collector.lock:
+                    collector.received_bytes += len(body)
+                    collector.received_lines += line_count
+                    collector.last_receive_time = time.time()
+                self.send_body(200, '{"text":"Success","code":0}')
+
+            def send_body(self, status_code, body, headers=None):
+                self.send_response(status_code)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return CollectorRequestHandler
+
+    def start(self):
+        server_thread = threading.Thread(target=self.server.serve_forever, name="fake_http_collector_thread")
+        server_thread.daemon = True
+        server_thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+"""
+
+FakeSftpServer - A class for accepting SFTP uploads to a local folder
+
+"""
+
+
+class FakeSftpServer:
+
+    def __init__(self, root, username, password):
+        self.root = root
+        self.username = username
+        self.password = password
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.lock = threading.Lock()
+        self.uploaded_files = 0
+        self.last_upload_time = None
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind(("127.0.0.1", 0))
+        self.listen_socket.listen(16)
+        self.port = self.listen_socket.getsockname()[1]
+        self.running = True
+        self.transports = []
+
+    def start(self):
+        accept_thread = threading.Thread(target=self.accept_connections, name="fake_sftp_accept_thread")
+        accept_thread.daemon = True
+        accept_thread.start()
+
+    def accept_connections(self):
+        while self.running:
+            try:
+                connection_socket, address = self.listen_socket.accept()
+            except socket.error:
+                return
+            transport = paramiko.Transport(connection_socket)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, LocalSftpInterface, self)
+            transport.start_server(server=PasswordServerInterface(self.username, self.password))
+            self.transports.append(transport)
+
+    """
+    Counts a completely uploaded file
+    """
+    def on_upload(self):
+        with self.lock:
+            self.uploaded_files += 1
+            self.last_upload_time = time.time()
+
+    def stop(self):
+        self.running = False
+        self.listen_socket.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class PasswordServerInterface(paramiko.ServerInterface):
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+
+    def check_auth_password(self, username, password):
+        if username == self.username and password == self.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class LocalSftpHandle(paramiko.SFTPHandle):
+
+    def __init__(self, flags, server):
+        paramiko.SFTPHandle.__init__(self, flags)
+        self.server = server
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+    def close(self):
+        paramiko.SFTPHandle.close(self)
+        if self.flags & (os.O_WRONLY | os.O_RDWR):
+            self.server.on_upload()
+
+
+class LocalSftpInterface(paramiko.SFTPServerInterface):
+
+    def __init__(self, server_interface, server, *args, **kwargs):
+        paramiko.SFTPServerInterface.__init__(self, server_interface, *args, **kwargs)
+        self.server = server
+
+    def local_path(self, path):
+        return os.path.join(self.server.root, self.canonicalize(path).lstrip("/"))
+
+    def open(self, path, flags, attr):
+        local_path = self.local_path(path)
+        try:
+            if not os.path.exists(os.path.dirname(local_path)):
+                os.makedirs(os.path.dirname(local_path))
+            file_descriptor = os.open(local_path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        local_file = os.fdopen(file_descriptor, mode)
+        handle = LocalSftpHandle(flags, self.server)
+        handle.filename = local_path
+        handle.readfile = local_file
+        handle.writefile = local_file
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self.local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def list_folder(self, path):
+        local_path = self.local_path(path)
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local_path, name)), name) for name in os.listdir(local_path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def mkdir(self, path, attr):
+        try:
+            os.makedirs(self.local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        try:
+            os.remove(self.local_path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self.local_path(oldpath), self.local_path(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
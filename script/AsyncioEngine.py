@@ -0,0 +1,614 @@
+"""
+
+AsyncioEngine - Runs the downloaders on an asyncio event loop, selected with '-e asyncio', requires Python 3.7 or newer
+
+The downloads of the upcoming log files, the syslog writes and the logs index refreshes overlap on the event loop,
+while decrypting, decompressing and writing local files run on an executor. The configuration, the last known
+downloaded file id and the log file format are handled by the same classes as in LogsDownloader.py
+
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import signal
+import ssl
+import time
+import traceback
+
+import aiohttp
+
+import sinks
+from LogsDownloader import AccountLoggerAdapter, CefFilter, Config, FileDownloader, LastFileId, LogContentSinks, LogsDownloader, \
+    LogsFileIndex, PollingScheduler, PrivateKeyRing, ProcessedFileLedger, SharedResources, TokenBucket
+
+
+"""
+Runs a downloader for each config folder until the process is terminated, returns the process exit code
+"""
+def run(paths_to_config_folders, path_to_system_logs_folder, system_logs_level):
+    logger = LogsDownloader.create_logger(path_to_system_logs_folder, system_logs_level)
+    shared_resources = SharedResources(len(paths_to_config_folders) > 1)
+    # decrypting, decompressing and the blocking file system work run on this executor
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(4, 2 * multiprocessing.cpu_count()))
+    try:
+        downloaders = [AsyncioLogsDownloader(path, logger, shared_resources, executor) for path in paths_to_config_folders]
+        asyncio.run(run_downloaders(downloaders, logger))
+    finally:
+        executor.shutdown()
+    return 0
+
+
+"""
+Runs the downloaders, the first SIGTERM/SIGINT drains the in-flight files and the second one stops right away
+"""
+async def run_downloaders(downloaders, logger):
+    loop = asyncio.get_event_loop()
+    tasks = [asyncio.ensure_future(downloader.run()) for downloader in downloaders]
+
+    def stop(signal_number):
+        if any(downloader.running for downloader in downloaders):
+            logger.info("Got signal %s, handling the in-flight files before stopping", signal_number)
+            for downloader in downloaders:
+                downloader.stop()
+        else:
+            logger.info("Got signal %s again, stopping without waiting for the in-flight files", signal_number)
+            for task in tasks:
+                task.cancel()
+    loop.add_signal_handler(signal.SIGTERM, stop, signal.SIGTERM)
+    loop.add_signal_handler(signal.SIGINT, stop, signal.SIGINT)
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error("A downloader failed - %s", "".join(traceback.format_exception(type(result), result, result.__traceback__)))
+
+
+"""
+
+AsyncioLogsDownloader - A class for downloading the log files of an account on the event loop
+
+"""
+
+
+class AsyncioLogsDownloader:
+
+    def __init__(self, config_path, logger, shared_resources, executor):
+        self.config_path = config_path
+        self.logger = logger
+        if shared_resources.multi_account:
+            self.logger = AccountLoggerAdapter(logger, {"account": config_path})
+        self.executor = executor
+        self.running = True
+        self.config = Config(config_path, self.logger).read()
+        self.metrics = shared_resources.metrics
+        self.line_filter = CefFilter.from_config(self.config, self.metrics)
+        self.last_known_downloaded_file_id = LastFileId(config_path, self.config.CHECKPOINT_EVERY_FILES, self.config.CHECKPOINT_INTERVAL)
+        self.ledger = None
+        if self.config.PROCESSED_FILES_LEDGER == "YES":
+            self.ledger = ProcessedFileLedger(config_path, self.config.CHECKPOINT_EVERY_FILES, self.config.CHECKPOINT_INTERVAL)
+        self.key_ring = PrivateKeyRing(config_path, self.config, self.logger, self.metrics)
+        # the logs index is downloaded by this engine, the index class keeps the parsed ids and the validators
+        self.logs_file_index = LogsFileIndex(self.config, self.logger, None)
+        self.scheduler = PollingScheduler(self.config, self.logger, lambda: self.running)
+        self.rate_limiter = TokenBucket(self.config.API_RATE_LIMIT, self.config.API_RATE_BURST)
+        # the number of upcoming log files which are downloaded and decrypted while the current one is handled
+        self.window = max(1, self.config.PREFETCH_WINDOW)
+        if self.config.STREAMING_MODE == "YES":
+            self.logger.warning("STREAMING_MODE is ignored by the asyncio engine")
+        # the syslog lines are sent by this engine, LogContentSinks writes to the other sinks - the local file, which is routed to SFTP,
+        # and the HTTP collector
+        self.sink_names = [name for name in sinks.enabled_sinks(self.config) if name != "syslog"]
+        self.sink_modules = dict((name, sinks.load(name)) for name in self.sink_names)
+        self.syslog_writer = None
+        if self.config.SYSLOG_ENABLE == "YES":
+            self.syslog_writer = AsyncioSyslogWriter(self.config, self.logger, self.metrics)
+        self.sftp_uploader = None
+        if self.config.SFTP_TRANSFER == "YES":
+            self.sftp_uploader = shared_resources.get_sftp_uploader(self.config, self.logger)
+        self.http_bulk_client = None
+        if "http" in self.sink_names:
+            self.http_bulk_client = shared_resources.get_http_bulk_client(self.config, self.logger)
+        self.compression_engine = None
+        if self.config.SAVE_LOCALLY == "YES":
+            self.compression_engine = shared_resources.get_compression_engine(self.config, self.logger)
+        self.decode_engine = shared_resources.get_decode_engine(self.config, self.logger)
+        if self.config.SAVE_LOCALLY == "YES":
+            if not os.path.exists(self.config.PROCESS_DIR):
+                os.makedirs(self.config.PROCESS_DIR)
+        self.metrics.add_gauge("logs_downloader_lag_files", (("account", config_path),), self.get_lag)
+        shared_resources.start_metrics_server(self.config, self.logger)
+        # the event loop objects are created once the loop is running
+        self.session = None
+        self.stop_event = None
+        self.index_lock = None
+        self.logger.info("LogsDownloader initializing is done")
+
+    """
+    Downloads the log files until the downloader is stopped, like LogsDownloader.get_log_files
+    """
+    async def run(self):
+        self.stop_event = asyncio.Event()
+        self.index_lock = asyncio.Lock()
+        self.session = self.create_session()
+        index_refresh_task = asyncio.ensure_future(self.refresh_index_periodically())
+        try:
+            while self.running:
+                if self.last_known_downloaded_file_id.get_last_log_id() == "":
+                    self.logger.info("No last downloaded file is found - downloading index file and starting to download all the log files in it")
+                    try:
+                        await self.refresh_index()
+                        await self.first_time_scan()
+                    except Exception as e:
+                        self.logger.error("Failed to downloading index file and starting to download all the log files in it - %s, %s", e, traceback.format_exc())
+                        self.scheduler.on_not_ready()
+                else:
+                    # download and handle the following log files, the downloads run ahead of the handling
+                    if await self.handle_files(self.upcoming_file_names(), False) > 0:
+                        continue
+                await self.wait("before trying to fetch logs again")
+        finally:
+            index_refresh_task.cancel()
+            # persist the last known downloaded file id before exiting
+            self.last_known_downloaded_file_id.flush()
+            if self.ledger is not None:
+                self.ledger.flush()
+            if self.syslog_writer is not None:
+                await self.syslog_writer.close()
+            await self.session.close()
+            self.logger.info("LogsDownloader stopped")
+
+    """
+    Stops the downloader once the files which are being downloaded are handled
+    """
+    def stop(self):
+        self.running = False
+        if self.stop_event is not None:
+            self.stop_event.set()
+
+    """
+    Creates the HTTP session of the logs server
+    """
+    def create_session(self):
+        ssl_context = False
+        if self.config.USE_CUSTOM_CA_FILE == "YES":
+            ssl_context = ssl.create_default_context(cafile=self.config.CUSTOM_CA_FILE)
+        connector = aiohttp.TCPConnector(limit=self.config.HTTP_POOL_SIZE, ssl=ssl_context)
+        return aiohttp.ClientSession(connector=connector, auth=aiohttp.BasicAuth(self.config.API_ID, self.config.API_KEY))
+
+    """
+    Scan the logs.index file, and download all the log files in it
+    """
+    async def first_time_scan(self):
+        self.logger.info("No last index found, will now scan the entire index...")
+        logs_in_index = [name for name in self.logs_file_index.indexed_logs() if LogsFileIndex.validate_log_file_format(name)]
+        # the files which were already handled are not downloaded again
+        if self.ledger is not None and logs_in_index:
+            last_log = logs_in_index[-1]
+            handled_logs = set(name for name in logs_in_index if self.ledger.contains(name))
+            if handled_logs:
+                self.logger.info("%s files of the index were already handled, skipping them", len(handled_logs))
+                self.metrics.inc("logs_downloader_files_total", (("result", "skipped"),), len(handled_logs))
+                logs_in_index = [name for name in logs_in_index if name not in handled_logs]
+            await self.handle_files(iter(logs_in_index), True)
+            # the position moves to the last file of the index, even when it was skipped
+            if last_log in handled_logs and self.running:
+                self.last_known_downloaded_file_id.update_last_log_id(last_log)
+        else:
+            await self.handle_files(iter(logs_in_index), True)
+        self.logger.info("Completed fetching all the files from the logs files index file")
+
+    """
+    Gets the names of the log files which follow the last known downloaded file, without the files which were already handled
+    """
+    def upcoming_file_names(self):
+        prefix = self.last_known_downloaded_file_id.prefix
+        log_id = self.last_known_downloaded_file_id.log_id
+        first_file = True
+        while True:
+            log_id += 1
+            filename = LogsFileIndex.file_name(prefix, log_id)
+            last_handled_file = self.ledger.last_handled(filename) if self.ledger is not None else None
+            if last_handled_file is not None:
+                self.logger.info("Files %s to %s were already handled, skipping them", filename, last_handled_file)
+                skipped_to_log_id = LogsFileIndex.parse_file_name(last_handled_file)[1]
+                self.metrics.inc("logs_downloader_files_total", (("result", "skipped"),), skipped_to_log_id - log_id + 1)
+                log_id = skipped_to_log_id
+                # the position moves over the skipped files which directly follow it, the files before them were all handled
+                if first_file:
+                    self.last_known_downloaded_file_id.update_last_log_id(last_handled_file)
+                continue
+            first_file = False
+            yield filename
+
+    """
+    Handles log files in order, while up to PREFETCH_WINDOW files are downloaded and decrypted ahead.
+    In a first time scan a failed file is skipped, otherwise the handling stops at the first failed file.
+    Returns the number of handled files
+    """
+    async def handle_files(self, file_names, first_time_scan):
+        in_flight = collections.deque()
+        handled_files = 0
+
+        def start_next_download():
+            if not self.running or len(in_flight) >= self.window:
+                return False
+            # the next file is always polled, the following ones are downloaded ahead only if the index has them
+            if in_flight and not first_time_scan:
+                prefix, log_id = LogsFileIndex.parse_file_name(in_flight[-1][0])
+                newest_log_id = self.logs_file_index.newest(prefix)
+                if newest_log_id is None or log_id >= newest_log_id:
+                    return False
+            filename = next(file_names, None)
+            if filename is None:
+                return False
+            in_flight.append((filename, asyncio.ensure_future(self.download_and_decrypt(filename))))
+            return True
+
+        try:
+            while start_next_download():
+                pass
+            # the files which are already downloading are handled even when the downloader is stopped
+            while in_flight:
+                filename, download = in_flight.popleft()
+                if await self.handle_file(filename, download, not first_time_scan):
+                    self.last_known_downloaded_file_id.update_last_log_id(filename)
+                    if self.ledger is not None:
+                        self.ledger.add(filename)
+                    handled_files += 1
+                elif first_time_scan:
+                    self.logger.warning("Skipping File %s", filename)
+                else:
+                    self.logger.info("Could not get log file %s. It could be that the log file does not exist yet.", filename)
+                    break
+                while start_next_download():
+                    pass
+        finally:
+            for filename, download in in_flight:
+                download.cancel()
+        return handled_files
+
+    """
+    Handles a log file which is being downloaded, the download is retried up to 3 times, like LogsDownloader.handle_file
+    """
+    async def handle_file(self, logfile, download, locate_missing_file):
+        loop = asyncio.get_event_loop()
+        for attempt in range(4):
+            if attempt > 0:
+                if not self.running:
+                    return False
+                self.metrics.inc("logs_downloader_retries_total")
+                await self.wait("until next file download retry number %s out of 3" % attempt)
+                download = self.download_and_decrypt(logfile)
+            result, decrypted_file, error = await download
+            # if we got it
+            if result[0] == "OK":
+                try:
+                    if error is not None:
+                        raise error
+                    await self.handle_log_decrypted_content(logfile, decrypted_file)
+                    self.logger.info("File %s download and processing completed successfully", logfile)
+                    self.metrics.inc("logs_downloader_files_total", (("result", "handled"),))
+                    self.scheduler.on_success()
+                    return True
+                # if an exception occurs during the decryption or handling the decrypted content,
+                # we save the raw file to a "fail" folder
+                except Exception as e:
+                    self.logger.error("Saving file %s locally to the 'fail' folder %s %s", logfile, e, traceback.format_exc())
+                    await loop.run_in_executor(self.executor, self.save_failed_file, logfile, result[1])
+                    return False
+            elif result[0] == "404_NOT_FOUND":
+                self.logger.info("Got 404 on file: %s", logfile)
+                self.scheduler.on_not_ready()
+                if locate_missing_file:
+                    await self.locate_missing_file(logfile)
+                return False
+            # if the server asked us to slow down
+            elif result[0] == "RATE_LIMITED":
+                self.scheduler.on_rate_limited(result[1])
+            else:
+                self.scheduler.on_not_ready()
+        return False
+
+    """
+    Checks where a missing file is relative to the files in the bucket, and skips to the next existing file if needed
+    """
+    async def locate_missing_file(self, logfile):
+        try:
+            await self.refresh_index()
+        except Exception as e:
+            self.logger.error("Failed to download the logs index file - %s", e)
+            return
+        prefix, log_id = LogsFileIndex.parse_file_name(logfile)
+        first_log_id = self.logs_file_index.oldest(prefix)
+        last_log_id = self.logs_file_index.newest(prefix)
+        if first_log_id is None:
+            self.logger.info("no log files of %s in bucket, not updating values", prefix)
+        elif log_id < first_log_id:
+            self.last_known_downloaded_file_id.update_last_log_id(LogsFileIndex.file_name(prefix, first_log_id - 1))
+            self.logger.info("updated log file to: %s", LogsFileIndex.file_name(prefix, first_log_id))
+        elif log_id > last_log_id:
+            self.logger.info("file %s is not in the bucket yet, not updating values", logfile)
+        elif not self.logs_file_index.contains(prefix, log_id):
+            # the file is missing from the bucket, so we continue from the next file which exists
+            next_log_id = self.logs_file_index.successor(prefix, log_id)
+            self.last_known_downloaded_file_id.update_last_log_id(LogsFileIndex.file_name(prefix, next_log_id - 1))
+            self.logger.info("file %s is not in bucket, continuing from: %s", logfile, LogsFileIndex.file_name(prefix, next_log_id))
+
+    """
+    Downloads a log file and decrypts it on the executor, returns the download result, the decrypted content and the decryption error
+    """
+    async def download_and_decrypt(self, filename):
+        result = await self.download_log_file(filename)
+        if result[0] != "OK":
+            return result, None, None
+        try:
+            decrypted_file = await asyncio.get_event_loop().run_in_executor(self.executor, self.decrypt_file, result[1], filename)
+            return result, decrypted_file, None
+        except Exception as e:
+            return result, None, e
+
+    """
+    Downloads a log file, returns the same results as LogsDownloader.download_log_file
+    """
+    async def download_log_file(self, filename):
+        url = self.config.BASE_URL + filename
+        try:
+            with self.metrics.time("download"):
+                status, content, headers = await self.request(url)
+        except Exception as e:
+            self.logger.error("Error while trying to download file %s - %s", filename, e)
+            return "ERROR", ""
+        if status == 200 and content:
+            self.logger.info("Successfully downloaded file from URL %s", url)
+            self.metrics.inc("logs_downloader_bytes_total", (("stage", "download"),), len(content))
+            return "OK", content
+        elif status == 200:
+            return "NOT_FOUND", content
+        elif status == 404:
+            self.logger.error("Could not find file %s. Response code is %s", url, status)
+            return "404_NOT_FOUND", ""
+        elif status == 429:
+            self.logger.error("Rate limit exceeded - Failed to download file %s. Response code is %s", url, status)
+            retry_after = FileDownloader.parse_retry_after(headers.get("Retry-After"))
+            # hold all the requests to the API until the server allows them again
+            if retry_after is not None:
+                self.rate_limiter.pause(retry_after)
+            return "RATE_LIMITED", retry_after
+        elif status == 401:
+            self.logger.error("Authorization error - Failed to download file %s. Response code is %s", url, status)
+        else:
+            self.logger.error("An error has occur while making a open connection to %s. %s", url, status)
+        return "ERROR", ""
+
+    """
+    Sends a GET request to the logs server, returns the status code, the content and the headers of the response
+    """
+    async def request(self, url, headers=None):
+        while True:
+            wait_time = self.rate_limiter.try_acquire()
+            if wait_time == 0:
+                break
+            await asyncio.sleep(wait_time)
+        proxy = self.config.PROXY_SERVER if self.config.USE_PROXY == "YES" else None
+        try:
+            async with self.session.get(url, headers=headers, proxy=proxy, timeout=aiohttp.ClientTimeout(total=20)) as response:
+                content = await response.read()
+        except Exception:
+            self.metrics.inc("logs_downloader_http_responses_total", (("status", "error"),))
+            raise
+        self.metrics.inc("logs_downloader_http_responses_total", (("status", str(response.status)),))
+        return response.status, content, response.headers
+
+    """
+    Refreshes the logs index file if it was not refreshed in the last LOGS_INDEX_TTL seconds, like LogsFileIndex.refresh
+    """
+    async def refresh_index(self):
+        async with self.index_lock:
+            logs_file_index = self.logs_file_index
+            if logs_file_index.refresh_time is not None and time.time() - logs_file_index.refresh_time < self.config.LOGS_INDEX_TTL:
+                return
+            self.logger.info("Downloading logs index file...")
+            headers = {}
+            if logs_file_index.etag is not None:
+                headers["If-None-Match"] = logs_file_index.etag
+            if logs_file_index.last_modified is not None:
+                headers["If-Modified-Since"] = logs_file_index.last_modified
+            status, content, response_headers = await self.request(self.config.BASE_URL + "logs.index", headers)
+            # if the file was not modified since the last download
+            if status == 304:
+                self.logger.debug("logs index file was not modified")
+                logs_file_index.refresh_time = time.time()
+                return
+            if status != 200 or not content:
+                raise Exception("Failed to download the logs index file, response code is %s" % status)
+            content = content.decode("utf-8")
+            if not LogsFileIndex.validate_logs_index_file_format(content):
+                self.logger.error("log.index, Pattern Validation Failed")
+                raise Exception("log.index, Pattern Validation Failed")
+            logs_file_index.load(content)
+            logs_file_index.etag = response_headers.get("ETag")
+            logs_file_index.last_modified = response_headers.get("Last-Modified")
+            logs_file_index.refresh_time = time.time()
+
+    """
+    Keeps the logs index fresh in the background, so the files which are downloaded ahead are known without waiting
+    """
+    async def refresh_index_periodically(self):
+        while self.running:
+            try:
+                await self.refresh_index()
+            except Exception as e:
+                self.logger.debug("Failed to refresh the logs index file - %s", e)
+            await asyncio.sleep(max(1, self.config.LOGS_INDEX_TTL))
+
+    """
+    Waits for the current polling delay, returns early if the downloader is stopped
+    """
+    async def wait(self, reason):
+        if self.scheduler.delay <= 0 or not self.running:
+            return
+        delay = self.scheduler.jittered_delay()
+        self.logger.info("Sleeping for %.1f seconds %s...", delay, reason)
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    """
+    Decrypts a downloaded log file, the same way as LogsDownloader.decrypt_file, runs on the executor
+    """
+    def decrypt_file(self, file_content, filename):
+        # each log file is built from a header section and a content section, the two are divided by a |==| mark
+        file_header_content, file_log_content = file_content.split(b"|==|\n", 1)
+        file_header_content = file_header_content.decode("utf-8")
+        # if the file is not encrypted - the "key" value in the file header is '-1'
+        if file_header_content.find("key:") == -1:
+            self.logger.debug("%s is not encrypted, Skipping decryption", filename)
+            return self.decode_engine.decode(file_log_content, None, None, filename)
+        checksum = file_header_content.split("checksum:")[1].splitlines()[0]
+        content_encrypted_sym_key = file_header_content.split("key:")[1].splitlines()[0]
+        public_key_id = file_header_content.split("publicKeyId:")[1].splitlines()[0]
+        sym_key = self.key_ring.decrypt_symmetric_key(public_key_id, content_encrypted_sym_key.encode("ascii"), filename)
+        # decrypt, uncompress and verify the log content, on a decode worker process when DECODE_WORKERS is set
+        return self.decode_engine.decode(file_log_content, sym_key, checksum, filename)
+
+    """
+    Sends the decrypted lines to the syslog servers while the local file is written on the executor
+    """
+    async def handle_log_decrypted_content(self, filename, decrypted_file):
+        if self.line_filter is not None:
+            decrypted_file = await asyncio.get_event_loop().run_in_executor(self.executor, self.filter_content, decrypted_file)
+        writes = [asyncio.get_event_loop().run_in_executor(self.executor, self.write_local_file, filename, decrypted_file)]
+        if self.syslog_writer is not None:
+            writes.append(self.syslog_writer.emit(decrypted_file.splitlines()))
+        await asyncio.gather(*writes)
+
+    """
+    Filters the decrypted content, the lines are decoded as UTF-8 and the bytes which are not valid UTF-8 are kept as is. Runs on the executor
+    """
+    def filter_content(self, decrypted_file):
+        return self.line_filter.filter_content(decrypted_file.decode("utf-8", "surrogateescape")).encode("utf-8", "surrogateescape")
+
+    """
+    Writes the file to the sinks which are not handled by this engine, runs on the executor
+    """
+    def write_local_file(self, filename, decrypted_file):
+        content_sinks = LogContentSinks(self, filename)
+        try:
+            content_sinks.write_content(decrypted_file)
+            content_sinks.close()
+        except Exception:
+            content_sinks.abort()
+            raise
+
+    """
+    Compresses a handled log file, used by LogContentSinks
+    """
+    def gzip_file(self, infile, callback=None, failure_callback=None):
+        self.compression_engine.compress(infile, callback, failure_callback)
+
+    # routes the written local file to SFTP and compression, the same way as the default engine
+    transfer_local_file = LogsDownloader.transfer_local_file
+    open_sink = LogsDownloader.open_sink
+
+    """
+    Saves a raw file content to the "fail" folder
+    """
+    def save_failed_file(self, logfile, file_content):
+        self.metrics.inc("logs_downloader_files_total", (("result", "failed"),))
+        fail_dir = os.path.join(self.config.PROCESS_DIR, 'fail')
+        if not os.path.exists(fail_dir):
+            os.makedirs(fail_dir)
+        with open(os.path.join(fail_dir, logfile), "wb") as file:
+            file.write(file_content)
+        self.logger.info("Saved file %s locally to the 'fail' folder", logfile)
+
+    """
+    Gets the number of log files between the last downloaded file and the newest file in the logs index
+    """
+    def get_lag(self):
+        last_log_id = self.last_known_downloaded_file_id.log_id
+        newest_log_id = self.logs_file_index.newest(self.last_known_downloaded_file_id.prefix)
+        if last_log_id is None or newest_log_id is None:
+            return None
+        return max(0, newest_log_id - last_log_id)
+
+
+"""
+
+AsyncioSyslogWriter - A class for sending log lines to the syslog servers over long lived event loop connections
+
+"""
+
+
+class AsyncioSyslogWriter:
+
+    def __init__(self, config, logger, metrics):
+        self.logger = logger
+        self.metrics = metrics
+        self.servers = [(server.strip(), int(config.SYSLOG_PORT)) for server in config.SYSLOG_ADDRESS.split(",")]
+        self.batch_size = config.SYSLOG_BATCH_SIZE
+        self.timeout = config.SYSLOG_TIMEOUT
+        self.retry_interval = config.SYSLOG_HEALTH_CHECK_INTERVAL
+        # the open connection of each server, and the time until which each failed server is skipped
+        self.writers = {}
+        self.failed_until = {}
+        self.next_server = 0
+
+    """
+    Sends log lines, the lines are framed with their octet count and sent in large batches, like SyslogConnectionPool.emit
+    """
+    async def emit(self, lines):
+        batch = []
+        batch_size = 0
+        for msg in lines:
+            if msg:
+                frame = b"%d %s" % (len(msg), msg)
+                batch.append(frame)
+                batch_size += len(frame)
+                if batch_size >= self.batch_size:
+                    await self.send(b"".join(batch))
+                    batch = []
+                    batch_size = 0
+        if batch:
+            await self.send(b"".join(batch))
+
+    """
+    Sends a batch to the next available server, the batch moves to the following server if the send fails
+    """
+    async def send(self, batch):
+        for attempt in range(len(self.servers)):
+            server = self.servers[self.next_server]
+            self.next_server = (self.next_server + 1) % len(self.servers)
+            if time.time() < self.failed_until.get(server, 0):
+                continue
+            try:
+                writer = self.writers.get(server)
+                if writer is None:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(server[0], server[1]), self.timeout)
+                    self.writers[server] = writer
+                with self.metrics.time("syslog_emit"):
+                    writer.write(batch)
+                    await asyncio.wait_for(writer.drain(), self.timeout)
+                self.metrics.inc("logs_downloader_bytes_total", (("stage", "syslog_emit"),), len(batch))
+                return
+            except Exception as e:
+                self.logger.error("Failed to send to syslog server %s:%s - %s", server[0], server[1], e)
+                writer = self.writers.pop(server, None)
+                if writer is not None:
+                    writer.close()
+                self.failed_until[server] = time.time() + self.retry_interval
+        raise Exception("No syslog server is available")
+
+    """
+    Closes the connections once the sent lines were written to them
+    """
+    async def close(self):
+        for writer in self.writers.values():
+            try:
+                await asyncio.wait_for(writer.drain(), self.timeout)
+            except Exception:
+                pass
+            writer.close()
+        self.writers = {}
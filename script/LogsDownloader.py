@@ -33,35 +33,50 @@
 #
 
 
-import ConfigParser
+import array
 import base64
+import bisect
+import calendar
+import collections
+import contextlib
+import email.utils
 import getopt
 import hashlib
+import io
 import logging
+import multiprocessing
 import os
 import platform
 import re
+import shutil
 import signal
+import socket
+import struct
 import sys
+import tempfile
 import threading
 import time
 import traceback
-import urllib2
 import zlib
 from logging import handlers
 import random
-import M2Crypto
-import loggerglue
-import loggerglue.emitter
-import loggerglue.logger
-from Crypto.Cipher import AES
-
-import paramiko
-from paramiko.py3compat import input
+try:
+    import ConfigParser
+    import BaseHTTPServer
+    import Queue
+    import urllib2
+except ImportError:
+    # the module is imported on Python 3 by the asyncio engine
+    import configparser as ConfigParser
+    import http.server as BaseHTTPServer
+    import queue as Queue
 import ssl
 import requests
+import requests.adapters
 import urllib3
 import gzip
+# the sink plugins, each plugin module is imported only when its sink is enabled
+import sinks
 
 """
 Warnings overrides
@@ -78,29 +93,18 @@ class LogsDownloader:
     # the LogsDownloader will run until external termination
     running = True
 
-    def __init__(self, config_path, system_log_path, log_level):
+    def __init__(self, config_path, system_log_path, log_level, shared_resources=None):
         # set a log file for the downloader
-        self.logger = logging.getLogger("logsDownloader")
-        # default log directory for the downloader
-        log_dir = system_log_path
-        # create the log directory if needed
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir)
-        # keep logs history for 7 days
-        file_handler = logging.handlers.TimedRotatingFileHandler(os.path.join(log_dir, "logs_downloader.log"), when='midnight', backupCount=7)
-        formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
-        file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(formatter)
-        self.logger.addHandler(console_handler)
-        if log_level.upper() == "DEBUG":
-            self.logger.setLevel(logging.DEBUG)
-        elif log_level.upper() == "INFO":
-            self.logger.setLevel(logging.INFO)
-        elif log_level.upper() == "ERROR":
-            self.logger.setLevel(logging.ERROR)
+        self.logger = LogsDownloader.create_logger(system_log_path, log_level)
+        # the connections and worker pools, which are shared by all the downloaders of the process
+        if shared_resources is None:
+            shared_resources = SharedResources(False)
+        self.shared_resources = shared_resources
+        # when running a few accounts, each log line is prefixed with the account config folder
+        if shared_resources.multi_account:
+            self.logger = AccountLoggerAdapter(self.logger, {"account": config_path})
         self.logger.debug("Initializing LogsDownloader")
+        self.metrics = shared_resources.metrics
         self.config_path = config_path
         self.config_reader = Config(self.config_path, self.logger)
         try:
@@ -109,18 +113,103 @@ class LogsDownloader:
         except Exception:
             self.logger.error("Exception while getting LogsDownloader config file - Could Not find Configuration file - %s", traceback.format_exc())
             sys.exit("Could Not find Configuration file")
+        # create the compression worker processes first, before any other thread is started - only when local files are written
+        self.compression_engine = None
+        if self.config.SAVE_LOCALLY == "YES":
+            self.compression_engine = shared_resources.get_compression_engine(self.config, self.logger)
+        self.decode_engine = shared_resources.get_decode_engine(self.config, self.logger)
+        # create the filter of the decrypted log lines, None if all the lines are sent as is
+        self.line_filter = CefFilter.from_config(self.config, self.metrics)
         # create a file downloader handler
-        self.file_downloader = FileDownloader(self.config, self.logger)
+        self.file_downloader = FileDownloader(self.config, self.logger, shared_resources.get_http_adapter(self.config), self.metrics)
+        # the download slots which are fairly shared with the other accounts, None if downloads are not limited
+        self.download_slots = shared_resources.get_download_slots(self.config)
         # create a last file id handler
-        self.last_known_downloaded_file_id = LastFileId(self.config_path)
+        self.checkpoint = LastFileId(self.config_path, self.config.CHECKPOINT_EVERY_FILES, self.config.CHECKPOINT_INTERVAL)
+        # the log files which were already handled, a backfill worker downloads its range again on purpose
+        self.ledger = None
+        if self.config.PROCESSED_FILES_LEDGER == "YES" and not shared_resources.pool_worker:
+            self.ledger = ProcessedFileLedger(self.config_path, self.config.CHECKPOINT_EVERY_FILES, self.config.CHECKPOINT_INTERVAL)
+        self.last_known_downloaded_file_id = self.checkpoint
+        # create a private keys handler for decrypting the files
+        self.key_ring = PrivateKeyRing(self.config_path, self.config, self.logger, self.metrics)
         # create a logs file index handler
         self.logs_file_index = LogsFileIndex(self.config, self.logger, self.file_downloader)
+        # load the plugin modules of the enabled sinks, the other sinks are never imported
+        self.sink_names = sinks.enabled_sinks(self.config)
+        self.sink_modules = dict((name, sinks.load(name)) for name in self.sink_names)
+        # create the connections to the syslog servers, they are kept open across files
+        self.syslog_pool = None
+        if "syslog" in self.sink_names:
+            self.syslog_pool = shared_resources.get_syslog_pool(self.config, self.logger)
+        # create an uploader which sends the log files to the SFTP server in the background
+        self.sftp_uploader = None
+        if self.config.SFTP_TRANSFER == "YES":
+            self.sftp_uploader = shared_resources.get_sftp_uploader(self.config, self.logger)
+        # create the client which sends the log lines to the HTTP collector in bulk requests
+        self.http_bulk_client = None
+        if "http" in self.sink_names:
+            self.http_bulk_client = shared_resources.get_http_bulk_client(self.config, self.logger)
+        # create a scheduler which decides how long to wait between polls for the next file
+        self.scheduler = PollingScheduler(self.config, self.logger, lambda: self.running)
+        # create a pipeline which decrypts the downloaded files and writes them to the sinks on separate stages
+        self.pipeline = None
+        if self.config.PIPELINE_MODE == "YES":
+            if self.config.STREAMING_MODE == "YES":
+                self.logger.warning("PIPELINE_MODE is ignored when STREAMING_MODE is enabled")
+            else:
+                self.pipeline = LogFilePipeline(self, self.checkpoint)
+                # the downloads run ahead of the checkpoint by the files which are still on the pipeline
+                self.last_known_downloaded_file_id = DownloadCursor(self.checkpoint)
+        # create a prefetcher for downloading the upcoming log files in parallel
+        self.prefetcher = None
+        if self.config.PREFETCH_WINDOW > 1:
+            if self.config.STREAMING_MODE == "YES":
+                self.logger.warning("PREFETCH_WINDOW is ignored when STREAMING_MODE is enabled")
+            else:
+                # on a pipeline the files are decrypted by the decode stage
+                self.prefetcher = LogFilePrefetcher(self, self.config.PREFETCH_WINDOW, self.logger, self.pipeline is None)
         # create log folder if needed for storing downloaded logs
         if self.config.SAVE_LOCALLY == "YES":
             if not os.path.exists(self.config.PROCESS_DIR):
                 os.makedirs(self.config.PROCESS_DIR)
+        # download the indexed log files which were skipped in the background
+        self.gap_repairer = None
+        if self.config.GAP_REPAIR == "YES" and self.ledger is not None:
+            self.gap_repairer = GapRepairer(self)
+        # expose how far behind the newest log file in the bucket we are
+        self.metrics.add_gauge("logs_downloader_lag_files", (("account", self.config_path),), self.get_lag)
+        shared_resources.start_metrics_server(self.config, self.logger)
         self.logger.info("LogsDownloader initializing is done")
 
+    """
+    Gets the downloader logger, its log file is set once, even when a few downloaders run in the same process
+    """
+    @staticmethod
+    def create_logger(system_log_path, log_level):
+        logger = logging.getLogger("logsDownloader")
+        if not logger.handlers:
+            # default log directory for the downloader
+            log_dir = system_log_path
+            # create the log directory if needed
+            if not os.path.exists(log_dir):
+                os.makedirs(log_dir)
+            # keep logs history for 7 days
+            file_handler = logging.handlers.TimedRotatingFileHandler(os.path.join(log_dir, "logs_downloader.log"), when='midnight', backupCount=7)
+            formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+            file_handler.setFormatter(formatter)
+            logger.addHandler(file_handler)
+            console_handler = logging.StreamHandler()
+            console_handler.setFormatter(formatter)
+            logger.addHandler(console_handler)
+            if log_level.upper() == "DEBUG":
+                logger.setLevel(logging.DEBUG)
+            elif log_level.upper() == "INFO":
+                logger.setLevel(logging.INFO)
+            elif log_level.upper() == "ERROR":
+                logger.setLevel(logging.ERROR)
+        return logger
+
     """
     Download the log files.
     If this is the first time, we get the logs.index file, scan it, and download all of the files in it.
@@ -134,21 +223,29 @@ class LogsDownloader:
             if last_log_id == "":
                     self.logger.info("No last downloaded file is found - downloading index file and starting to download all the log files in it")
                     try:
-                        # download the logs.index file
-                        self.logs_file_index.download()
+                        # download the logs.index file, unless it was recently downloaded
+                        self.logs_file_index.refresh()
                         # scan it and download all of the files in it
                         self.first_time_scan()
                     except Exception as e:
                         self.logger.error("Failed to downloading index file and starting to download all the log files in it - %s, %s", e.message, traceback.format_exc())
-                        # wait for 5 seconds between each iteration
-                        self.logger.info("Sleeping for 3 seconds before trying to fetch logs again...")
-                        time.sleep(3)
+                        # back off before trying again
+                        self.scheduler.on_not_ready()
+                        self.scheduler.wait("before trying to fetch logs again")
                         continue
             # the is a last downloaded log file id
             else:
                 self.logger.debug("The last known downloaded file is %s", last_log_id)
                 # get the next log file name that we should download
                 next_file = self.last_known_downloaded_file_id.get_next_file_name()
+                # skip the files which were already handled, for example after the position was reset to the oldest file in the bucket
+                last_handled_file = self.ledger.last_handled(next_file) if self.ledger is not None else None
+                if last_handled_file is not None:
+                    skipped_files = LogsFileIndex.parse_file_name(last_handled_file)[1] - LogsFileIndex.parse_file_name(next_file)[1] + 1
+                    self.logger.info("Files %s to %s were already handled, skipping them", next_file, last_handled_file)
+                    self.metrics.inc("logs_downloader_files_total", (("result", "skipped"),), skipped_files)
+                    self.last_known_downloaded_file_id.update_last_log_id(last_handled_file)
+                    continue
                 self.logger.debug("Will now try to download %s", next_file)
                 try:
                     # download and handle the next log file
@@ -158,15 +255,36 @@ class LogsDownloader:
                         self.logger.debug("Successfully handled file %s, updating the last known downloaded file id", next_file)
                         # set the last handled log file information
                         self.last_known_downloaded_file_id.move_to_next_file()
+                        # we are probably catching up, so download the following files in parallel, only the ones the index already has
+                        if self.prefetcher is not None:
+                            upcoming_logs = self.last_known_downloaded_file_id.get_next_file_names(self.prefetcher.window)
+                            prefix, log_id = LogsFileIndex.parse_file_name(next_file)
+                            newest_log_id = self.logs_file_index.newest(prefix)
+                            # the cached index may be behind, it is downloaded again at most once every LOGS_INDEX_TTL seconds
+                            if newest_log_id is None or newest_log_id <= log_id:
+                                self.logs_file_index.refresh()
+                                newest_log_id = self.logs_file_index.newest(prefix)
+                            upcoming_logs = [name for name in upcoming_logs
+                                             if newest_log_id is not None and LogsFileIndex.parse_file_name(name)[1] <= newest_log_id]
+                            if self.ledger is not None:
+                                upcoming_logs = [name for name in upcoming_logs if not self.ledger.contains(name)]
+                            self.prefetcher.prefetch(upcoming_logs)
+                        # poll for the next file right away
+                        continue
                     # we failed to handle the next log file
                     else:
                         self.logger.info("Could not get log file %s. It could be that the log file does not exist yet.", next_file)
                 except Exception as e:
                         self.logger.error("Failed to download file %s. Error is - %s , %s", next_file, e.message, traceback.format_exc())
             if self.running:
-                # wait for 5 seconds between each iteration
-                self.logger.info("Sleeping for 3 seconds before trying to fetch logs again...")
-                time.sleep(3)
+                # wait until the next file is expected, backing off while it does not exist
+                self.scheduler.wait("before trying to fetch logs again")
+        # let the files on the pipeline reach the sinks, and persist the last known downloaded file id before exiting
+        if self.pipeline is not None:
+            self.pipeline.drain()
+        self.checkpoint.flush()
+        if self.ledger is not None:
+            self.ledger.flush()
 
     """
     Scan the logs.index file, and download all the log files in it
@@ -175,10 +293,25 @@ class LogsDownloader:
         self.logger.info("No last index found, will now scan the entire index...")
         # get the list of file names from the index file
         logs_in_index = self.logs_file_index.indexed_logs()
+        # the files which were already handled are not downloaded again
+        last_handled_log = None
+        if self.ledger is not None:
+            handled_logs = set(log_file_name for log_file_name in logs_in_index
+                               if LogsFileIndex.validate_log_file_format(str(log_file_name.rstrip('\r\n'))) and self.ledger.contains(log_file_name))
+            if handled_logs:
+                self.logger.info("%s files of the index were already handled, skipping them", len(handled_logs))
+                self.metrics.inc("logs_downloader_files_total", (("result", "skipped"),), len(handled_logs))
+                if logs_in_index[-1] in handled_logs:
+                    last_handled_log = logs_in_index[-1]
+                logs_in_index = [log_file_name for log_file_name in logs_in_index if log_file_name not in handled_logs]
         # for each file
-        for log_file_name in logs_in_index:
+        for position, log_file_name in enumerate(logs_in_index):
             if self.running:
                 if LogsFileIndex.validate_log_file_format(str(log_file_name.rstrip('\r\n'))):
+                    # download the following files in parallel, they are still handled one by one in the index order
+                    if self.prefetcher is not None:
+                        upcoming_logs = [name for name in logs_in_index[position:position + self.prefetcher.window] if LogsFileIndex.validate_log_file_format(str(name.rstrip('\r\n')))]
+                        self.prefetcher.prefetch(upcoming_logs)
                     # download and handle the log file
                     success = self.handle_file(log_file_name, wait_time=3)
                     # if we successfully handled the log file
@@ -186,8 +319,13 @@ class LogsDownloader:
                         # set the last handled log file information
                         self.last_known_downloaded_file_id.update_last_log_id(log_file_name)
                     else:
-                        # skip the file and try to get the next one
+                        # skip the file and try to get the next one, it is downloaded again in the background
                         self.logger.warning("Skipping File %s", log_file_name)
+                        if self.gap_repairer is not None:
+                            self.gap_repairer.add([log_file_name])
+        # the position moves to the last file of the index, even when it was skipped
+        if last_handled_log is not None and self.running:
+            self.last_known_downloaded_file_id.update_last_log_id(last_handled_log)
         self.logger.info("Completed fetching all the files from the logs files index file")
 
     """
@@ -197,60 +335,87 @@ class LogsDownloader:
         # we will try to get the file a max of 3 tries
         counter = 0
         failcount = 0
+        attempts = 0
         while counter <= 3:
             if self.running:
-                # download the file
-                result = self.download_log_file(logfile)
+                # the position may have been moved back to a file which was already handled
+                if self.ledger is not None and self.ledger.contains(logfile):
+                    self.logger.info("File %s was already handled, skipping it", logfile)
+                    self.metrics.inc("logs_downloader_files_total", (("result", "skipped"),))
+                    return True
+                if attempts > 0:
+                    self.metrics.inc("logs_downloader_retries_total")
+                attempts += 1
+                prefetched = None
+                # download, decrypt and handle the file chunk by chunk
+                if self.config.STREAMING_MODE == "YES":
+                    result = self.stream_log_file(logfile)
+                # use the file if it was already downloaded by the prefetcher, otherwise download it
+                else:
+                    prefetched = self.prefetcher.take(logfile) if self.prefetcher is not None else None
+                    result = prefetched.result if prefetched is not None else self.download_log_file(logfile)
+                # if the file was streamed to the end
+                if result[0] == "STREAMED":
+                    self.logger.info("File %s download and processing completed successfully", logfile)
+                    self.metrics.inc("logs_downloader_files_total", (("result", "handled"),))
+                    if self.ledger is not None:
+                        self.ledger.add(logfile)
+                    self.scheduler.on_success()
+                    return True
+                # if an exception occurs while streaming the file, we download it again and save the raw file to a "fail" folder
+                elif result[0] == "STREAM_FAILED":
+                    raw_result = self.download_log_file(logfile)
+                    if raw_result[0] == "OK":
+                        self.save_failed_file(logfile, raw_result[1])
+                    break
                 # if we got it
-                if result[0] == "OK":
+                # on a pipeline the file is decrypted and written to the sinks by the pipeline stages
+                elif result[0] == "OK" and self.pipeline is not None:
+                    self.pipeline.submit(logfile, result[1], prefetched)
+                    self.scheduler.on_success()
+                    return True
+                elif result[0] == "OK":
                     try:
                         # we decrypt the file
-                        decrypted_file = self.decrypt_file(result[1], logfile)
+                        if prefetched is not None and prefetched.error is not None:
+                            raise prefetched.error
+                        elif prefetched is not None:
+                            decrypted_file = prefetched.decrypted
+                        else:
+                            decrypted_file = self.decrypt_file(result[1], logfile)
                         # handle the decrypted content
                         self.handle_log_decrypted_content(logfile, decrypted_file)
                         self.logger.info("File %s download and processing completed successfully", logfile)
+                        self.metrics.inc("logs_downloader_files_total", (("result", "handled"),))
+                        if self.ledger is not None:
+                            self.ledger.add(logfile)
+                        self.scheduler.on_success()
                         return True
                     # if an exception occurs during the decryption or handling the decrypted content,
                     # we save the raw file to a "fail" folder
                     except Exception as e:
                         self.logger.error("Saving file %s locally to the 'fail' folder %s %s", logfile, e.message, traceback.format_exc())
-                        fail_dir = os.path.join(self.config.PROCESS_DIR, 'fail')
-                        if not os.path.exists(fail_dir):
-                            os.mkdir(fail_dir)
-                        with open(os.path.join(fail_dir, logfile), "w") as file:
-                            file.write(result[1])
-                        self.logger.info("Saved file %s locally to the 'fail' folder", logfile)
+                        self.save_failed_file(logfile, result[1])
                         break
                 elif result[0] == "404_NOT_FOUND":
                     self.logger.info("Got 404 on file: %s", logfile)
                     counter += 1
-                    # insert code to retrieve latest log file from the bucket here in case of 404
-                    base64creds = base64.encodestring('%s:%s' % (self.config.API_ID, self.config.API_KEY)).replace('\n', '')
-                    headers = {"Authorization": "Basic %s" % base64creds}
-                    if self.config.USE_CUSTOM_CA_FILE == "YES":
-                        if self.config.USE_PROXY == "YES":
-                            proxies = {'http': self.config.PROXY_SERVER, 'https': self.config.PROXY_SERVER}
-                            request = requests.get((self.config.BASE_URL + "/logs.index"), headers=headers, proxies=proxies, verify=self.config.CUSTOM_CA_FILE, timeout=20)
-                        else:
-                            request = requests.get((self.config.BASE_URL + "/logs.index"), headers=headers, verify=self.config.CUSTOM_CA_FILE, timeout=20)
-                    else:
-                        if self.config.USE_PROXY == "YES":
-                            proxies = {'http': self.config.PROXY_SERVER, 'https': self.config.PROXY_SERVER}
-                            request = requests.get((self.config.BASE_URL + "/logs.index"), headers=headers, proxies=proxies, verify=False, timeout=20)
-                        else:
-                            request = requests.get((self.config.BASE_URL + "/logs.index"), headers=headers, verify=False, timeout=20)
-                    data = request.content
-                    request.connection.close()
-                    # self.logger.debug("logs index data is: %s", data)
-                    first_logfile = data.split('\n')[0]
+                    self.scheduler.on_not_ready()
+                    # check where the file is relative to the files in the bucket, using the cached logs index
+                    self.logs_file_index.refresh()
+                    prefix, log_id = LogsFileIndex.parse_file_name(logfile)
+                    first_log_id = self.logs_file_index.oldest(prefix)
+                    last_log_id = self.logs_file_index.newest(prefix)
+                    first_logfile = LogsFileIndex.file_name(prefix, first_log_id) if first_log_id is not None else None
                     self.logger.info("first line/oldest log in bucket: %s", first_logfile)
-                    last_logfile = data.split('\n')[-2]
-                    self.logger.info("last line/newest log in bucket: %s", last_logfile)
-                    if int(re.search('((?<=_)\\d+)(?=\\.)', logfile).group(0)) < int(re.search('((?<=_)\\d+)(?=\\.)', first_logfile).group(0)):
+                    self.logger.info("last line/newest log in bucket: %s", LogsFileIndex.file_name(prefix, last_log_id) if last_log_id is not None else None)
+                    if first_log_id is None:
+                        self.logger.info("no log files of %s in bucket, not updating values", prefix)
+                    elif log_id < first_log_id:
                         logfile = first_logfile
                         self.last_known_downloaded_file_id.update_last_log_id(logfile)
                         self.logger.info("updated log file to: %s", logfile)
-                    elif int(re.search('((?<=_)\\d+)(?=\\.)', logfile).group(0)) > int(re.search('((?<=_)\\d+)(?=\\.)', last_logfile).group(0)):
+                    elif log_id > last_log_id:
                         self.logger.info("true 404 found, waiting a minute, not updating values")
                         failcount += 1
                         if failcount > 3:
@@ -260,55 +425,111 @@ class LogsDownloader:
                             self.logger.info("updated log file to: %s", logfile)
                             #self.logs_file_index.download()
                             #self.first_time_scan()
-                        else:
-                            time.sleep(10)
+                    elif self.logs_file_index.contains(prefix, log_id):
+                        self.last_known_downloaded_file_id.update_last_log_id(logfile)
+                        self.logger.info("found the file we stopped at, logfile value is now: %s", logfile)
                     else:
-                        for each_file in data.split('\n')[1:-3]:
-                            if logfile == each_file:
-                                logfile = each_file
-                                self.last_known_downloaded_file_id.update_last_log_id(logfile)
-                                self.logger.info("found the file we stopped at, logfile value is now: %s", logfile)
-                                break
+                        # the file is missing from the bucket, so we continue from the next file which exists
+                        next_log_id = self.logs_file_index.successor(prefix, log_id)
+                        self.last_known_downloaded_file_id.update_last_log_id(LogsFileIndex.file_name(prefix, next_log_id - 1))
+                        self.logger.info("file %s is not in bucket, continuing from: %s", logfile, LogsFileIndex.file_name(prefix, next_log_id))
+                        # the file is known to be missing, so it is not downloaded again
+                        return False
                     self.logger.debug("404 snippet completed")
+                # if the server asked us to slow down
+                elif result[0] == "RATE_LIMITED":
+                    counter += 1
+                    self.scheduler.on_rate_limited(result[1])
                 # if the file is not found (could be that it is not generated yet)
                 elif result[0] == "NOT_FOUND" or result[0] == "ERROR":
                     # we increase the retry counter
                     counter += 1
+                    self.scheduler.on_not_ready()
                 # if we want to sleep between retries
                 if wait_time > 0 and counter <= 2:
                     if self.running:
-                        self.logger.info("Sleeping for %s seconds until next file download retry number %s out of 2", wait_time, counter)
-                        time.sleep(wait_time)
+                        self.scheduler.wait("until next file download retry number %s out of 2" % counter)
             # if the downloader was stopped
             else:
                 return False
         # if we didn't succeed to download the file
         return False
 
+    """
+    Creates the sink object of an enabled sink for a log file
+    """
+    def open_sink(self, name, filename):
+        return self.sink_modules[name].create_sink(self, filename)
+
+    """
+    Saves a raw file content to the "fail" folder
+    """
+    def save_failed_file(self, logfile, file_content):
+        self.metrics.inc("logs_downloader_files_total", (("result", "failed"),))
+        fail_dir = os.path.join(self.config.PROCESS_DIR, 'fail')
+        if not os.path.exists(fail_dir):
+            os.mkdir(fail_dir)
+        with open(os.path.join(fail_dir, logfile), "w") as file:
+            file.write(file_content)
+        self.logger.info("Saved file %s locally to the 'fail' folder", logfile)
+
     """
     Saves the decrypted file content to a log file in the filesystem
     """
     def handle_log_decrypted_content(self, filename, decrypted_file):
-        # Need to add up/down check of some sort, but random load balance for now if more than 1 server @ config file
-        SYSLOG_SERVERS = [e.strip() for e in self.config.SYSLOG_ADDRESS.split(',')]
-        if self.config.SYSLOG_ENABLE == 'YES':
-            choosen_server = random.choice(SYSLOG_SERVERS)
-            emit = loggerglue.emitter.TCPSyslogEmitter((choosen_server, int(self.config.SYSLOG_PORT)))
-            self.logger.info("Randomized server: %s" % choosen_server)
-            for msg in decrypted_file.splitlines():
-                if msg != '':
-                    emit.emit(msg)
-        if self.config.SAVE_LOCALLY == "YES":
-            local_file = open(self.config.PROCESS_DIR + filename, "a+")
-            local_file.writelines(str(line) for line in decrypted_file)
-        if self.config.SFTP_TRANSFER == "YES":
-            upfile = self.config.PROCESS_DIR + filename
-            sendsftp = self.sftp_upload_file(self.config.SFTP_HOSTNAME,int(self.config.SFTP_PORT),self.config.SFTP_USERNAME,self.config.SFTP_PASSWORD,self.config.SFTP_REMOTEDIR,filename)
-            # Compress the file after sent to SFTP server
-            self.gzip_file(self.upfile)
-        if self.config.SFTP_TRANSFER == "NO":
-            tmpfile = self.config.PROCESS_DIR + filename
-            self.gzip_file(tmpfile)
+        if self.line_filter is not None:
+            decrypted_file = self.line_filter.filter_content(decrypted_file)
+        content_sinks = LogContentSinks(self, filename)
+        try:
+            content_sinks.write_content(decrypted_file)
+            content_sinks.close()
+        except Exception:
+            content_sinks.abort()
+            raise
+
+    """
+    Downloads a log file in chunks, and decrypts, decompresses and handles its lines as they arrive.
+    The whole file is never held in memory
+    """
+    def stream_log_file(self, filename):
+        with self.download_slot():
+            return self.stream_log_file_content(filename)
+
+    """
+    Streams a log file, see stream_log_file
+    """
+    def stream_log_file_content(self, filename):
+        filename = str(filename.rstrip("\r\n"))
+        try:
+            response = self.file_downloader.request_file_content(self.config.BASE_URL + filename, stream=True)
+        except RateLimitError as e:
+            return "RATE_LIMITED", e.retry_after
+        except Exception:
+            self.logger.error("Error while trying to download file")
+            return "ERROR", ""
+        if response == "404_NOT_FOUND":
+            return "404_NOT_FOUND", response
+        if response == "":
+            return "NOT_FOUND", response
+        try:
+            decoder = LogFileStreamDecoder(self, filename)
+            content_sinks = LogContentSinks(self, filename)
+            try:
+                for chunk in response.iter_content(chunk_size=self.config.STREAM_CHUNK_SIZE):
+                    self.metrics.inc("logs_downloader_bytes_total", (("stage", "download"),), len(chunk))
+                    for lines in decoder.feed(chunk):
+                        content_sinks.write(lines)
+                content_sinks.write(decoder.finish())
+                content_sinks.close()
+            except Exception:
+                content_sinks.abort()
+                raise
+            finally:
+                response.close()
+            return "STREAMED", ""
+        except Exception as e:
+            self.logger.error("Error while streaming the file %s - %s %s", filename, e.message, traceback.format_exc())
+            return "STREAM_FAILED", ""
 
     """
     Decrypt a file content
@@ -325,45 +546,24 @@ class LogsDownloader:
         if file_encryption_key == -1:
             # uncompress the log content
             self.logger.debug("%s is not encrypted, Skipping decryption", filename)
-            uncompressed_and_decrypted_file_content = file_log_content
-            try:
-                uncompressed_and_decrypted_file_content = zlib.decompressobj().decompress(file_log_content)
-            except zlib.error:
-                # File is not compressed
-                self.logger.debug("%s is not compressed, skipping decompression", filename)
-                uncompressed_and_decrypted_file_content = file_log_content
+            return self.decode_engine.decode(file_log_content, None, None, filename)
         # if the file is encrypted
         else:
-            content_encrypted_sym_key = file_header_content.split("key:")[1].splitlines()[0]
-            # we expect to have a 'keys' folder that will have the stored private keys
-            if not os.path.exists(os.path.join(self.config_path, "keys")):
-                self.logger.error("No encryption keys directory was found and file %s is encrypted", filename)
-                raise Exception("No encryption keys directory was found")
-            # get the public key id from the log file header
-            public_key_id = file_header_content.split("publicKeyId:")[1].splitlines()[0]
-            # get the public key directory in the filesystem - each time we upload a new key this id is incremented
-            public_key_directory = os.path.join(os.path.join(self.config_path, "keys"), public_key_id)
-            # if the key directory does not exists
-            if not os.path.exists(public_key_directory):
-                self.logger.error("Failed to find a proper certificate for : %s who has the publicKeyId of %s", filename, public_key_id)
-                raise Exception("Failed to find a proper certificate")
             # get the checksum
             checksum = file_header_content.split("checksum:")[1].splitlines()[0]
-            # get the private key
-            private_key = open(os.path.join(public_key_directory, "Private.key"), "r").read()
-            try:
-                rsa_private_key = M2Crypto.RSA.load_key_string(private_key)
-                content_decrypted_sym_key = rsa_private_key.private_decrypt(base64.b64decode(bytearray(content_encrypted_sym_key)), M2Crypto.RSA.pkcs1_padding)
-                uncompressed_and_decrypted_file_content = zlib.decompressobj().decompress(AES.new(base64.b64decode(bytearray(content_decrypted_sym_key)), AES.MODE_CBC, 16 * "\x00").decrypt(file_log_content))
-                # we check the content validity by checking the checksum
-                content_is_valid = self.validate_checksum(checksum, uncompressed_and_decrypted_file_content)
-                if not content_is_valid:
-                    self.logger.error("Checksum verification failed for file %s", filename)
-                    raise Exception("Checksum verification failed")
-            except Exception as e:
-                self.logger.error("Error while trying to decrypt the file %s", filename, e.message, traceback.format_exc())
-                raise Exception("Error while trying to decrypt the file" + filename)
-        return uncompressed_and_decrypted_file_content
+            # get the symmetric key which the log content is encrypted with
+            sym_key = self.get_file_symmetric_key(file_header_content, filename)
+            # decrypt, uncompress and verify the log content, on a decode worker process when there are any
+            return self.decode_engine.decode(file_log_content, sym_key, checksum, filename)
+
+    """
+    Gets the symmetric key of an encrypted file, by decrypting the key from the file header with our private key
+    """
+    def get_file_symmetric_key(self, file_header_content, filename):
+        content_encrypted_sym_key = file_header_content.split("key:")[1].splitlines()[0]
+        # get the public key id from the log file header
+        public_key_id = file_header_content.split("publicKeyId:")[1].splitlines()[0]
+        return self.key_ring.decrypt_symmetric_key(public_key_id, content_encrypted_sym_key, filename)
 
     """
     Downloads a log file
@@ -373,18 +573,44 @@ class LogsDownloader:
         filename = str(filename.rstrip("\r\n"))
         try:
             # download the file
-            file_content = self.file_downloader.request_file_content(self.config.BASE_URL + filename)
+            with self.download_slot():
+                with self.metrics.time("download"):
+                    file_content = self.file_downloader.request_file_content(self.config.BASE_URL + filename)
             # if we received a valid file content
             if file_content != "" and file_content != "404_NOT_FOUND":
+                self.metrics.inc("logs_downloader_bytes_total", (("stage", "download"),), len(file_content))
                 return "OK", file_content
             # if the file was not found
             elif file_content == "404_NOT_FOUND":
                 return "404_NOT_FOUND", file_content
             else:
                 return "NOT_FOUND", file_content
+        except RateLimitError as e:
+            return "RATE_LIMITED", e.retry_after
         except Exception:
             self.logger.error("Error while trying to download file")
-            return "ERROR"
+            return "ERROR", ""
+
+    """
+    Gets the number of log files between the last downloaded file and the newest file in the logs index
+    """
+    def get_lag(self):
+        last_log_id = self.checkpoint.log_id
+        newest_log_id = self.logs_file_index.newest(self.checkpoint.prefix)
+        if last_log_id is None or newest_log_id is None:
+            return None
+        return max(0, newest_log_id - last_log_id)
+
+    """
+    Holds a download slot while downloading a file, when the number of concurrent downloads is limited
+    """
+    @contextlib.contextmanager
+    def download_slot(self):
+        if self.download_slots is None:
+            yield
+        else:
+            with self.download_slots.slot(self.config_path):
+                yield
 
     """
     Validates a checksum
@@ -409,321 +635,2937 @@ class LogsDownloader:
             self.running = False
             self.logger.info("Got a interrupt signal, will now shutdown and exit gracefully")
 
-    def sftp_upload_file(self, hostname, port, username, password, directory, upfile):
-        # paramiko.util.log_to_file('/opt/incapsula/logs/sftp.log')
-        try:
-            t = paramiko.Transport((hostname,port))
-            t.start_client()
-            t.auth_password(username,password)
-            sftp = paramiko.SFTPClient.from_transport(t)
-            sftp.put((self.config.PROCESS_DIR + upfile), (directory + "/" + upfile))
-        except Exception as e:
-            self.logger.error('*** Caught exception: %s: %s' % (e.__class__,e))
-            try:
-                t.close()
-            except:
-                pass
-            return "ERROR"
+    """
+    Compresses a file in the background, the file is replaced by a .gz file and the callback is called with the .gz file path
+    """
+    def gzip_file(self, infile, callback=None, failure_callback=None):
+        self.compression_engine.compress(infile, callback, failure_callback)
+
+    """
+    Sends a locally saved log file to the SFTP server and compresses it, according to the settings.
+    The uploaded callback is called once the file reached the SFTP server, see SftpUploader.upload in the SFTP sink for the failure callback
+    """
+    def transfer_local_file(self, filename, upfile, uploaded_callback=None, failure_callback=None):
+        written_compressed = self.config.LOCAL_WRITE_COMPRESSED == "YES" or self.config.LOCAL_ARCHIVE == "YES"
+        if self.config.SFTP_TRANSFER == "YES":
+            if written_compressed:
+                # the file was already written compressed
+                self.sftp_uploader.upload(upfile, os.path.basename(upfile), uploaded_callback, failure_callback)
+            elif self.config.SFTP_UPLOAD_COMPRESSED == "YES":
+                # Compress the file and send the compressed file to the SFTP server
+                remote_file_name = filename + ".gz"
+                sftp_uploader = self.sftp_uploader
+                self.gzip_file(upfile, lambda out_gz: sftp_uploader.upload(out_gz, remote_file_name, uploaded_callback, failure_callback), failure_callback)
+            else:
+                # Compress the file after sent to SFTP server
+                def uploaded(local_path):
+                    if uploaded_callback is not None:
+                        uploaded_callback(local_path)
+                    self.gzip_file(local_path)
+                self.sftp_uploader.upload(upfile, filename, uploaded, failure_callback)
+        if self.config.SFTP_TRANSFER == "NO" and not written_compressed:
+            self.gzip_file(upfile)
+
+
+"""
+Class for re-downloading an explicit range of log files, in parallel to the live downloader
+"""
 
-    def gzip_file(self,infile):
+
+class Backfill:
+
+    # the backfill runs until all the files were handled or until external termination
+    running = True
+
+    def __init__(self, config_path, system_log_path, log_level, first_file, last_file, workers=None):
+        self.logger = LogsDownloader.create_logger(system_log_path, log_level)
+        self.config_path = config_path
+        self.system_log_path = system_log_path
+        self.log_level = log_level
+        # the range is given as log file ids, for example 123_1000, the .log extension is optional
+        self.prefix, self.first_id = LogsFileIndex.parse_file_name(first_file if first_file.endswith(".log") else first_file + ".log")
+        last_prefix, self.last_id = LogsFileIndex.parse_file_name(last_file if last_file.endswith(".log") else last_file + ".log")
+        if last_prefix != self.prefix or self.last_id < self.first_id:
+            raise Exception("The backfill range %s to %s is not valid" % (first_file, last_file))
+        self.config = Config(config_path, self.logger).read()
+        self.workers = workers if workers is not None else self.config.BACKFILL_WORKERS
+        self.shard_size = self.config.BACKFILL_SHARD_SIZE
+        # the handled files of the range, kept apart from the last known downloaded file id of the live downloader
+        self.progress_file_path = os.path.join(config_path, "Backfill_%s_%s_%s.progress" % (self.prefix, self.first_id, self.last_id))
+
+    """
+    Downloads and handles all the files of the range which were not handled yet, returns the names of the files which failed
+    """
+    def run(self):
+        handled_files = self.load_progress()
+        pending_files = [LogsFileIndex.file_name(self.prefix, log_id) for log_id in range(self.first_id, self.last_id + 1)]
+        pending_files = [log_file_name for log_file_name in pending_files if log_file_name not in handled_files]
+        # each shard is a run of consecutive files which are handled one after the other by a single worker process
+        shards = collections.deque(pending_files[i:i + self.shard_size] for i in range(0, len(pending_files), self.shard_size))
+        self.logger.info("Backfilling %s files of %s_%s to %s_%s, %s files were already handled, on %s worker processes",
+                         len(pending_files), self.prefix, self.first_id, self.prefix, self.last_id, len(handled_files), self.workers)
+        failed_files = []
+        completed_shards = Queue.Queue()
+        pool = multiprocessing.Pool(self.workers, initializer=init_backfill_worker, initargs=(self.config_path, self.system_log_path, self.log_level))
         try:
-            in_data = open(infile, "rb").read()
-            out_gz = infile + ".gz"
-            gzf = gzip.open(out_gz, "wb")
-            gzf.write(in_data)
-            gzf.close()
-            os.unlink(infile)
-        except Exception as e:
-            self.logger.error('*** Caught Exception: %s: %s' % (e.__class__,e))
-            return "ERROR"
+            in_flight = 0
+            while in_flight > 0 or (self.running and shards):
+                # a few shards wait for each worker, the rest are queued only once the first ones are done, so a stop does not wait for all of them
+                while self.running and shards and in_flight < 2 * self.workers:
+                    pool.apply_async(backfill_shard, (shards.popleft(),), callback=completed_shards.put)
+                    in_flight += 1
+                try:
+                    shard_results = completed_shards.get(timeout=1)
+                except Queue.Empty:
+                    continue
+                in_flight -= 1
+                shard_results, shard_error = shard_results
+                if shard_error is not None:
+                    self.logger.error("A backfill shard of %s files failed - %s", len(shard_results), shard_error)
+                self.save_progress([log_file_name for log_file_name, success in shard_results if success])
+                failed_files.extend(log_file_name for log_file_name, success in shard_results if not success)
+        finally:
+            pool.close()
+            pool.join()
+        self.logger.info("Backfill of %s_%s to %s_%s is %s, %s files failed",
+                         self.prefix, self.first_id, self.prefix, self.last_id, "stopped" if shards else "done", len(failed_files))
+        return sorted(failed_files, key=LogsFileIndex.parse_file_name)
+
+    """
+    Gets the names of the files which were already handled by previous runs of the same range
+    """
+    def load_progress(self):
+        handled_files = set()
+        if os.path.exists(self.progress_file_path):
+            with open(self.progress_file_path, "r") as progress_file:
+                for line in progress_file:
+                    # a partially written last line is ignored
+                    if line.endswith("\n") and LogsFileIndex.LOG_FILE_NAME_REGEX.match(line.rstrip()):
+                        handled_files.add(line.rstrip())
+        return handled_files
 
+    """
+    Appends the handled files of a shard to the progress file, and syncs it to the disk
+    """
+    def save_progress(self, log_file_names):
+        if not log_file_names:
+            return
+        with open(self.progress_file_path, "a") as progress_file:
+            progress_file.write("".join(log_file_name + "\n" for log_file_name in log_file_names))
+            progress_file.flush()
+            os.fsync(progress_file.fileno())
+
+    """
+    Handle a case of process termination
+    """
+    def set_signal_handling(self, sig, frame):
+        self.running = False
+        self.logger.info("Got a termination signal, will stop once the files which are already being backfilled are handled")
 
 
 """
-****************************************************************
-                        Helper Classes
-****************************************************************
+The downloader of a backfill worker process, and the error if it could not be created
 """
+backfill_downloader = None
+backfill_init_error = None
 
+
+"""
+Initializes a backfill worker process, each worker has its own downloader and connections.
+A failure is kept for the shards, since a pool worker whose initializer fails is started again and again
 """
+def init_backfill_worker(config_path, system_log_path, log_level):
+    global backfill_downloader, backfill_init_error
+    ignore_interrupt_signal()
+    try:
+        backfill_downloader = LogsDownloader(config_path, system_log_path, log_level, SharedResources(False, pool_worker=True))
+    except (Exception, SystemExit) as e:
+        backfill_init_error = "Failed to initialize the backfill worker - %s: %s" % (e.__class__.__name__, e)
 
-LastFileId - A class for managing the last known successfully downloaded log file
 
 """
+Downloads and handles a shard of a backfill, runs on a backfill worker process.
+Returns whether each file was handled, and the error which failed the whole shard or None. The shard never raises an exception,
+so the backfill always gets its results
+"""
+def backfill_shard(log_file_names):
+    if backfill_downloader is None:
+        return [(log_file_name, False) for log_file_name in log_file_names], backfill_init_error
+    results = []
+    for log_file_name in log_file_names:
+        try:
+            success = backfill_file(backfill_downloader, log_file_name)
+        except Exception as e:
+            backfill_downloader.logger.error("Failed to backfill file %s - %s, %s", log_file_name, e, traceback.format_exc())
+            success = False
+        results.append((log_file_name, success))
+    # the shard is done only once its files reached the SFTP server
+    if backfill_downloader.sftp_uploader is not None:
+        try:
+            backfill_downloader.sftp_uploader.wait_until_uploaded()
+        except Exception as e:
+            backfill_downloader.logger.error("Failed to wait for the SFTP uploads of the backfill - %s, %s", e, traceback.format_exc())
+            return [(log_file_name, False) for log_file_name in log_file_names], "The SFTP uploads failed - %s" % e
+    return results, None
 
 
-class LastFileId:
+"""
+Downloads, decrypts and handles a single file of a backfill. Unlike handle_file, the last known downloaded file id is never touched.
+The retries wait according to the given scheduler, the scheduler of the downloader by default
+"""
+def backfill_file(downloader, log_file_name, scheduler=None):
+    if scheduler is None:
+        scheduler = downloader.scheduler
+    for attempt in range(4):
+        if downloader.config.STREAMING_MODE == "YES":
+            result = downloader.stream_log_file(log_file_name)
+        else:
+            result = downloader.download_log_file(log_file_name)
+        if result[0] == "STREAMED":
+            downloader.logger.info("Backfilled file %s", log_file_name)
+            return True
+        elif result[0] == "STREAM_FAILED":
+            raw_result = downloader.download_log_file(log_file_name)
+            if raw_result[0] == "OK":
+                downloader.save_failed_file(log_file_name, raw_result[1])
+            return False
+        elif result[0] == "OK":
+            try:
+                downloader.handle_log_decrypted_content(log_file_name, downloader.decrypt_file(result[1], log_file_name))
+            except Exception as e:
+                downloader.logger.error("Saving file %s locally to the 'fail' folder %s %s", log_file_name, e, traceback.format_exc())
+                downloader.save_failed_file(log_file_name, result[1])
+                return False
+            downloader.logger.info("Backfilled file %s", log_file_name)
+            return True
+        # a file of the past which is not found is not going to be generated later on
+        elif result[0] == "404_NOT_FOUND":
+            downloader.logger.info("Got 404 on file: %s, it is no longer in the bucket", log_file_name)
+            return False
+        elif result[0] == "RATE_LIMITED":
+            scheduler.on_rate_limited(result[1])
+        else:
+            scheduler.on_not_ready()
+        if attempt < 3:
+            scheduler.wait("until next backfill retry of file %s" % log_file_name)
+    return False
 
-    def __init__(self, config_path):
-        self.config_path = config_path
+
+"""
+Class for finding the log lines of a time window in the locally saved archive files, see ArchiveBlockWriter in the local sink
+"""
+
+
+class ArchiveQuery:
+
+    TIME_FORMATS = ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d")
+
+    def __init__(self, process_dir, start_time, end_time, site_id=None):
+        self.process_dir = process_dir
+        # the window is inclusive, in milliseconds since the epoch like the start field of the log lines
+        self.start_time = start_time
+        self.end_time = end_time
+        self.site_id = site_id
+        # the archive files are written by the local sink, which also defines their format
+        from sinks.local_sink import ArchiveBlockWriter
+        self.catalog_file_name = ArchiveBlockWriter.CATALOG_FILE_NAME
+        self.start_time_regex = ArchiveBlockWriter.START_TIME_REGEX
+        self.site_id_regex = ArchiveBlockWriter.SITE_ID_REGEX
 
     """
-    Gets the last known successfully downloaded log file id
+    Writes the log lines of the window to the output file, returns the number of files and blocks which were read and of the lines which were written
     """
-    def get_last_log_id(self):
-        # gets the LastKnownDownloadedFileId file
-        index_file_path = os.path.join(self.config_path, "LastKnownDownloadedFileId.txt")
-        # if the file exists - get the log file id from it
-        if os.path.exists(index_file_path):
-            with open(index_file_path, "r+") as index_file:
-                tmpfil = index_file.read()
-                return tmpfil.rstrip()
-        # return an empty string if no file exists
-        return ''
+    def run(self, out_file):
+        read_files = read_blocks = written_lines = 0
+        for filename in self.find_files():
+            archive_path = os.path.join(self.process_dir, filename + ".gz")
+            try:
+                blocks = self.load_index(archive_path + ".idx")
+                archive_file = open(archive_path, "rb")
+            except (IOError, OSError):
+                # the file was removed from the process directory after it was cataloged
+                continue
+            read_files += 1
+            with archive_file:
+                for offset, size, min_time, max_time in blocks:
+                    archive_file.seek(offset)
+                    block = zlib.decompress(archive_file.read(size), 16 + zlib.MAX_WBITS)
+                    read_blocks += 1
+                    if self.site_id is None and self.start_time <= min_time and max_time <= self.end_time:
+                        # all the lines of the block are in the window
+                        lines = block.splitlines()
+                    else:
+                        lines = [line for line in block.splitlines() if self.matches(line)]
+                    if lines:
+                        out_file.write(b"\n".join(lines) + b"\n")
+                        written_lines += len(lines)
+        return read_files, read_blocks, written_lines
 
     """
-    Update the last known successfully downloaded log file id
+    Gets the names of the cataloged files which have lines in the window, by log file id order
     """
-    def update_last_log_id(self, last_id):
-        # gets the LastKnownDownloadedFileId file
-        index_file_path = os.path.join(self.config_path, "LastKnownDownloadedFileId.txt")
-        with open(index_file_path, "w") as index_file:
-            # update the id
-            index_file.write(last_id)
-            index_file.close()
+    def find_files(self):
+        catalog_path = os.path.join(self.process_dir, self.catalog_file_name)
+        if not os.path.exists(catalog_path):
+            return []
+        files = {}
+        with open(catalog_path, "r") as catalog_file:
+            for line in catalog_file:
+                fields = line.split()
+                # a partially written last line is ignored
+                if not line.endswith("\n") or len(fields) != 5 or not LogsFileIndex.LOG_FILE_NAME_REGEX.match(fields[0]):
+                    continue
+                # a file which was written again, for example by a backfill, is listed again
+                files[fields[0]] = (int(fields[3]), int(fields[4]))
+        return sorted((filename for filename, (min_time, max_time) in files.items()
+                       if min_time >= 0 and min_time <= self.end_time and max_time >= self.start_time), key=LogsFileIndex.parse_file_name)
 
     """
-    Gets the next log file name that we should download
+    Gets the (offset, compressed size, min time, max time) of the blocks of an archive file which may have lines in the window
     """
-    def get_next_file_name(self):
-        # get the current stored last known successfully downloaded log file
-        curr_log_file_name_arr = self.get_last_log_id().split("_")
-        # get the current id
-        curr_log_file_id = int(curr_log_file_name_arr[1].rstrip(".log")) + 1
-        # build the next log file name
-        new_log_file_id = curr_log_file_name_arr[0] + "_" + str(curr_log_file_id) + ".log"
-        return new_log_file_id
+    def load_index(self, index_path):
+        blocks = []
+        with open(index_path, "r") as index_file:
+            for line in index_file:
+                offset, size, lines, min_time, max_time, site_ids = line.split()
+                min_time, max_time = int(min_time), int(max_time)
+                if min_time < 0 or min_time > self.end_time or max_time < self.start_time:
+                    continue
+                if self.site_id is not None and site_ids != "*" and str(self.site_id) not in site_ids.split(","):
+                    continue
+                blocks.append((int(offset), int(size), min_time, max_time))
+        return blocks
 
     """
-    Increment the last known successfully downloaded log file id
+    Checks whether a log line is in the window and of the site
     """
-    def move_to_next_file(self):
-        self.update_last_log_id(self.get_next_file_name())
+    def matches(self, line):
+        start_time = self.start_time_regex.search(line)
+        if start_time is None or not self.start_time <= int(start_time.group(1)) <= self.end_time:
+            return False
+        if self.site_id is not None:
+            site_id = self.site_id_regex.search(line)
+            return site_id is not None and int(site_id.group(1)) == self.site_id
+        return True
+
+    """
+    Parses a time given as seconds or milliseconds since the epoch, or as a UTC date and time such as 2020-01-31T13:45:00.
+    Returns milliseconds since the epoch
+    """
+    @staticmethod
+    def parse_time(value):
+        if value.isdigit():
+            # anything beyond the year 5000 in seconds is taken as milliseconds
+            return int(value) if int(value) > 10 ** 11 else int(value) * 1000
+        for time_format in ArchiveQuery.TIME_FORMATS:
+            try:
+                return calendar.timegm(time.strptime(value, time_format)) * 1000
+            except ValueError:
+                pass
+        raise Exception("The time %s is not valid, use seconds since the epoch or a UTC time such as 2020-01-31T13:45:00" % value)
 
 
+"""
+****************************************************************
+                        Helper Classes
+****************************************************************
 """
 
-LogsFileIndex - A class for managing the logs files index file
+"""
+
+SharedResources - A class for holding the connections and worker pools which are shared by all the downloaders of the process.
+When running a few accounts, the settings of each shared resource are taken from the first account which uses it
 
 """
 
 
-class LogsFileIndex:
+class SharedResources:
 
-    def __init__(self, config, logger, downloader):
-        self.config = config
-        self.content = None
-        self.hash_content = None
-        self.logger = logger
-        self.file_downloader = downloader
+    def __init__(self, multi_account, pool_worker=False):
+        self.multi_account = multi_account
+        # a backfill worker process cannot start processes of its own, and the metrics port belongs to the main process
+        self.pool_worker = pool_worker
+        self.metrics = Metrics()
+        self.metrics_server = None
+        self.compression_engine = None
+        self.decode_engine = None
+        self.http_adapter = None
+        self.download_slots = None
+        # the syslog connection pools by (address, port), the SFTP uploaders by (host, port, user, remote folder) and the HTTP bulk clients by (URL, authorization, index, format)
+        self.syslog_pools = {}
+        self.sftp_uploaders = {}
+        self.http_bulk_clients = {}
 
     """
-    Gets the indexed log files
+    Gets the compression worker pool, it is created by the first downloader which saves the log files locally
     """
-    def indexed_logs(self):
-        return self.content
+    def get_compression_engine(self, config, logger):
+        if self.compression_engine is None:
+            compression_workers = 0 if self.pool_worker else config.COMPRESSION_WORKERS
+            self.compression_engine = CompressionEngine(config, logger, self.metrics, compression_workers)
+        return self.compression_engine
 
     """
-    Downloads a logs file index file
+    Gets the decode worker pool
     """
-    def download(self):
-        self.logger.info("Downloading logs index file...")
-        # try to get the logs.index file
-        file_content = self.file_downloader.request_file_content(self.config.BASE_URL + "logs.index")
-        # if we got the file content
-        if file_content != "":
-            content = file_content.decode("utf-8")
-            # validate the file format
-            if LogsFileIndex.validate_logs_index_file_format(content):
-                self.content = content.splitlines()
-                self.hash_content = set(self.content)
-            else:
-                self.logger.error("log.index, Pattern Validation Failed")
-                raise Exception
-        else:
-            raise Exception
+    def get_decode_engine(self, config, logger):
+        if self.decode_engine is None:
+            decode_workers = 0 if self.pool_worker else config.DECODE_WORKERS
+            self.decode_engine = DecodeEngine(config, logger, self.metrics, decode_workers)
+        return self.decode_engine
 
     """
-    Validates that format name of the logs files inside the logs index file
+    Gets the HTTP connection pool, only when running a few accounts - otherwise the session creates its own
     """
-    @staticmethod
-    def validate_logs_index_file_format(content):
-        file_rex = re.compile("(\d+_\d+\.log\n)+")
-        if file_rex.match(content):
-            return True
-        return False
+    def get_http_adapter(self, config):
+        if self.multi_account and self.http_adapter is None:
+            self.http_adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=config.HTTP_POOL_SIZE)
+        return self.http_adapter
 
     """
-    Validates a log file name format
+    Gets the download slots, or None if the number of concurrent downloads is not limited
     """
-    @staticmethod
-    def validate_log_file_format(content):
-        file_rex = re.compile("(\d+_\d+\.log)")
-        if file_rex.match(content):
-            return True
-        return False
+    def get_download_slots(self, config):
+        if self.download_slots is None and config.DOWNLOAD_CONCURRENCY > 0:
+            self.download_slots = FairSlots(config.DOWNLOAD_CONCURRENCY)
+        return self.download_slots
+
+    """
+    Gets the connection pool to the syslog servers of an account
+    """
+    def get_syslog_pool(self, config, logger):
+        key = (config.SYSLOG_ADDRESS, config.SYSLOG_PORT)
+        if key not in self.syslog_pools:
+            from sinks.syslog_sink import SyslogConnectionPool
+            # the spill folder belongs to the main process
+            self.syslog_pools[key] = SyslogConnectionPool(config, logger, self.metrics, not self.pool_worker)
+        return self.syslog_pools[key]
+
+    """
+    Gets the SFTP uploader of an account
+    """
+    def get_sftp_uploader(self, config, logger):
+        key = (config.SFTP_HOSTNAME, config.SFTP_PORT, config.SFTP_USERNAME, config.SFTP_REMOTEDIR)
+        if key not in self.sftp_uploaders:
+            from sinks.sftp_sink import SftpUploader
+            self.sftp_uploaders[key] = SftpUploader(config, logger, self.metrics)
+        return self.sftp_uploaders[key]
+
+    """
+    Gets the bulk client of the HTTP collector of an account
+    """
+    def get_http_bulk_client(self, config, logger):
+        # accounts which send to the same collector with another token or index get their own client
+        key = (config.HTTP_SINK_URL, config.HTTP_SINK_AUTHORIZATION, config.HTTP_SINK_INDEX, config.HTTP_SINK_FORMAT.upper())
+        if key not in self.http_bulk_clients:
+            from sinks.http_sink import HttpBulkClient
+            self.http_bulk_clients[key] = HttpBulkClient(config, logger, self.metrics)
+        return self.http_bulk_clients[key]
+
+    """
+    Starts the metrics HTTP server, if it is enabled and was not started yet
+    """
+    def start_metrics_server(self, config, logger):
+        if self.metrics_server is None and config.METRICS_PORT > 0 and not self.pool_worker:
+            self.metrics_server = MetricsServer(self.metrics, config.METRICS_ADDRESS, config.METRICS_PORT, logger)
 
 
 """
 
-Config - A class for reading the configuration file
+FairSlots - A class for fairly sharing a limited number of concurrent downloads between accounts.
+A free slot goes to the waiting account which currently holds the least slots, so a backlogged account cannot starve the others
 
 """
 
 
-class Config:
+class FairSlots:
 
-    def __init__(self, config_path, logger):
-        self.config_path = config_path
-        self.logger = logger
+    def __init__(self, size):
+        self.free_slots = size
+        # the number of slots held by each account
+        self.held_slots = collections.defaultdict(int)
+        # the waiting requests - ticket number by account, in the order of arrival
+        self.waiting = []
+        self.next_ticket = 0
+        self.condition = threading.Condition()
 
     """
-    Reads the configuration file
+    Holds a slot for an account, waits until the slot is granted
     """
-    def read(self):
-        config_file = os.path.join(self.config_path, "Settings.Config")
-        if os.path.exists(config_file):
-            config_parser = ConfigParser.ConfigParser()
-            config_parser.read(config_file)
-            config = Config(self.config_path, self.logger)
-            config.API_ID = config_parser.get("SETTINGS", "APIID")
-            config.API_KEY = config_parser.get("SETTINGS", "APIKEY")
-            config.PROCESS_DIR = os.path.join(config_parser.get("SETTINGS", "PROCESS_DIR"), "")
-            config.BASE_URL = os.path.join(config_parser.get("SETTINGS", "BASEURL"), "")
-            config.SAVE_LOCALLY = config_parser.get("SETTINGS", "SAVE_LOCALLY")
-            config.USE_PROXY = config_parser.get("SETTINGS", "USEPROXY")
-            config.PROXY_SERVER = config_parser.get("SETTINGS", "PROXYSERVER")
-            config.SYSLOG_ENABLE = config_parser.get('SETTINGS', 'SYSLOG_ENABLE')
-            config.SYSLOG_ADDRESS = config_parser.get('SETTINGS', 'SYSLOG_ADDRESS')
-            config.SYSLOG_PORT = config_parser.get('SETTINGS', 'SYSLOG_PORT')
-            config.USE_CUSTOM_CA_FILE = config_parser.get('SETTINGS', 'USE_CUSTOM_CA_FILE')
-            config.CUSTOM_CA_FILE = config_parser.get('SETTINGS', 'CUSTOM_CA_FILE')
-            config.SFTP_TRANSFER = config_parser.get('SETTINGS','SFTP_TRANSFER')
-            config.SFTP_HOSTNAME = config_parser.get('SETTINGS','SFTP_HOSTNAME')
-            config.SFTP_PORT = config_parser.get('SETTINGS','SFTP_PORT')
-            config.SFTP_USERNAME = config_parser.get('SETTINGS','SFTP_USERNAME')
-            config.SFTP_PASSWORD = config_parser.get('SETTINGS','SFTP_PASSWORD')
-            config.SFTP_REMOTEDIR = config_parser.get('SETTINGS','SFTP_REMOTEDIR')
+    @contextlib.contextmanager
+    def slot(self, account):
+        with self.condition:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            self.waiting.append((ticket, account))
+            while not (self.free_slots > 0 and self.next_granted() == ticket):
+                self.condition.wait()
+            self.waiting.remove((ticket, account))
+            self.free_slots -= 1
+            self.held_slots[account] += 1
+            self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.free_slots += 1
+                self.held_slots[account] -= 1
+                self.condition.notify_all()
 
-            return config
-        else:
-            self.logger.error("Could Not find configuration file %s", config_file)
-            raise Exception("Could Not find configuration file")
+    """
+    Gets the ticket of the waiting request which should get the next free slot
+    """
+    def next_granted(self):
+        return min(self.waiting, key=lambda waiting: (self.held_slots[waiting[1]], waiting[0]))[0]
 
 
 """
 
-FileDownloader - A class for downloading files
+AccountLoggerAdapter - A logger which prefixes the log lines with the account config folder
 
 """
 
 
-class FileDownloader:
+class AccountLoggerAdapter(logging.LoggerAdapter):
 
-    def __init__(self, config, logger):
-        self.config = config
-        self.logger = logger
+    def process(self, msg, kwargs):
+        return "[%s] %s" % (self.extra["account"], msg), kwargs
+
+
+"""
+
+Metrics - A class for collecting the downloader metrics, which are exposed in the Prometheus text format
+
+"""
+
+
+class Metrics:
+
+    # the upper bounds in seconds of the stage duration histogram buckets
+    DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    HELP = {
+        "logs_downloader_stage_duration_seconds": "Duration of each processing stage",
+        "logs_downloader_bytes_total": "Bytes processed by each stage",
+        "logs_downloader_lines_total": "Log lines handed to the outputs",
+        "logs_downloader_filtered_lines_total": "Log lines dropped by the CEF filter",
+        "logs_downloader_files_total": "Log files by handling result",
+        "logs_downloader_http_responses_total": "Responses from the logs server by status code",
+        "logs_downloader_retries_total": "Retried downloads and uploads",
+        "logs_downloader_queue_depth": "Items waiting in each background queue",
+        "logs_downloader_syslog_outstanding_bytes": "Bytes queued for the syslog servers and not sent yet",
+        "logs_downloader_syslog_spilled_bytes": "Bytes spilled to the disk and not replayed to the syslog servers yet",
+        "logs_downloader_http_sink_batch_bytes": "The current uncompressed size of the batches sent to the HTTP collector",
+        "logs_downloader_http_sink_responses_total": "Responses from the HTTP collector by status code",
+        "logs_downloader_lag_files": "Log files between the last downloaded file and the newest file in the logs index",
+        "logs_downloader_gaps": "Indexed log files before the last downloaded file which were not handled yet",
+        "logs_downloader_oldest_gap_age_seconds": "Seconds since the oldest missing log file was found",
+        "logs_downloader_gap_repairs_total": "Attempts to download the missing log files by result",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # the counter values by metric name and labels
+        self.counters = collections.defaultdict(dict)
+        # the stage duration histograms by stage - bucket counts, sum and count
+        self.durations = {}
+        # the gauges by metric name - (labels, function which returns the current value) pairs
+        self.gauges = collections.defaultdict(list)
 
     """
-    A method for getting a destination URL file content
+    Increments a counter, labels are a tuple of (name, value) pairs
     """
-    def request_file_content(self, url, timeout=20):
-        # default value
-        response_content = ""
-        if self.config.USE_PROXY == "YES":
-            proxies = {'http': self.config.PROXY_SERVER, 'https': self.config.PROXY_SERVER,}
-        base64creds = base64.encodestring('%s:%s' % (self.config.API_ID, self.config.API_KEY)).replace('\n', '')
-        headers = {"Authorization": "Basic %s" % base64creds}
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self.counters[name][labels] = self.counters[name].get(labels, 0) + value
 
+    """
+    Measures the duration of a stage
+    """
+    @contextlib.contextmanager
+    def time(self, stage):
+        start_time = time.time()
         try:
-            # open the connection to the URL
-            if self.config.USE_CUSTOM_CA_FILE == "YES":
-                if self.config.USE_PROXY == "YES":
-                    response = requests.get(url, headers=headers, proxies=proxies, verify=self.config.CUSTOM_CA_FILE, timeout=timeout)
-                else:
-                    response = requests.get(url, headers=headers, verify=self.config.CUSTOM_CA_FILE, timeout=timeout)
-            else:
-                if self.config.USE_PROXY == "YES":
-                    response = requests.get(url, headers=headers, proxies=proxies, verify=False, timeout=timeout)
-                else:
-                    response = requests.get(url, headers=headers, verify=False, timeout=timeout)
+            yield
+        finally:
+            self.observe_stage(stage, time.time() - start_time)
 
-            # raise status for any exceptions
-            response.raise_for_status()
-            # if we got a 200 OK response
-            if response.status_code == 200:
+    """
+    Adds a duration to the histogram of a stage
+    """
+    def observe_stage(self, stage, duration):
+        with self.lock:
+            histogram = self.durations.get(stage)
+            if histogram is None:
+                histogram = self.durations[stage] = [[0] * len(Metrics.DURATION_BUCKETS), 0.0, 0]
+            position = bisect.bisect_left(Metrics.DURATION_BUCKETS, duration)
+            if position < len(Metrics.DURATION_BUCKETS):
+                histogram[0][position] += 1
+            histogram[1] += duration
+            histogram[2] += 1
+
+    """
+    Adds a gauge which is read when the metrics are exposed
+    """
+    def add_gauge(self, name, labels, value_function):
+        with self.lock:
+            self.gauges[name].append((labels, value_function))
+
+    """
+    Renders all the metrics in the Prometheus text format
+    """
+    def render(self):
+        output = []
+        with self.lock:
+            counters = dict((name, dict(values)) for name, values in self.counters.items())
+            durations = dict((stage, (list(histogram[0]), histogram[1], histogram[2])) for stage, histogram in self.durations.items())
+            gauges = dict((name, list(values)) for name, values in self.gauges.items())
+        name = "logs_downloader_stage_duration_seconds"
+        output.append("# HELP %s %s" % (name, Metrics.HELP[name]))
+        output.append("# TYPE %s histogram" % name)
+        for stage in sorted(durations):
+            bucket_counts, duration_sum, count = durations[stage]
+            cumulative_count = 0
+            for bound, bucket_count in zip(Metrics.DURATION_BUCKETS, bucket_counts):
+                cumulative_count += bucket_count
+                output.append("%s_bucket%s %d" % (name, Metrics.format_labels((("stage", stage), ("le", repr(float(bound))))), cumulative_count))
+            output.append("%s_bucket%s %d" % (name, Metrics.format_labels((("stage", stage), ("le", "+Inf"))), count))
+            output.append("%s_sum%s %r" % (name, Metrics.format_labels((("stage", stage),)), duration_sum))
+            output.append("%s_count%s %d" % (name, Metrics.format_labels((("stage", stage),)), count))
+        for name in sorted(counters):
+            output.append("# HELP %s %s" % (name, Metrics.HELP.get(name, name)))
+            output.append("# TYPE %s counter" % name)
+            for labels in sorted(counters[name]):
+                output.append("%s%s %s" % (name, Metrics.format_labels(labels), counters[name][labels]))
+        for name in sorted(gauges):
+            output.append("# HELP %s %s" % (name, Metrics.HELP.get(name, name)))
+            output.append("# TYPE %s gauge" % name)
+            for labels, value_function in gauges[name]:
+                try:
+                    value = value_function()
+                except Exception:
+                    value = None
+                if value is not None:
+                    output.append("%s%s %s" % (name, Metrics.format_labels(labels), value))
+        return "\n".join(output) + "\n"
+
+    """
+    Formats metric labels, labels are a tuple of (name, value) pairs
+    """
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join('%s="%s"' % (label, str(value).replace("\\", "\\\\").replace('"', '\\"')) for label, value in labels) + "}"
+
+
+"""
+
+MetricsServer - A class for serving the metrics over HTTP, on a dedicated thread
+
+"""
+
+
+class MetricsServer:
+
+    def __init__(self, metrics, address, port, logger):
+        class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render()
+                # the body is rendered to a str, which is not bytes on python 3, where the asyncio engine runs
+                if not isinstance(body, bytes):
+                    body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # the requests are not written to the downloader log
+            def log_message(self, format, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer((address, port), MetricsRequestHandler)
+        server_thread = threading.Thread(target=self.server.serve_forever, name="metrics_thread")
+        server_thread.daemon = True
+        server_thread.start()
+        logger.info("Serving metrics on http://%s:%s/metrics", address, port)
+
+
+"""
+
+LastFileId - A class for managing the last known successfully downloaded log file
+
+"""
+
+
+class LastFileId:
+
+    def __init__(self, config_path, checkpoint_every_files=1, checkpoint_interval=0):
+        self.config_path = config_path
+        self.index_file_path = os.path.join(config_path, "LastKnownDownloadedFileId.txt")
+        # every update is appended to the journal, the journal is replayed on top of the index file when starting
+        self.journal_file_path = os.path.join(config_path, "LastKnownDownloadedFileId.journal")
+        # the index file is rewritten once every checkpoint_every_files updates, or once checkpoint_interval seconds passed
+        self.checkpoint_every_files = checkpoint_every_files
+        self.checkpoint_interval = checkpoint_interval
+        self.pending_updates = 0
+        self.checkpoint_time = time.time()
+        self.journal_file = None
+        # the last known successfully downloaded log file - its prefix and id, or None if there is none
+        self.prefix = None
+        self.log_id = None
+        self.load()
+
+    """
+    Loads the last known successfully downloaded log file id from the index file and the journal
+    """
+    def load(self):
+        last_id = ''
+        # if the file exists - get the log file id from it
+        if os.path.exists(self.index_file_path):
+            with open(self.index_file_path, "r") as index_file:
+                last_id = index_file.read().rstrip()
+        # the updates which were made after the index file was written
+        if os.path.exists(self.journal_file_path):
+            with open(self.journal_file_path, "r") as journal_file:
+                for line in journal_file:
+                    # a partially written last line is ignored
+                    if line.endswith("\n") and LogsFileIndex.LOG_FILE_NAME_REGEX.match(line.rstrip()):
+                        last_id = line.rstrip()
+        if last_id != '':
+            self.prefix, self.log_id = LogsFileIndex.parse_file_name(last_id)
+
+    """
+    Gets the last known successfully downloaded log file id
+    """
+    def get_last_log_id(self):
+        # return an empty string if there is no last known file
+        if self.log_id is None:
+            return ''
+        return LogsFileIndex.file_name(self.prefix, self.log_id)
+
+    """
+    Update the last known successfully downloaded log file id
+    """
+    def update_last_log_id(self, last_id):
+        self.prefix, self.log_id = LogsFileIndex.parse_file_name(last_id)
+        self.pending_updates += 1
+        if self.pending_updates >= self.checkpoint_every_files or (self.checkpoint_interval > 0 and time.time() - self.checkpoint_time >= self.checkpoint_interval):
+            self.flush()
+        else:
+            self.append_to_journal()
+
+    """
+    Writes the last known successfully downloaded log file id to the index file and clears the journal
+    """
+    def flush(self):
+        if self.pending_updates == 0:
+            return
+        # write a temporary file and replace the index file with it, so the index file is never partially written
+        tmp_file_path = self.index_file_path + ".tmp"
+        with open(tmp_file_path, "w") as index_file:
+            # update the id
+            index_file.write(self.get_last_log_id())
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        if platform.system() == "Windows" and os.path.exists(self.index_file_path):
+            os.remove(self.index_file_path)
+        os.rename(tmp_file_path, self.index_file_path)
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+        if os.path.exists(self.journal_file_path):
+            os.remove(self.journal_file_path)
+        self.pending_updates = 0
+        self.checkpoint_time = time.time()
+
+    """
+    Appends the last known successfully downloaded log file id to the journal
+    """
+    def append_to_journal(self):
+        if self.journal_file is None:
+            self.journal_file = open(self.journal_file_path, "a")
+        self.journal_file.write(self.get_last_log_id() + "\n")
+        # the journal is not synced, but is written out of the process so it survives the process crashing
+        self.journal_file.flush()
+
+    """
+    Gets the next log file name that we should download
+    """
+    def get_next_file_name(self):
+        return LogsFileIndex.file_name(self.prefix, self.log_id + 1)
+
+    """
+    Gets the names of the next log files that we should download, in order
+    """
+    def get_next_file_names(self, count):
+        return [LogsFileIndex.file_name(self.prefix, self.log_id + i) for i in range(1, count + 1)]
+
+    """
+    Increment the last known successfully downloaded log file id
+    """
+    def move_to_next_file(self):
+        self.update_last_log_id(self.get_next_file_name())
+
+
+"""
+
+DownloadCursor - A class for the position of the next log file to download when the files are handled on a pipeline.
+The position is kept in memory only, the checkpoint advances separately once the files were acknowledged by all the sinks
+
+"""
+
+
+class DownloadCursor(LastFileId):
+
+    def __init__(self, checkpoint):
+        self.prefix = checkpoint.prefix
+        self.log_id = checkpoint.log_id
+
+    """
+    Moves the position to a log file, nothing is written to the disk
+    """
+    def update_last_log_id(self, last_id):
+        self.prefix, self.log_id = LogsFileIndex.parse_file_name(last_id)
+
+    """
+    Nothing to persist, the checkpoint is written by the pipeline
+    """
+    def flush(self):
+        pass
+
+
+"""
+
+ProcessedFileLedger - A class for the log files which were already handled, so they are not downloaded and sent again
+when the position moves back, for example when it is reset to the oldest file in the bucket. The handled ids of each
+prefix are kept as runs of consecutive ids, so the ledger stays small however many files were handled
+
+"""
+
+
+class ProcessedFileLedger:
+
+    def __init__(self, config_path, checkpoint_every_files=1, checkpoint_interval=0):
+        self.ledger_file_path = os.path.join(config_path, "ProcessedFiles.ledger")
+        # every handled file is appended to the journal, the journal is replayed on top of the ledger file when starting
+        self.journal_file_path = os.path.join(config_path, "ProcessedFiles.journal")
+        # the ledger file is rewritten as often as the last known downloaded file id
+        self.checkpoint_every_files = checkpoint_every_files
+        self.checkpoint_interval = checkpoint_interval
+        self.pending_updates = 0
+        self.checkpoint_time = time.time()
+        self.journal_file = None
+        # the first and the last ids of the runs of handled ids of each prefix, sorted
+        self.run_starts = {}
+        self.run_ends = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    """
+    Loads the handled log files from the ledger file and the journal
+    """
+    def load(self):
+        if os.path.exists(self.ledger_file_path):
+            with open(self.ledger_file_path, "r") as ledger_file:
+                for line in ledger_file:
+                    prefix, first_id, last_id = line.split()
+                    self.run_starts.setdefault(prefix, []).append(int(first_id))
+                    self.run_ends.setdefault(prefix, []).append(int(last_id))
+        if os.path.exists(self.journal_file_path):
+            with open(self.journal_file_path, "r") as journal_file:
+                for line in journal_file:
+                    # a partially written last line is ignored
+                    if line.endswith("\n") and LogsFileIndex.LOG_FILE_NAME_REGEX.match(line.rstrip()):
+                        self.add_to_runs(*LogsFileIndex.parse_file_name(line.rstrip()))
+
+    """
+    Gets the position of the run which holds a log id, or None if the log id was not handled
+    """
+    def find_run(self, prefix, log_id):
+        run_starts = self.run_starts.get(prefix)
+        if not run_starts:
+            return None
+        position = bisect.bisect_right(run_starts, log_id) - 1
+        if position >= 0 and self.run_ends[prefix][position] >= log_id:
+            return position
+        return None
+
+    """
+    Checks whether a log file was already handled
+    """
+    def contains(self, log_file_name):
+        prefix, log_id = LogsFileIndex.parse_file_name(log_file_name)
+        with self.lock:
+            return self.find_run(prefix, log_id) is not None
+
+    """
+    Gets the last log file of the run of handled files which starts with or holds a log file, or None if the log file was not handled
+    """
+    def last_handled(self, log_file_name):
+        prefix, log_id = LogsFileIndex.parse_file_name(log_file_name)
+        with self.lock:
+            position = self.find_run(prefix, log_id)
+            if position is None:
+                return None
+            return LogsFileIndex.file_name(prefix, self.run_ends[prefix][position])
+
+    """
+    Gets the first handled log id of a prefix, or None if no log file of the prefix was handled
+    """
+    def first_handled_id(self, prefix):
+        with self.lock:
+            run_starts = self.run_starts.get(prefix)
+            return run_starts[0] if run_starts else None
+
+    """
+    Records a handled log file
+    """
+    def add(self, log_file_name):
+        prefix, log_id = LogsFileIndex.parse_file_name(log_file_name)
+        with self.lock:
+            if not self.add_to_runs(prefix, log_id):
+                return
+            self.pending_updates += 1
+            if self.pending_updates >= self.checkpoint_every_files or (self.checkpoint_interval > 0 and time.time() - self.checkpoint_time >= self.checkpoint_interval):
+                self.write_ledger_file()
+            else:
+                self.append_to_journal(log_file_name)
+
+    """
+    Adds a log id to the runs of its prefix, merging the runs it connects. Returns False if it was already there
+    """
+    def add_to_runs(self, prefix, log_id):
+        run_starts = self.run_starts.setdefault(prefix, [])
+        run_ends = self.run_ends.setdefault(prefix, [])
+        # the run before the log id starts at or before it
+        position = bisect.bisect_right(run_starts, log_id)
+        if position > 0 and run_ends[position - 1] >= log_id:
+            return False
+        extends_previous = position > 0 and run_ends[position - 1] == log_id - 1
+        extends_next = position < len(run_starts) and run_starts[position] == log_id + 1
+        if extends_previous and extends_next:
+            run_ends[position - 1] = run_ends[position]
+            del run_starts[position]
+            del run_ends[position]
+        elif extends_previous:
+            run_ends[position - 1] = log_id
+        elif extends_next:
+            run_starts[position] = log_id
+        else:
+            run_starts.insert(position, log_id)
+            run_ends.insert(position, log_id)
+        return True
+
+    """
+    Writes the pending handled log files to the ledger file and clears the journal
+    """
+    def flush(self):
+        with self.lock:
+            if self.pending_updates > 0:
+                self.write_ledger_file()
+
+    """
+    Replaces the ledger file with all the runs and clears the journal, the lock is held by the caller
+    """
+    def write_ledger_file(self):
+        # write a temporary file and replace the ledger file with it, so the ledger file is never partially written
+        tmp_file_path = self.ledger_file_path + ".tmp"
+        with open(tmp_file_path, "w") as ledger_file:
+            for prefix in sorted(self.run_starts):
+                for first_id, last_id in zip(self.run_starts[prefix], self.run_ends[prefix]):
+                    ledger_file.write("%s %d %d\n" % (prefix, first_id, last_id))
+            ledger_file.flush()
+            os.fsync(ledger_file.fileno())
+        if platform.system() == "Windows" and os.path.exists(self.ledger_file_path):
+            os.remove(self.ledger_file_path)
+        os.rename(tmp_file_path, self.ledger_file_path)
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+        if os.path.exists(self.journal_file_path):
+            os.remove(self.journal_file_path)
+        self.pending_updates = 0
+        self.checkpoint_time = time.time()
+
+    """
+    Appends a handled log file to the journal, the lock is held by the caller
+    """
+    def append_to_journal(self, log_file_name):
+        if self.journal_file is None:
+            self.journal_file = open(self.journal_file_path, "a")
+        self.journal_file.write(log_file_name + "\n")
+        # the journal is not synced, but is written out of the process so it survives the process crashing
+        self.journal_file.flush()
+
+
+"""
+
+GapRepairer - A class for finding the indexed log files before the last known downloaded file which were not handled,
+and for downloading them again in the background with a growing delay between the attempts, while the newest files
+keep being downloaded. The missing files are kept in Gaps.list in the config folder, so they are retried after a restart
+
+"""
+
+
+class GapRepairer:
+
+    def __init__(self, downloader):
+        self.downloader = downloader
+        self.config = downloader.config
+        self.logger = downloader.logger
+        self.metrics = downloader.metrics
+        self.ledger = downloader.ledger
+        self.gaps_file_path = os.path.join(downloader.config_path, "Gaps.list")
+        # the missing log files by name - [detection time, failed attempts, time of the next attempt]
+        self.gaps = {}
+        self.lock = threading.Lock()
+        # the retries of a missing file back off on their own, without delaying the polls for the newest files
+        self.scheduler = PollingScheduler(self.config, self.logger, lambda: self.downloader.running)
+        self.load()
+        account = (("account", downloader.config_path),)
+        self.metrics.add_gauge("logs_downloader_gaps", account, lambda: len(self.gaps))
+        self.metrics.add_gauge("logs_downloader_oldest_gap_age_seconds", account, self.get_oldest_gap_age)
+        repair_thread = threading.Thread(target=self.run, name="gap_repair_thread")
+        repair_thread.daemon = True
+        repair_thread.start()
+
+    """
+    Loads the missing log files which were found before the restart
+    """
+    def load(self):
+        if not os.path.exists(self.gaps_file_path):
+            return
+        with open(self.gaps_file_path, "r") as gaps_file:
+            for line in gaps_file:
+                fields = line.split()
+                if len(fields) == 3 and LogsFileIndex.LOG_FILE_NAME_REGEX.match(fields[0]):
+                    self.gaps[fields[0]] = [float(fields[1]), int(fields[2]), 0]
+
+    """
+    Replaces Gaps.list with the current missing log files, the lock is held by the caller
+    """
+    def save(self):
+        tmp_file_path = self.gaps_file_path + ".tmp"
+        with open(tmp_file_path, "w") as gaps_file:
+            for log_file_name in sorted(self.gaps, key=LogsFileIndex.parse_file_name):
+                detection_time, attempts, next_attempt_time = self.gaps[log_file_name]
+                gaps_file.write("%s %.3f %d\n" % (log_file_name, detection_time, attempts))
+            gaps_file.flush()
+            os.fsync(gaps_file.fileno())
+        if platform.system() == "Windows" and os.path.exists(self.gaps_file_path):
+            os.remove(self.gaps_file_path)
+        os.rename(tmp_file_path, self.gaps_file_path)
+
+    """
+    Records missing log files, they are downloaded again in the background
+    """
+    def add(self, log_file_names):
+        with self.lock:
+            new_gaps = [log_file_name for log_file_name in log_file_names if log_file_name not in self.gaps]
+            if not new_gaps:
+                return
+            for log_file_name in new_gaps:
+                self.gaps[log_file_name] = [time.time(), 0, 0]
+            self.save()
+        self.logger.warning("Found %s missing log files, they will be downloaded in the background - %s", len(new_gaps), ", ".join(new_gaps))
+
+    """
+    Drops a missing log file from the list
+    """
+    def remove(self, log_file_name):
+        with self.lock:
+            if self.gaps.pop(log_file_name, None) is not None:
+                self.save()
+
+    """
+    Compares the handled log files with the index, from the first handled file to the last known downloaded file
+    """
+    def detect(self):
+        checkpoint = self.downloader.checkpoint
+        prefix, last_log_id = checkpoint.prefix, checkpoint.log_id
+        if last_log_id is None:
+            return
+        first_log_id = self.ledger.first_handled_id(prefix)
+        if first_log_id is None:
+            return
+        self.downloader.logs_file_index.refresh()
+        missing_files = [LogsFileIndex.file_name(prefix, log_id) for log_id in self.downloader.logs_file_index.ids_between(prefix, first_log_id, last_log_id)]
+        self.add([log_file_name for log_file_name in missing_files if not self.ledger.contains(log_file_name)])
+
+    """
+    Finds and repairs the missing log files until the downloader is stopped, runs on a dedicated thread
+    """
+    def run(self):
+        next_detection_time = 0
+        while self.downloader.running:
+            if time.time() >= next_detection_time:
+                try:
+                    self.detect()
+                except Exception as e:
+                    self.logger.error("Failed to look for missing log files - %s", e)
+                next_detection_time = time.time() + self.config.GAP_CHECK_INTERVAL
+            log_file_name = self.next_due_gap()
+            if log_file_name is None:
+                time.sleep(1)
+                continue
+            try:
+                self.repair(log_file_name)
+            except Exception as e:
+                self.logger.error("Unexpected error while repairing the missing log file %s - %s, %s", log_file_name, e, traceback.format_exc())
+
+    """
+    Gets the oldest missing log file which is due for another attempt, or None if there is none
+    """
+    def next_due_gap(self):
+        now = time.time()
+        with self.lock:
+            due_gaps = [log_file_name for log_file_name, gap in self.gaps.items() if gap[2] <= now]
+        return min(due_gaps, key=LogsFileIndex.parse_file_name) if due_gaps else None
+
+    """
+    Downloads and handles a missing log file, or schedules another attempt if it failed
+    """
+    def repair(self, log_file_name):
+        if self.ledger.contains(log_file_name):
+            # the file was handled in the meantime, for example after the position was moved back
+            self.remove(log_file_name)
+            return
+        prefix, log_id = LogsFileIndex.parse_file_name(log_file_name)
+        oldest_log_id = self.downloader.logs_file_index.oldest(prefix)
+        if oldest_log_id is not None and log_id < oldest_log_id:
+            self.logger.error("The missing log file %s is no longer in the bucket, it is lost", log_file_name)
+            self.metrics.inc("logs_downloader_gap_repairs_total", (("result", "lost"),))
+            self.remove(log_file_name)
+            return
+        if backfill_file(self.downloader, log_file_name, self.scheduler):
+            self.ledger.add(log_file_name)
+            self.logger.info("Repaired the missing log file %s", log_file_name)
+            self.metrics.inc("logs_downloader_gap_repairs_total", (("result", "repaired"),))
+            self.remove(log_file_name)
+            return
+        self.metrics.inc("logs_downloader_gap_repairs_total", (("result", "failed"),))
+        with self.lock:
+            gap = self.gaps.get(log_file_name)
+            if gap is None:
+                return
+            gap[1] += 1
+            delay = min(self.config.GAP_RETRY_MAX_DELAY, self.config.GAP_CHECK_INTERVAL * 2 ** min(gap[1] - 1, 16))
+            gap[2] = time.time() + delay
+            self.save()
+        self.logger.info("Failed to repair the missing log file %s, will try again in %s seconds", log_file_name, delay)
+
+    """
+    Gets the number of seconds since the oldest missing log file was found
+    """
+    def get_oldest_gap_age(self):
+        with self.lock:
+            detection_times = [gap[0] for gap in self.gaps.values()]
+        return time.time() - min(detection_times) if detection_times else 0
+
+
+"""
+
+PrivateKeyRing - A class for caching the private keys and the decrypted symmetric keys of the log files
+
+"""
+
+
+class PrivateKeyRing:
+
+    def __init__(self, config_path, config, logger, metrics):
+        self.keys_directory = os.path.join(config_path, "keys")
+        self.metrics = metrics
+        self.check_interval = config.KEY_RING_CHECK_INTERVAL
+        self.logger = logger
+        # the loaded private keys by public key id - (Private.key modification time, last check time, RSA key)
+        self.private_keys = {}
+        # the decrypted symmetric keys by (public key id, encrypted symmetric key), least recently used first
+        self.symmetric_keys = collections.OrderedDict()
+        self.symmetric_keys_cache_size = config.SYMMETRIC_KEY_CACHE_SIZE
+        self.lock = threading.Lock()
+
+    """
+    Decrypts the symmetric key of a log file, using a cached result if the same key was already decrypted
+    """
+    def decrypt_symmetric_key(self, public_key_id, content_encrypted_sym_key, filename):
+        rsa_private_key = self.get_private_key(public_key_id, filename)
+        cache_key = (public_key_id, content_encrypted_sym_key)
+        with self.lock:
+            sym_key = self.symmetric_keys.pop(cache_key, None)
+            if sym_key is not None:
+                self.symmetric_keys[cache_key] = sym_key
+                return sym_key
+        # the crypto libraries are imported only once an encrypted file arrives
+        import M2Crypto
+        try:
+            with self.metrics.time("rsa_decrypt"):
+                content_decrypted_sym_key = rsa_private_key.private_decrypt(base64.b64decode(bytearray(content_encrypted_sym_key)), M2Crypto.RSA.pkcs1_padding)
+            sym_key = base64.b64decode(bytearray(content_decrypted_sym_key))
+        except Exception as e:
+            self.logger.error("Error while trying to decrypt the symmetric key of the file %s - %s", filename, str(e))
+            raise Exception("Error while trying to decrypt the file" + filename)
+        with self.lock:
+            self.symmetric_keys[cache_key] = sym_key
+            while len(self.symmetric_keys) > self.symmetric_keys_cache_size:
+                self.symmetric_keys.popitem(last=False)
+        return sym_key
+
+    """
+    Gets the private key of a public key id, loading it from the keys directory if it is new or was modified
+    """
+    def get_private_key(self, public_key_id, filename):
+        now = time.time()
+        with self.lock:
+            cached = self.private_keys.get(public_key_id)
+        # the key file is checked for modifications at most once per check interval
+        if cached is not None and now - cached[1] < self.check_interval:
+            return cached[2]
+        # we expect to have a 'keys' folder that will have the stored private keys
+        if not os.path.exists(self.keys_directory):
+            self.logger.error("No encryption keys directory was found and file %s is encrypted", filename)
+            raise Exception("No encryption keys directory was found")
+        # get the public key directory in the filesystem - each time we upload a new key this id is incremented
+        public_key_directory = os.path.join(self.keys_directory, public_key_id)
+        # if the key directory does not exists
+        if not os.path.exists(public_key_directory):
+            self.logger.error("Failed to find a proper certificate for : %s who has the publicKeyId of %s", filename, public_key_id)
+            raise Exception("Failed to find a proper certificate")
+        private_key_path = os.path.join(public_key_directory, "Private.key")
+        modification_time = os.path.getmtime(private_key_path)
+        if cached is not None and cached[0] == modification_time:
+            rsa_private_key = cached[2]
+        else:
+            self.logger.info("Loading the private key of publicKeyId %s", public_key_id)
+            # get the private key
+            private_key = open(private_key_path, "r").read()
+            import M2Crypto
+            try:
+                rsa_private_key = M2Crypto.RSA.load_key_string(private_key)
+            except Exception as e:
+                self.logger.error("Error while trying to load the private key of publicKeyId %s - %s", public_key_id, str(e))
+                raise Exception("Error while trying to decrypt the file" + filename)
+        with self.lock:
+            if cached is not None and cached[2] is not rsa_private_key:
+                # the key was replaced, so the symmetric keys which were decrypted with the old key are dropped
+                for cache_key in [cache_key for cache_key in self.symmetric_keys if cache_key[0] == public_key_id]:
+                    del self.symmetric_keys[cache_key]
+            self.private_keys[public_key_id] = (modification_time, now, rsa_private_key)
+        return rsa_private_key
+
+
+"""
+
+PollingScheduler - A class for deciding how long to wait before polling for the next log file
+
+"""
+
+
+class PollingScheduler:
+
+    # the weight of the newest sample in the estimated interval between new log files
+    INTERVAL_SMOOTHING = 0.2
+
+    def __init__(self, config, logger, is_running):
+        self.min_delay = config.POLL_MIN_DELAY
+        self.max_delay = config.POLL_MAX_DELAY
+        self.logger = logger
+        self.is_running = is_running
+        # the number of polls which did not find the next file since the last success
+        self.misses = 0
+        # the learned interval between new log files, and when the last new log file was found
+        self.interval = None
+        self.last_arrival = None
+        self.delay = self.min_delay
+
+    """
+    Registers a successfully handled file, so the next file is polled right away
+    """
+    def on_success(self):
+        now = time.time()
+        # a file which was not there on the previous poll has just been produced, so we learn from its arrival time
+        if self.misses > 0:
+            if self.last_arrival is not None:
+                sample = now - self.last_arrival
+                if self.interval is None:
+                    self.interval = sample
+                else:
+                    self.interval += PollingScheduler.INTERVAL_SMOOTHING * (sample - self.interval)
+            self.last_arrival = now
+        self.misses = 0
+        self.delay = 0
+
+    """
+    Registers a poll which did not find the next file, the wait grows exponentially with each miss
+    """
+    def on_not_ready(self):
+        self.misses += 1
+        if self.misses == 1 and self.interval is not None and self.last_arrival is not None:
+            # wait until the next file is expected to be produced
+            delay = self.last_arrival + self.interval - time.time()
+        else:
+            delay = self.min_delay * (2 ** min(self.misses - 1, 16))
+        self.delay = min(self.max_delay, max(self.min_delay, delay))
+
+    """
+    Registers a poll which was rejected due to rate limiting, the server's Retry-After is honored if it was given
+    """
+    def on_rate_limited(self, retry_after):
+        self.on_not_ready()
+        if retry_after is not None:
+            self.delay = max(self.delay, retry_after)
+
+    """
+    Waits for the current delay with a random jitter, returns early if the downloader is stopped
+    """
+    def wait(self, reason):
+        if self.delay <= 0:
+            return
+        delay = self.jittered_delay()
+        self.logger.info("Sleeping for %.1f seconds %s...", delay, reason)
+        wake_up_time = time.time() + delay
+        while self.is_running() and time.time() < wake_up_time:
+            time.sleep(max(0, min(1, wake_up_time - time.time())))
+
+    """
+    Gets the current delay with a random jitter, so a few downloaders do not poll at the same moments
+    """
+    def jittered_delay(self):
+        return random.uniform(self.delay / 2, self.delay)
+
+
+"""
+
+TokenBucket - A class for limiting the rate of requests, shared between threads
+
+"""
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        # the number of requests per second, 0 means no limit
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.update_time = time.time()
+        # no request is allowed before this time
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    """
+    Waits until a request is allowed
+    """
+    def acquire(self):
+        while True:
+            wait_time = self.try_acquire()
+            if wait_time == 0:
+                return
+            time.sleep(wait_time)
+
+    """
+    Takes a token if a request is allowed, otherwise returns the number of seconds to wait before trying again
+    """
+    def try_acquire(self):
+        with self.lock:
+            now = time.time()
+            if now < self.paused_until:
+                return self.paused_until - now
+            elif self.rate <= 0:
+                return 0
+            self.tokens = min(self.burst, self.tokens + (now - self.update_time) * self.rate)
+            self.update_time = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    """
+    Holds all the requests for the given number of seconds
+    """
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+
+"""
+
+LogFilePrefetcher - A class for downloading and decrypting the upcoming log files ahead of time
+
+"""
+
+
+class LogFilePrefetcher:
+
+    def __init__(self, downloader, window, logger, decrypt=True):
+        self.downloader = downloader
+        self.window = window
+        self.logger = logger
+        self.decrypt = decrypt
+        # the log files which are currently downloaded or waiting to be taken, by file name
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    """
+    Starts downloading and decrypting the given log files, up to the size of the prefetch window
+    """
+    def prefetch(self, log_file_names):
+        with self.lock:
+            # drop files which are no longer expected, e.g. after the last known downloaded file id was reset
+            for stale_file_name in [name for name in self.in_flight if name not in log_file_names]:
+                del self.in_flight[stale_file_name]
+            for log_file_name in log_file_names:
+                if len(self.in_flight) >= self.window:
+                    break
+                if log_file_name in self.in_flight:
+                    continue
+                prefetched = PrefetchedLogFile(log_file_name)
+                self.in_flight[log_file_name] = prefetched
+                worker = threading.Thread(target=self.fetch, args=(prefetched,), name="prefetch_thread")
+                worker.daemon = True
+                worker.start()
+
+    """
+    Downloads and decrypts a single log file, runs on a prefetch thread
+    """
+    def fetch(self, prefetched):
+        try:
+            prefetched.result = self.downloader.download_log_file(prefetched.name)
+            if prefetched.result[0] == "OK" and self.decrypt:
+                prefetched.decrypted = self.downloader.decrypt_file(prefetched.result[1], prefetched.name)
+        except Exception as e:
+            prefetched.error = e
+        finally:
+            prefetched.done.set()
+
+    """
+    Gets a prefetched log file, waiting for its download to complete if needed.
+    Returns None if the file was not prefetched or could not be downloaded - in which case the caller downloads it on its own
+    """
+    def take(self, log_file_name):
+        with self.lock:
+            prefetched = self.in_flight.pop(log_file_name, None)
+        if prefetched is None:
+            return None
+        prefetched.done.wait()
+        # a missing file could be generated later on, so only successful downloads are reused
+        if prefetched.result is None or prefetched.result[0] != "OK":
+            return None
+        self.logger.debug("Using prefetched log file %s", log_file_name)
+        return prefetched
+
+
+class PrefetchedLogFile:
+
+    def __init__(self, name):
+        self.name = name
+        self.result = None
+        self.decrypted = None
+        self.error = None
+        self.done = threading.Event()
+
+
+"""
+
+LogFilePipeline - A class for decrypting the downloaded log files and writing them to the sinks on separate stages.
+Each stage has its own worker threads and a bounded queue, so a slow stage holds back the stages before it, down to
+the downloads. The checkpoint advances over a file only once all the enabled sinks acknowledged it, in download order
+
+"""
+
+
+class LogFilePipeline:
+
+    def __init__(self, downloader, checkpoint):
+        self.downloader = downloader
+        self.config = downloader.config
+        self.logger = downloader.logger
+        self.metrics = downloader.metrics
+        self.checkpoint = checkpoint
+        # the files which were not committed yet, in download order
+        self.in_flight = collections.deque()
+        self.condition = threading.Condition()
+        # the sinks which acknowledge each file, each sink has its own stage. The SFTP server gets the locally saved file
+        self.sinks = []
+        self.sink_queues = []
+        for name in downloader.sink_names:
+            self.sinks.append(name)
+            workers = getattr(self.config, "PIPELINE_%s_WORKERS" % name.upper(), 1)
+            self.sink_queues.append(self.start_stage(name, workers, lambda pipeline_file, name=name: self.write_to_sink(name, pipeline_file)))
+        if "local" in self.sinks and self.config.SFTP_TRANSFER == "YES":
+            self.sinks.append("sftp")
+        self.decode_queue = self.start_stage("decode", self.config.PIPELINE_DECODE_WORKERS, self.decode)
+
+    """
+    Starts the worker threads of a stage, returns the queue of the stage
+    """
+    def start_stage(self, name, workers, handler):
+        stage_queue = Queue.Queue(self.config.PIPELINE_QUEUE_SIZE)
+        self.metrics.add_gauge("logs_downloader_queue_depth", (("queue", "pipeline_" + name), ("account", self.downloader.config_path)), stage_queue.qsize)
+        for i in range(workers):
+            stage_thread = threading.Thread(target=self.run_stage, args=(stage_queue, handler), name="pipeline_%s_thread" % name)
+            stage_thread.daemon = True
+            stage_thread.start()
+        return stage_queue
+
+    """
+    Handles the files of a stage one by one, runs on a dedicated thread
+    """
+    def run_stage(self, stage_queue, handler):
+        while True:
+            pipeline_file = stage_queue.get()
+            try:
+                handler(pipeline_file)
+            except Exception as e:
+                # the checkpoint could not advance over the file anymore, so the downloader stops instead of downloading ahead forever
+                self.stop("Unexpected error while handling file %s on the pipeline - %s, %s" % (pipeline_file.name, e, traceback.format_exc()))
+                self.abandon(pipeline_file)
+
+    """
+    Queues a downloaded log file for decryption, waits while the decode queue is full
+    """
+    def submit(self, logfile, file_content, prefetched=None):
+        pipeline_file = PipelineFile(logfile, file_content, prefetched, self.sinks)
+        with self.condition:
+            self.in_flight.append(pipeline_file)
+        self.decode_queue.put(pipeline_file)
+
+    """
+    Decrypts a file and hands it to all the sink stages
+    """
+    def decode(self, pipeline_file):
+        prefetched = pipeline_file.prefetched
+        try:
+            if prefetched is not None and prefetched.error is not None:
+                raise prefetched.error
+            elif prefetched is not None and prefetched.decrypted is not None:
+                pipeline_file.content = prefetched.decrypted
+            else:
+                pipeline_file.content = self.downloader.decrypt_file(pipeline_file.file_content, pipeline_file.name)
+            if self.downloader.line_filter is not None:
+                pipeline_file.content = self.downloader.line_filter.filter_content(pipeline_file.content)
+        # a file which cannot be decrypted is saved to the "fail" folder, and is skipped
+        except Exception as e:
+            self.logger.error("Saving file %s locally to the 'fail' folder %s %s", pipeline_file.name, e, traceback.format_exc())
+            self.downloader.save_failed_file(pipeline_file.name, pipeline_file.file_content)
+            pipeline_file.failed = True
+            for sink in list(pipeline_file.pending_sinks):
+                self.acknowledge(pipeline_file, sink)
+            return
+        pipeline_file.file_content = None
+        pipeline_file.prefetched = None
+        self.metrics.inc("logs_downloader_lines_total", (), len(pipeline_file.content.splitlines()))
+        pipeline_file.readers = len(self.sink_queues)
+        for sink_queue in self.sink_queues:
+            sink_queue.put(pipeline_file)
+        if not self.sink_queues:
+            self.commit()
+
+    """
+    Writes a file to a sink, retrying until it was delivered, and starts the background work of the sink such as the SFTP upload
+    """
+    def write_to_sink(self, name, pipeline_file):
+        while True:
+            sink = None
+            try:
+                sink = self.downloader.open_sink(name, pipeline_file.name)
+                sink.write_content(pipeline_file.content)
+                # the file is acknowledged only once all of its lines were delivered
+                sink.flush()
+                break
+            except Exception as e:
+                if sink is not None:
+                    sink.abort()
+                self.logger.error("Failed to write file %s to the %s sink - %s", pipeline_file.name, name, e)
+                if not self.wait_to_retry():
+                    self.abandon(pipeline_file)
+                    return
+        self.release(pipeline_file)
+        sink.close(lambda local_path: self.acknowledge(pipeline_file, "sftp"), lambda retry: self.retry_later(pipeline_file, retry))
+        self.acknowledge(pipeline_file, name)
+
+    """
+    Schedules a retry of a failed background SFTP upload or compression
+    """
+    def retry_later(self, pipeline_file, retry):
+        if not self.downloader.running:
+            self.abandon(pipeline_file)
+            return
+        self.logger.info("Will retry the transfer of file %s in %s seconds", pipeline_file.name, self.config.PIPELINE_RETRY_INTERVAL)
+        retry_timer = threading.Timer(self.config.PIPELINE_RETRY_INTERVAL, retry)
+        retry_timer.daemon = True
+        retry_timer.start()
+
+    """
+    Waits before retrying a failed sink, returns False if the downloader was stopped in the meantime
+    """
+    def wait_to_retry(self):
+        retry_time = time.time() + self.config.PIPELINE_RETRY_INTERVAL
+        while self.downloader.running and time.time() < retry_time:
+            time.sleep(min(1, retry_time - time.time()))
+        return self.downloader.running
+
+    """
+    Drops the decrypted content of a file once all the sink stages are done with it
+    """
+    def release(self, pipeline_file):
+        with self.condition:
+            pipeline_file.readers -= 1
+            if pipeline_file.readers == 0:
+                pipeline_file.content = None
+
+    """
+    Marks a file as acknowledged by a sink, and advances the checkpoint over the files which were acknowledged by all the sinks
+    """
+    def acknowledge(self, pipeline_file, sink):
+        with self.condition:
+            pipeline_file.pending_sinks.discard(sink)
+        self.commit()
+
+    """
+    Advances the checkpoint over the oldest files which were acknowledged by all the sinks
+    """
+    def commit(self):
+        with self.condition:
+            try:
+                while self.in_flight and not self.in_flight[0].pending_sinks and not self.in_flight[0].abandoned:
+                    # the file leaves the pipeline only once the checkpoint was advanced over it
+                    pipeline_file = self.in_flight[0]
+                    self.checkpoint.update_last_log_id(pipeline_file.name)
+                    # a file which was saved to the "fail" folder is not in the ledger, like on the inline path, so the gap repair downloads it again
+                    if self.downloader.ledger is not None and not pipeline_file.failed:
+                        self.downloader.ledger.add(pipeline_file.name)
+                    self.in_flight.popleft()
+                    if not pipeline_file.failed:
+                        self.metrics.inc("logs_downloader_files_total", (("result", "handled"),))
+                        self.logger.info("File %s download and processing completed successfully", pipeline_file.name)
+            except Exception as e:
+                self.stop("Failed to advance the last known downloaded file id - %s, %s" % (e, traceback.format_exc()))
+            self.condition.notify_all()
+
+    """
+    Stops the downloader on an error which the pipeline cannot recover from, the files on the pipeline are then abandoned
+    """
+    def stop(self, error):
+        self.logger.error("Stopping the downloader - %s", error)
+        self.downloader.running = False
+
+    """
+    Gives up on a file when the downloader is stopped, the checkpoint does not advance over it. Must not be called while the downloader is running
+    """
+    def abandon(self, pipeline_file):
+        with self.condition:
+            pipeline_file.abandoned = True
+            self.condition.notify_all()
+        self.logger.info("Stopped handling file %s, it will be downloaded again once the downloader is started", pipeline_file.name)
+
+    """
+    Waits until all the files on the pipeline were acknowledged by the sinks or abandoned
+    """
+    def drain(self):
+        with self.condition:
+            while any(pipeline_file.pending_sinks and not pipeline_file.abandoned for pipeline_file in self.in_flight):
+                self.condition.wait(1)
+
+
+"""
+
+PipelineFile - A class for a log file which is handled on the pipeline
+
+"""
+
+
+class PipelineFile:
+
+    def __init__(self, name, file_content, prefetched, sinks):
+        self.name = name
+        # the downloaded file, until it is decrypted
+        self.file_content = file_content
+        self.prefetched = prefetched
+        # the decrypted file, until all the sink stages are done with it
+        self.content = None
+        self.readers = 0
+        # the sinks which did not acknowledge the file yet
+        self.pending_sinks = set(sinks)
+        self.abandoned = False
+        # whether the file could not be decrypted and was saved to the "fail" folder
+        self.failed = False
+
+
+"""
+
+LogFileStreamDecoder - A class for decrypting and decompressing a log file chunk by chunk
+
+"""
+
+
+class LogFileStreamDecoder:
+
+    # each log file is built from a header section and a content section, the two are divided by a |==| mark
+    HEADER_SEPARATOR = "|==|\n"
+    # the header is small, anything bigger means that the file is malformed
+    MAX_HEADER_SIZE = 64 * 1024
+
+    def __init__(self, downloader, filename):
+        self.downloader = downloader
+        self.filename = filename
+        self.logger = downloader.logger
+        self.metrics = downloader.metrics
+        self.max_output_size = downloader.config.STREAM_CHUNK_SIZE
+        self.header = None
+        self.pending_header = ""
+        self.checksum = None
+        self.cipher = None
+        self.pending_cipher_text = ""
+        self.decompressor = None
+        self.decompression_ended = False
+        # None until we know whether the log content is compressed
+        self.compressed = None
+        self.pending_content = ""
+        self.md5 = hashlib.md5()
+        self.pending_line = ""
+
+    """
+    Feeds a downloaded chunk, yields the complete lines which were decoded from it in bounded size batches
+    """
+    def feed(self, chunk):
+        if self.header is None:
+            self.pending_header += chunk
+            separator_position = self.pending_header.find(LogFileStreamDecoder.HEADER_SEPARATOR)
+            if separator_position == -1:
+                if len(self.pending_header) > LogFileStreamDecoder.MAX_HEADER_SIZE:
+                    raise Exception("Could not find the end of the header of the file " + self.filename)
+                return
+            self.start(self.pending_header[:separator_position])
+            chunk = self.pending_header[separator_position + len(LogFileStreamDecoder.HEADER_SEPARATOR):]
+            self.pending_header = ""
+        for content in self.decode(chunk):
+            yield self.split_lines(content)
+
+    """
+    Completes the decoding after the last chunk, returns the remaining lines and validates the checksum
+    """
+    def finish(self):
+        if self.header is None:
+            raise Exception("Could not find the end of the header of the file " + self.filename)
+        if self.pending_cipher_text != "":
+            raise Exception("Encrypted content of the file %s is not aligned to the cipher block size" % self.filename)
+        if self.compressed and not self.decompression_ended:
+            lines = self.split_lines(self.decompressor.flush())
+        else:
+            # a content which is too short to be compressed
+            lines = self.split_lines(self.pending_content)
+        if self.pending_line != "":
+            lines.append(self.pending_line)
+            self.pending_line = ""
+        if self.checksum is not None and self.md5.hexdigest() != self.checksum:
+            self.logger.error("Checksum verification failed for file %s", self.filename)
+            raise Exception("Checksum verification failed")
+        return lines
+
+    """
+    Parses the file header and prepares the decryption
+    """
+    def start(self, header):
+        self.header = header
+        # if the file is not encrypted - the "key" value in the file header is '-1'
+        if header.find("key:") == -1:
+            self.logger.debug("%s is not encrypted, Skipping decryption", self.filename)
+        else:
+            self.checksum = header.split("checksum:")[1].splitlines()[0]
+            sym_key = self.downloader.get_file_symmetric_key(header, self.filename)
+            from Crypto.Cipher import AES
+            self.cipher = AES.new(sym_key, AES.MODE_CBC, 16 * "\x00")
+            # an encrypted content is always compressed
+            self.compressed = True
+        self.decompressor = zlib.decompressobj()
+
+    """
+    Decrypts and decompresses a chunk of the log content, yields the decoded content in bounded size pieces
+    """
+    def decode(self, chunk):
+        if self.cipher is not None:
+            # the cipher works on whole blocks, the rest is kept for the next chunk
+            data = self.pending_cipher_text + chunk
+            aligned_length = len(data) - len(data) % self.cipher.block_size
+            self.pending_cipher_text = data[aligned_length:]
+            with self.metrics.time("aes_decrypt"):
+                chunk = self.cipher.decrypt(data[:aligned_length])
+        if self.compressed is None:
+            # an unencrypted content might not be compressed, we check for a zlib stream header before decompressing
+            self.pending_content += chunk
+            if len(self.pending_content) < 2:
+                return
+            chunk = self.pending_content
+            self.pending_content = ""
+            self.compressed = LogFileStreamDecoder.is_zlib_header(chunk[:2])
+            if not self.compressed:
+                self.logger.debug("%s is not compressed, skipping decompression", self.filename)
+        if not self.compressed:
+            yield chunk
+            return
+        # once the compressed stream has ended, the rest is cipher padding
+        if self.decompression_ended or self.decompressor.unused_data != "":
+            return
+        # the output size of each step is bounded so that highly compressed chunks do not blow up the memory
+        with self.metrics.time("decompress"):
+            content = self.decompressor.decompress(chunk, self.max_output_size)
+        yield content
+        while self.decompressor.unconsumed_tail != "":
+            unconsumed_tail = self.decompressor.unconsumed_tail
+            with self.metrics.time("decompress"):
+                content = self.decompressor.decompress(unconsumed_tail, self.max_output_size)
+            # the stream has ended and the rest of the input is left untouched
+            if content == "" and self.decompressor.unconsumed_tail == unconsumed_tail:
+                self.decompression_ended = True
+                return
+            yield content
+
+    """
+    Checks whether the given two bytes are a valid zlib stream header
+    """
+    @staticmethod
+    def is_zlib_header(header):
+        cmf, flg = ord(header[0]), ord(header[1])
+        return cmf & 0x0f == 8 and (cmf * 256 + flg) % 31 == 0
+
+    """
+    Splits decoded content into complete lines, keeping the last partial line for the next chunk
+    """
+    def split_lines(self, content):
+        if content == "":
+            return []
+        with self.metrics.time("checksum"):
+            self.md5.update(content)
+        lines = (self.pending_line + content).split("\n")
+        self.pending_line = lines.pop()
+        return [line.rstrip("\r") for line in lines]
+
+
+"""
+
+CefFilter - A class for dropping the CEF log lines which are not needed, and the extension fields which are not needed.
+The include and exclude rules are compiled once, and each line is parsed only as far as the rules need
+
+"""
+
+
+class CefFilter:
+
+    # the names of the CEF header fields, by their position
+    HEADER_FIELDS = ("version", "deviceVendor", "deviceProduct", "deviceVersion", "deviceEventClassId", "name", "severity")
+    # a pipe which ends a header field, unless it is escaped
+    HEADER_DELIMITER_REGEX = re.compile(r"(?<!\\)\|")
+    # the value of an extension field ends where the next field starts, or at the end of the line
+    NEXT_FIELD_REGEX = re.compile(r" [\w.\-\[\]]+=")
+    NUMBER_RANGE_REGEX = re.compile(r"^(\d+)-(\d+)$")
+
+    def __init__(self, include, exclude, drop_fields, metrics):
+        self.metrics = metrics
+        self.include_rules = [self.compile_rule(rule) for rule in include.split("|") if rule.strip()]
+        self.exclude_rules = [self.compile_rule(rule) for rule in exclude.split("|") if rule.strip()]
+        self.drop_fields = [field.strip() for field in drop_fields.split(",") if field.strip()]
+
+    """
+    Creates a filter from the settings, returns None if no filtering is configured
+    """
+    @staticmethod
+    def from_config(config, metrics):
+        if config.CEF_INCLUDE == "" and config.CEF_EXCLUDE == "" and config.CEF_DROP_FIELDS == "":
+            return None
+        return CefFilter(config.CEF_INCLUDE, config.CEF_EXCLUDE, config.CEF_DROP_FIELDS, metrics)
+
+    """
+    Compiles a rule - conditions separated by ';', all of which should match.
+    Each condition is a field name and comma separated values, which can also be IP ranges such as 10.0.0.0/8 or number ranges such as 500-599
+    """
+    def compile_rule(self, rule):
+        conditions = []
+        for condition in rule.split(";"):
+            if not condition.strip():
+                continue
+            if "=" not in condition:
+                raise Exception("Invalid CEF filter condition " + condition)
+            field, values = condition.split("=", 1)
+            conditions.append((field.strip(), self.compile_values([value.strip() for value in values.split(",")])))
+        return conditions
+
+    """
+    Compiles the values of a condition to a predicate on a field value
+    """
+    def compile_values(self, values):
+        exact_values = set()
+        ip_ranges = []
+        number_ranges = []
+        for value in values:
+            number_range = self.NUMBER_RANGE_REGEX.match(value)
+            if "/" in value:
+                address, prefix_length = value.split("/", 1)
+                family, network = CefFilter.parse_ip(address)
+                bits = 32 if family == socket.AF_INET else 128
+                mask = ((1 << bits) - 1) ^ ((1 << (bits - int(prefix_length))) - 1)
+                ip_ranges.append((family, network & mask, mask))
+            elif number_range is not None:
+                number_ranges.append((int(number_range.group(1)), int(number_range.group(2))))
+            else:
+                exact_values.add(value)
+
+        def matches(field_value):
+            if field_value is None:
+                return False
+            if field_value in exact_values:
+                return True
+            if number_ranges and field_value.isdigit():
+                number = int(field_value)
+                if any(low <= number <= high for low, high in number_ranges):
+                    return True
+            if ip_ranges:
+                try:
+                    family, address = CefFilter.parse_ip(field_value)
+                except Exception:
+                    return False
+                return any(family == range_family and address & mask == network for range_family, network, mask in ip_ranges)
+            return False
+        return matches
+
+    """
+    Parses an IPv4 or IPv6 address to its address family and a number
+    """
+    @staticmethod
+    def parse_ip(address):
+        if ":" in address:
+            return socket.AF_INET6, int(base64.b16encode(socket.inet_pton(socket.AF_INET6, address)), 16)
+        return socket.AF_INET, struct.unpack("!I", socket.inet_aton(address))[0]
+
+    """
+    Finds an extension field, returns the start of the field and the start and end of its value, or None if it is missing
+    """
+    @staticmethod
+    def find_field(extension, field):
+        if extension.startswith(field + "="):
+            field_start = 0
+        else:
+            field_start = extension.find(" " + field + "=")
+            if field_start == -1:
+                return None
+        value_start = extension.index("=", field_start) + 1
+        next_field = CefFilter.NEXT_FIELD_REGEX.search(extension, value_start)
+        value_end = next_field.start() if next_field is not None else len(extension.rstrip())
+        return field_start, value_start, value_end
+
+    """
+    Filters log lines, returns the lines to send
+    """
+    def filter_lines(self, lines):
+        kept_lines = []
+        for line in lines:
+            event = CefEvent(line)
+            if self.include_rules and not any(all(matches(event.get(field)) for field, matches in rule) for rule in self.include_rules):
+                continue
+            if self.exclude_rules and any(all(matches(event.get(field)) for field, matches in rule) for rule in self.exclude_rules):
+                continue
+            kept_lines.append(event.project(self.drop_fields) if self.drop_fields else line)
+        if len(kept_lines) < len(lines):
+            self.metrics.inc("logs_downloader_filtered_lines_total", (), len(lines) - len(kept_lines))
+        return kept_lines
+
+    """
+    Filters a whole decrypted file content
+    """
+    def filter_content(self, content):
+        kept_lines = self.filter_lines(content.splitlines())
+        if not kept_lines:
+            return ""
+        return "\n".join(kept_lines) + "\n"
+
+
+"""
+
+CefEvent - A class for a CEF log line, its fields are parsed on first use
+
+"""
+
+
+class CefEvent:
+
+    def __init__(self, line):
+        self.line = line
+        self.header = None
+        self.extension = None
+        self.extension_start = None
+        self.fields = {}
+
+    """
+    Splits the line to the header fields and the extension
+    """
+    def parse(self):
+        cef_start = self.line.find("CEF:")
+        if cef_start == -1:
+            self.header = []
+            self.extension = ""
+            self.extension_start = len(self.line)
+            return
+        # the header fields rarely have escaped pipes, so the faster split is used when there are none
+        if "\\|" in self.line:
+            parts = CefFilter.HEADER_DELIMITER_REGEX.split(self.line[cef_start + 4:], 7)
+        else:
+            parts = self.line[cef_start + 4:].split("|", 7)
+        self.header = parts[:7]
+        self.extension = parts[7] if len(parts) > 7 else ""
+        self.extension_start = len(self.line) - len(self.extension)
+
+    """
+    Gets the value of a header or extension field, or None if the line does not have it
+    """
+    def get(self, field):
+        if field in self.fields:
+            return self.fields[field]
+        if self.header is None:
+            self.parse()
+        if field in CefFilter.HEADER_FIELDS:
+            position = CefFilter.HEADER_FIELDS.index(field)
+            value = self.header[position] if position < len(self.header) else None
+        else:
+            position = CefFilter.find_field(self.extension, field)
+            value = None
+            if position is not None:
+                value = self.extension[position[1]:position[2]]
+                if "\\" in value:
+                    value = value.replace("\\=", "=").replace("\\\\", "\\")
+        self.fields[field] = value
+        return value
+
+    """
+    Gets the line without the given extension fields
+    """
+    def project(self, fields):
+        if self.header is None:
+            self.parse()
+        extension = self.extension
+        for field in fields:
+            position = CefFilter.find_field(extension, field)
+            if position is not None:
+                field_start, field_end = position[0], position[2]
+                # the first field is dropped with the space after it, so the separator after the header is kept as is
+                if field_start == 0:
+                    if extension.startswith(" "):
+                        field_start = 1
+                    if field_end < len(extension):
+                        field_end += 1
+                extension = extension[:field_start] + extension[field_end:]
+        return self.line[:self.extension_start] + extension
+
+
+"""
+
+LogContentSinks - A class for handing the decrypted log lines of a file to the enabled sinks, see the sinks package
+
+"""
+
+
+class LogContentSinks:
+
+    def __init__(self, downloader, filename):
+        self.downloader = downloader
+        self.filename = filename
+        self.line_filter = downloader.line_filter
+        self.metrics = downloader.metrics
+        self.sinks = []
+        for name in downloader.sink_names:
+            self.sinks.append(downloader.open_sink(name, filename))
+
+    """
+    Writes a batch of complete log lines, after filtering them
+    """
+    def write(self, lines):
+        if self.line_filter is not None:
+            lines = self.line_filter.filter_lines(lines)
+        self.metrics.inc("logs_downloader_lines_total", (), len(lines))
+        for sink in self.sinks:
+            sink.write(lines)
+
+    """
+    Writes a whole decrypted file content, the content is split to lines once for all the sinks. The content should already be filtered
+    """
+    def write_content(self, content):
+        lines = content.splitlines()
+        self.metrics.inc("logs_downloader_lines_total", (), len(lines))
+        for sink in self.sinks:
+            sink.write_content(content, lines)
+
+    """
+    Completes the handling of the file once all of its lines were written
+    """
+    def close(self):
+        # the file is handled only once all of its lines were delivered to all the sinks
+        for sink in self.sinks:
+            sink.flush()
+        for sink in self.sinks:
+            sink.close()
+
+    """
+    Drops what was written when the handling of the file failed
+    """
+    def abort(self):
+        for sink in self.sinks:
+            sink.abort()
+
+
+"""
+
+CompressionEngine - A class for compressing the handled log files on a pool of worker processes
+
+"""
+
+
+class CompressionEngine:
+
+    def __init__(self, config, logger, metrics, workers):
+        self.logger = logger
+        self.metrics = metrics
+        self.level = config.COMPRESSION_LEVEL
+        self.chunk_size = config.COMPRESSION_CHUNK_SIZE
+        self.pool = None
+        if workers > 0:
+            self.pool = multiprocessing.Pool(workers, initializer=ignore_interrupt_signal)
+            # the files waiting to be compressed - (file path, callback once the file was compressed)
+            self.compression_queue = Queue.Queue(config.COMPRESSION_QUEUE_SIZE)
+            metrics.add_gauge("logs_downloader_queue_depth", (("queue", "compression"),), self.compression_queue.qsize)
+            # each thread hands one file at a time to the worker processes
+            for i in range(workers):
+                compression_thread = threading.Thread(target=self.compress_files, name="compression_thread")
+                compression_thread.daemon = True
+                compression_thread.start()
+
+    """
+    Queues a file for compression, waits if the compression queue is full. Without worker processes the file is compressed right away.
+    If the compression failed, the failure callback is called with a function which queues the file again
+    """
+    def compress(self, infile, callback=None, failure_callback=None):
+        if self.pool is None:
+            self.compress_file(infile, callback, failure_callback)
+        else:
+            self.compression_queue.put((infile, callback, failure_callback))
+
+    """
+    Compresses the queued files, runs on a dedicated thread
+    """
+    def compress_files(self):
+        while True:
+            infile, callback, failure_callback = self.compression_queue.get()
+            self.compress_file(infile, callback, failure_callback)
+
+    """
+    Compresses a file to a temporary file which replaces the source file once it is complete
+    """
+    def compress_file(self, infile, callback, failure_callback=None):
+        out_gz = infile + ".gz"
+        tmp_gz = out_gz + ".tmp"
+        start_time = time.time()
+        try:
+            if self.pool is not None and self.chunk_size > 0 and os.path.getsize(infile) > self.chunk_size:
+                # big files are split to chunks which are compressed in parallel, each chunk is a separate gzip member
+                chunks = [(infile, offset, self.chunk_size, self.level) for offset in range(0, os.path.getsize(infile), self.chunk_size)]
+                with open(tmp_gz, "wb") as gzf:
+                    for member in self.pool.imap(gzip_chunk, chunks):
+                        gzf.write(member)
+                    gzf.flush()
+                    os.fsync(gzf.fileno())
+            elif self.pool is not None:
+                self.pool.apply(gzip_stream, (infile, tmp_gz, self.level))
+            else:
+                gzip_stream(infile, tmp_gz, self.level)
+            os.rename(tmp_gz, out_gz)
+            os.unlink(infile)
+            self.metrics.observe_stage("gzip", time.time() - start_time)
+        except Exception as e:
+            self.logger.error('*** Caught Exception: %s: %s' % (e.__class__,e))
+            if os.path.exists(tmp_gz):
+                os.unlink(tmp_gz)
+            if failure_callback is not None:
+                failure_callback(lambda: self.compress(infile, callback, failure_callback))
+            return
+        if callback is not None:
+            callback(out_gz)
+
+
+"""
+Compresses a file to a gzip file without reading it all to memory, runs on a compression worker process
+"""
+def gzip_stream(infile, out_gz, level):
+    with open(infile, "rb") as in_file:
+        with open(out_gz, "wb") as out_file:
+            gzf = gzip.GzipFile(filename=os.path.basename(infile), mode="wb", compresslevel=level, fileobj=out_file)
+            shutil.copyfileobj(in_file, gzf, 1024 * 1024)
+            gzf.close()
+            out_file.flush()
+            os.fsync(out_file.fileno())
+
+
+"""
+Compresses a chunk of a file to a gzip member, runs on a compression worker process
+"""
+def gzip_chunk(chunk):
+    infile, offset, length, level = chunk
+    with open(infile, "rb") as in_file:
+        in_file.seek(offset)
+        data = in_file.read(length)
+    member = io.BytesIO()
+    gzf = gzip.GzipFile(filename=os.path.basename(infile), mode="wb", compresslevel=level, fileobj=member)
+    gzf.write(data)
+    gzf.close()
+    return member.getvalue()
+
+
+"""
+
+DecodeEngine - A class for decrypting, decompressing and verifying the log file contents, on a pool of worker processes
+so they are not limited to the core of the downloading threads. The contents are passed to and from the workers through
+files in a shared memory folder, instead of being pickled over the pool pipes
+
+"""
+
+
+class DecodeEngine:
+
+    def __init__(self, config, logger, metrics, workers):
+        self.logger = logger
+        self.metrics = metrics
+        self.shared_memory_dir = config.DECODE_SHARED_MEMORY_DIR
+        self.pool = None
+        if workers > 0:
+            self.pool = multiprocessing.Pool(workers, initializer=ignore_interrupt_signal)
+
+    """
+    Decrypts with the symmetric key, uncompresses and verifies the checksum of a log content, returns the decoded content.
+    A content without a symmetric key is only uncompressed, if it is compressed at all
+    """
+    def decode(self, file_log_content, sym_key, checksum, filename):
+        try:
+            if self.pool is None:
+                decoded_content, compressed, timings = decode_log_content(file_log_content, sym_key, checksum)
+            else:
+                decoded_content, compressed, timings = self.decode_on_worker(file_log_content, sym_key, checksum)
+        except Exception as e:
+            self.logger.error("Error while trying to decrypt the file %s - %s", filename, e)
+            raise Exception("Error while trying to decrypt the file " + filename)
+        for stage, duration in timings:
+            self.metrics.observe_stage(stage, duration)
+        if not compressed:
+            self.logger.debug("%s is not compressed, skipping decompression", filename)
+        return decoded_content
+
+    """
+    Hands a log content to a worker process through a shared memory file, and reads the decoded content it wrote to another one
+    """
+    def decode_on_worker(self, file_log_content, sym_key, checksum):
+        segment_fd, segment_path = tempfile.mkstemp(prefix="logs_downloader_decode_", dir=self.shared_memory_dir)
+        decoded_path = segment_path + ".decoded"
+        try:
+            with os.fdopen(segment_fd, "wb") as segment_file:
+                segment_file.write(file_log_content)
+            compressed, timings = self.pool.apply(decode_segment, (segment_path, decoded_path, sym_key, checksum))
+            with open(decoded_path, "rb") as decoded_file:
+                return decoded_file.read(), compressed, timings
+        finally:
+            for path in (segment_path, decoded_path):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+
+"""
+Decodes a log content from a shared memory file to another one, runs on a decode worker process.
+Returns whether the content was compressed and the duration of each stage
+"""
+def decode_segment(segment_path, decoded_path, sym_key, checksum):
+    with open(segment_path, "rb") as segment_file:
+        file_log_content = segment_file.read()
+    decoded_content, compressed, timings = decode_log_content(file_log_content, sym_key, checksum)
+    with open(decoded_path, "wb") as decoded_file:
+        decoded_file.write(decoded_content)
+    return compressed, timings
+
+
+"""
+Decrypts, uncompresses and verifies a log content, see DecodeEngine.decode.
+Returns the decoded content, whether it was compressed and the duration of each stage
+"""
+def decode_log_content(file_log_content, sym_key, checksum):
+    timings = []
+    start_time = time.time()
+    if sym_key is None:
+        try:
+            decoded_content = zlib.decompressobj().decompress(file_log_content)
+        except zlib.error:
+            # the content is not compressed
+            return file_log_content, False, timings
+        timings.append(("decompress", time.time() - start_time))
+        return decoded_content, True, timings
+    # the crypto library is imported only once an encrypted file arrives
+    from Crypto.Cipher import AES
+    compressed_file_content = AES.new(sym_key, AES.MODE_CBC, 16 * b"\x00").decrypt(file_log_content)
+    timings.append(("aes_decrypt", time.time() - start_time))
+    start_time = time.time()
+    decoded_content = zlib.decompressobj().decompress(compressed_file_content)
+    timings.append(("decompress", time.time() - start_time))
+    # we check the content validity by checking the checksum
+    start_time = time.time()
+    content_is_valid = LogsDownloader.validate_checksum(checksum, decoded_content)
+    timings.append(("checksum", time.time() - start_time))
+    if not content_is_valid:
+        raise Exception("Checksum verification failed")
+    return decoded_content, True, timings
+
+
+"""
+Makes a worker process ignore interrupts, the main process handles them
+"""
+def ignore_interrupt_signal():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+"""
+
+LogsFileIndex - A class for managing the logs files index file
+
+"""
+
+
+class LogsFileIndex:
+
+    LOGS_INDEX_FILE_REGEX = re.compile("(\d+_\d+\.log\n)+")
+    LOG_FILE_REGEX = re.compile("(\d+_\d+\.log)")
+    LOG_FILE_NAME_REGEX = re.compile("^(\d+)_(\d+)\.log$")
+
+    def __init__(self, config, logger, downloader):
+        self.config = config
+        self.logger = logger
+        self.file_downloader = downloader
+        # the indexed log file ids - a sorted array of ids per prefix, in the order in which the prefixes appear in the index
+        self.prefixes = []
+        self.ids = {}
+        # the validators of the downloaded logs.index file, used for revalidating it
+        self.etag = None
+        self.last_modified = None
+        self.refresh_time = None
+        self.lock = threading.Lock()
+
+    """
+    Gets the indexed log files
+    """
+    def indexed_logs(self):
+        with self.lock:
+            return [LogsFileIndex.file_name(prefix, log_id) for prefix in self.prefixes for log_id in self.ids[prefix]]
+
+    """
+    Refreshes the logs file index file if it was not refreshed in the last LOGS_INDEX_TTL seconds
+    """
+    def refresh(self):
+        if self.refresh_time is None or time.time() - self.refresh_time >= self.config.LOGS_INDEX_TTL:
+            self.download()
+
+    """
+    Downloads a logs file index file, the download is skipped by the server if the file was not modified
+    """
+    def download(self):
+        self.logger.info("Downloading logs index file...")
+        # try to get the logs.index file
+        file_content, etag, last_modified = self.file_downloader.request_conditional_content(self.config.BASE_URL + "logs.index", self.etag, self.last_modified)
+        # if the file was not modified since the last download
+        if file_content is None:
+            self.logger.debug("logs index file was not modified")
+            self.refresh_time = time.time()
+            return
+        # if we got the file content
+        if file_content != "" and file_content != "404_NOT_FOUND":
+            content = file_content.decode("utf-8")
+            # validate the file format
+            if LogsFileIndex.validate_logs_index_file_format(content):
+                self.load(content)
+                self.etag = etag
+                self.last_modified = last_modified
+                self.refresh_time = time.time()
+            else:
+                self.logger.error("log.index, Pattern Validation Failed")
+                raise Exception
+        else:
+            raise Exception
+
+    """
+    Parses the log file names of the index to sorted arrays of ids
+    """
+    def load(self, content):
+        prefixes = []
+        ids = {}
+        for log_file_name in content.splitlines():
+            match = LogsFileIndex.LOG_FILE_NAME_REGEX.match(log_file_name)
+            if match is None:
+                continue
+            prefix = match.group(1)
+            if prefix not in ids:
+                prefixes.append(prefix)
+                ids[prefix] = []
+            ids[prefix].append(int(match.group(2)))
+        for prefix in prefixes:
+            ids[prefix] = array.array('l', sorted(set(ids[prefix])))
+        with self.lock:
+            self.prefixes = prefixes
+            self.ids = ids
+
+    """
+    Gets the oldest indexed log file id of a prefix, or None if there is none
+    """
+    def oldest(self, prefix):
+        with self.lock:
+            ids = self.ids.get(prefix)
+        return ids[0] if ids else None
+
+    """
+    Gets the newest indexed log file id of a prefix, or None if there is none
+    """
+    def newest(self, prefix):
+        with self.lock:
+            ids = self.ids.get(prefix)
+        return ids[-1] if ids else None
+
+    """
+    Gets the first indexed log file id of a prefix which comes after the given id, or None if there is none
+    """
+    def successor(self, prefix, log_id):
+        with self.lock:
+            ids = self.ids.get(prefix)
+        if not ids:
+            return None
+        position = bisect.bisect_right(ids, log_id)
+        return ids[position] if position < len(ids) else None
+
+    """
+    Gets the indexed log file ids of a prefix from the first id to the last id, both included
+    """
+    def ids_between(self, prefix, first_id, last_id):
+        with self.lock:
+            ids = self.ids.get(prefix)
+        if not ids:
+            return []
+        return ids[bisect.bisect_left(ids, first_id):bisect.bisect_right(ids, last_id)]
+
+    """
+    Checks whether a log file id of a prefix is indexed
+    """
+    def contains(self, prefix, log_id):
+        with self.lock:
+            ids = self.ids.get(prefix)
+        if not ids:
+            return False
+        position = bisect.bisect_left(ids, log_id)
+        return position < len(ids) and ids[position] == log_id
+
+    """
+    Parses a log file name to its prefix and id
+    """
+    @staticmethod
+    def parse_file_name(log_file_name):
+        match = LogsFileIndex.LOG_FILE_NAME_REGEX.match(log_file_name.rstrip("\r\n"))
+        if match is None:
+            raise Exception("Invalid log file name " + log_file_name)
+        return match.group(1), int(match.group(2))
+
+    """
+    Builds a log file name from its prefix and id
+    """
+    @staticmethod
+    def file_name(prefix, log_id):
+        return "%s_%d.log" % (prefix, log_id)
+
+    """
+    Validates that format name of the logs files inside the logs index file
+    """
+    @staticmethod
+    def validate_logs_index_file_format(content):
+        if LogsFileIndex.LOGS_INDEX_FILE_REGEX.match(content):
+            return True
+        return False
+
+    """
+    Validates a log file name format
+    """
+    @staticmethod
+    def validate_log_file_format(content):
+        if LogsFileIndex.LOG_FILE_REGEX.match(content):
+            return True
+        return False
+
+
+"""
+
+Config - A class for reading the configuration file
+
+"""
+
+
+class Config:
+
+    def __init__(self, config_path, logger):
+        self.config_path = config_path
+        self.logger = logger
+
+    """
+    Reads the configuration file
+    """
+    def read(self):
+        config_file = os.path.join(self.config_path, "Settings.Config")
+        if os.path.exists(config_file):
+            config_parser = ConfigParser.ConfigParser()
+            config_parser.read(config_file)
+            config = Config(self.config_path, self.logger)
+            config.API_ID = config_parser.get("SETTINGS", "APIID")
+            config.API_KEY = config_parser.get("SETTINGS", "APIKEY")
+            config.PROCESS_DIR = os.path.join(config_parser.get("SETTINGS", "PROCESS_DIR"), "")
+            config.BASE_URL = os.path.join(config_parser.get("SETTINGS", "BASEURL"), "")
+            config.SAVE_LOCALLY = config_parser.get("SETTINGS", "SAVE_LOCALLY")
+            config.USE_PROXY = config_parser.get("SETTINGS", "USEPROXY")
+            config.PROXY_SERVER = config_parser.get("SETTINGS", "PROXYSERVER")
+            config.SYSLOG_ENABLE = config_parser.get('SETTINGS', 'SYSLOG_ENABLE')
+            config.SYSLOG_ADDRESS = config_parser.get('SETTINGS', 'SYSLOG_ADDRESS')
+            config.SYSLOG_PORT = config_parser.get('SETTINGS', 'SYSLOG_PORT')
+            config.USE_CUSTOM_CA_FILE = config_parser.get('SETTINGS', 'USE_CUSTOM_CA_FILE')
+            config.CUSTOM_CA_FILE = config_parser.get('SETTINGS', 'CUSTOM_CA_FILE')
+            config.SFTP_TRANSFER = config_parser.get('SETTINGS','SFTP_TRANSFER')
+            config.SFTP_HOSTNAME = config_parser.get('SETTINGS','SFTP_HOSTNAME')
+            config.SFTP_PORT = config_parser.get('SETTINGS','SFTP_PORT')
+            config.SFTP_USERNAME = config_parser.get('SETTINGS','SFTP_USERNAME')
+            config.SFTP_PASSWORD = config_parser.get('SETTINGS','SFTP_PASSWORD')
+            config.SFTP_REMOTEDIR = config_parser.get('SETTINGS','SFTP_REMOTEDIR')
+            # optional settings - fall back to defaults when missing from older configuration files
+            config.PREFETCH_WINDOW = int(Config.get_optional(config_parser, 'PREFETCH_WINDOW', '1'))
+            config.HTTP_POOL_SIZE = int(Config.get_optional(config_parser, 'HTTP_POOL_SIZE', '10'))
+            config.STREAMING_MODE = Config.get_optional(config_parser, 'STREAMING_MODE', 'NO')
+            config.STREAM_CHUNK_SIZE = int(Config.get_optional(config_parser, 'STREAM_CHUNK_SIZE', '1048576'))
+            config.KEY_RING_CHECK_INTERVAL = int(Config.get_optional(config_parser, 'KEY_RING_CHECK_INTERVAL', '60'))
+            config.SYMMETRIC_KEY_CACHE_SIZE = int(Config.get_optional(config_parser, 'SYMMETRIC_KEY_CACHE_SIZE', '128'))
+            config.SYSLOG_BATCH_SIZE = int(Config.get_optional(config_parser, 'SYSLOG_BATCH_SIZE', '65536'))
+            config.SYSLOG_MAX_PENDING_BATCHES = int(Config.get_optional(config_parser, 'SYSLOG_MAX_PENDING_BATCHES', '16'))
+            config.SYSLOG_HEALTH_CHECK_INTERVAL = int(Config.get_optional(config_parser, 'SYSLOG_HEALTH_CHECK_INTERVAL', '10'))
+            config.SYSLOG_TIMEOUT = int(Config.get_optional(config_parser, 'SYSLOG_TIMEOUT', '20'))
+            config.SYSLOG_SPILL_DIR = Config.get_optional(config_parser, 'SYSLOG_SPILL_DIR', '')
+            config.SYSLOG_SPILL_MAX_SIZE = int(Config.get_optional(config_parser, 'SYSLOG_SPILL_MAX_SIZE', '1073741824'))
+            config.SYSLOG_SPILL_SEGMENT_SIZE = int(Config.get_optional(config_parser, 'SYSLOG_SPILL_SEGMENT_SIZE', '16777216'))
+            config.SYSLOG_SPILL_REPLAY_RATE = int(Config.get_optional(config_parser, 'SYSLOG_SPILL_REPLAY_RATE', '0'))
+            config.CEF_INCLUDE = Config.get_optional(config_parser, 'CEF_INCLUDE', '')
+            config.CEF_EXCLUDE = Config.get_optional(config_parser, 'CEF_EXCLUDE', '')
+            config.CEF_DROP_FIELDS = Config.get_optional(config_parser, 'CEF_DROP_FIELDS', '')
+            config.HTTP_SINK_ENABLE = Config.get_optional(config_parser, 'HTTP_SINK_ENABLE', 'NO')
+            config.HTTP_SINK_URL = Config.get_optional(config_parser, 'HTTP_SINK_URL', '')
+            config.HTTP_SINK_FORMAT = Config.get_optional(config_parser, 'HTTP_SINK_FORMAT', 'HEC')
+            config.HTTP_SINK_AUTHORIZATION = Config.get_optional(config_parser, 'HTTP_SINK_AUTHORIZATION', '')
+            config.HTTP_SINK_INDEX = Config.get_optional(config_parser, 'HTTP_SINK_INDEX', '')
+            config.HTTP_SINK_CA_FILE = Config.get_optional(config_parser, 'HTTP_SINK_CA_FILE', '')
+            config.HTTP_SINK_CONCURRENCY = int(Config.get_optional(config_parser, 'HTTP_SINK_CONCURRENCY', '4'))
+            config.HTTP_SINK_BATCH_SIZE = int(Config.get_optional(config_parser, 'HTTP_SINK_BATCH_SIZE', '1048576'))
+            config.HTTP_SINK_MIN_BATCH_SIZE = int(Config.get_optional(config_parser, 'HTTP_SINK_MIN_BATCH_SIZE', '65536'))
+            config.HTTP_SINK_MAX_BATCH_SIZE = int(Config.get_optional(config_parser, 'HTTP_SINK_MAX_BATCH_SIZE', '8388608'))
+            config.HTTP_SINK_TARGET_LATENCY = float(Config.get_optional(config_parser, 'HTTP_SINK_TARGET_LATENCY', '1'))
+            config.HTTP_SINK_FLUSH_INTERVAL = float(Config.get_optional(config_parser, 'HTTP_SINK_FLUSH_INTERVAL', '1'))
+            config.HTTP_SINK_COMPRESSION_LEVEL = int(Config.get_optional(config_parser, 'HTTP_SINK_COMPRESSION_LEVEL', '6'))
+            config.HTTP_SINK_RETRIES = int(Config.get_optional(config_parser, 'HTTP_SINK_RETRIES', '5'))
+            config.HTTP_SINK_TIMEOUT = int(Config.get_optional(config_parser, 'HTTP_SINK_TIMEOUT', '30'))
+            config.SFTP_UPLOAD_COMPRESSED = Config.get_optional(config_parser, 'SFTP_UPLOAD_COMPRESSED', 'NO')
+            config.SFTP_CONCURRENCY = int(Config.get_optional(config_parser, 'SFTP_CONCURRENCY', '4'))
+            config.SFTP_QUEUE_SIZE = int(Config.get_optional(config_parser, 'SFTP_QUEUE_SIZE', '100'))
+            config.SFTP_RETRIES = int(Config.get_optional(config_parser, 'SFTP_RETRIES', '3'))
+            config.COMPRESSION_WORKERS = int(Config.get_optional(config_parser, 'COMPRESSION_WORKERS', str(multiprocessing.cpu_count())))
+            config.COMPRESSION_LEVEL = int(Config.get_optional(config_parser, 'COMPRESSION_LEVEL', '9'))
+            config.COMPRESSION_CHUNK_SIZE = int(Config.get_optional(config_parser, 'COMPRESSION_CHUNK_SIZE', '0'))
+            config.COMPRESSION_QUEUE_SIZE = int(Config.get_optional(config_parser, 'COMPRESSION_QUEUE_SIZE', '100'))
+            config.LOCAL_WRITE_BUFFER_SIZE = int(Config.get_optional(config_parser, 'LOCAL_WRITE_BUFFER_SIZE', '1048576'))
+            config.LOCAL_WRITE_COMPRESSED = Config.get_optional(config_parser, 'LOCAL_WRITE_COMPRESSED', 'NO')
+            config.LOCAL_FSYNC = Config.get_optional(config_parser, 'LOCAL_FSYNC', 'NO')
+            config.LOCAL_ARCHIVE = Config.get_optional(config_parser, 'LOCAL_ARCHIVE', 'NO')
+            config.LOCAL_ARCHIVE_BLOCK_SIZE = int(Config.get_optional(config_parser, 'LOCAL_ARCHIVE_BLOCK_SIZE', '1048576'))
+            config.LOGS_INDEX_TTL = int(Config.get_optional(config_parser, 'LOGS_INDEX_TTL', '10'))
+            config.POLL_MIN_DELAY = float(Config.get_optional(config_parser, 'POLL_MIN_DELAY', '1'))
+            config.POLL_MAX_DELAY = float(Config.get_optional(config_parser, 'POLL_MAX_DELAY', '60'))
+            config.API_RATE_LIMIT = float(Config.get_optional(config_parser, 'API_RATE_LIMIT', '0'))
+            config.API_RATE_BURST = int(Config.get_optional(config_parser, 'API_RATE_BURST', '10'))
+            config.CHECKPOINT_EVERY_FILES = int(Config.get_optional(config_parser, 'CHECKPOINT_EVERY_FILES', '1'))
+            config.CHECKPOINT_INTERVAL = int(Config.get_optional(config_parser, 'CHECKPOINT_INTERVAL', '0'))
+            config.DOWNLOAD_CONCURRENCY = int(Config.get_optional(config_parser, 'DOWNLOAD_CONCURRENCY', '0'))
+            config.METRICS_PORT = int(Config.get_optional(config_parser, 'METRICS_PORT', '0'))
+            config.METRICS_ADDRESS = Config.get_optional(config_parser, 'METRICS_ADDRESS', '127.0.0.1')
+            config.PIPELINE_MODE = Config.get_optional(config_parser, 'PIPELINE_MODE', 'NO')
+            config.PIPELINE_QUEUE_SIZE = int(Config.get_optional(config_parser, 'PIPELINE_QUEUE_SIZE', '10'))
+            config.PIPELINE_DECODE_WORKERS = int(Config.get_optional(config_parser, 'PIPELINE_DECODE_WORKERS', '2'))
+            config.PIPELINE_SYSLOG_WORKERS = int(Config.get_optional(config_parser, 'PIPELINE_SYSLOG_WORKERS', '1'))
+            config.PIPELINE_LOCAL_WORKERS = int(Config.get_optional(config_parser, 'PIPELINE_LOCAL_WORKERS', '2'))
+            config.PIPELINE_HTTP_WORKERS = int(Config.get_optional(config_parser, 'PIPELINE_HTTP_WORKERS', '1'))
+            config.PIPELINE_RETRY_INTERVAL = int(Config.get_optional(config_parser, 'PIPELINE_RETRY_INTERVAL', '10'))
+            config.BACKFILL_WORKERS = int(Config.get_optional(config_parser, 'BACKFILL_WORKERS', str(multiprocessing.cpu_count())))
+            config.BACKFILL_SHARD_SIZE = int(Config.get_optional(config_parser, 'BACKFILL_SHARD_SIZE', '10'))
+            config.PROCESSED_FILES_LEDGER = Config.get_optional(config_parser, 'PROCESSED_FILES_LEDGER', 'YES')
+            config.GAP_REPAIR = Config.get_optional(config_parser, 'GAP_REPAIR', 'YES')
+            config.GAP_CHECK_INTERVAL = int(Config.get_optional(config_parser, 'GAP_CHECK_INTERVAL', '60'))
+            config.GAP_RETRY_MAX_DELAY = int(Config.get_optional(config_parser, 'GAP_RETRY_MAX_DELAY', '3600'))
+            config.DECODE_WORKERS = int(Config.get_optional(config_parser, 'DECODE_WORKERS', '0'))
+            config.DECODE_SHARED_MEMORY_DIR = Config.get_optional(config_parser, 'DECODE_SHARED_MEMORY_DIR',
+                                                                  "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+
+            return config
+        else:
+            self.logger.error("Could Not find configuration file %s", config_file)
+            raise Exception("Could Not find configuration file")
+
+    """
+    Reads an optional setting, returns the default value if it is not set
+    """
+    @staticmethod
+    def get_optional(config_parser, option, default):
+        if config_parser.has_option("SETTINGS", option):
+            value = config_parser.get("SETTINGS", option)
+            if value != "":
+                return value
+        return default
+
+
+"""
+
+FileDownloader - A class for downloading files
+
+"""
+
+
+class FileDownloader:
+
+    def __init__(self, config, logger, adapter=None, metrics=None):
+        self.config = config
+        self.logger = logger
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.session = FileDownloader.create_session(config, adapter)
+        # limits the rate of requests to the API, shared by all the downloading threads
+        self.rate_limiter = TokenBucket(config.API_RATE_LIMIT, config.API_RATE_BURST)
+
+    """
+    Creates a connection pooled HTTP session which is shared by all the downloads.
+    The connections are kept alive between requests, so we do not pay a TCP and TLS handshake per file.
+    The connection pool can be shared with the sessions of other accounts
+    """
+    @staticmethod
+    def create_session(config, adapter=None):
+        session = requests.Session()
+        if adapter is None:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=config.HTTP_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        base64creds = base64.encodestring('%s:%s' % (config.API_ID, config.API_KEY)).replace('\n', '')
+        session.headers.update({"Authorization": "Basic %s" % base64creds})
+        if config.USE_PROXY == "YES":
+            session.proxies = {'http': config.PROXY_SERVER, 'https': config.PROXY_SERVER}
+        if config.USE_CUSTOM_CA_FILE == "YES":
+            session.verify = config.CUSTOM_CA_FILE
+        else:
+            session.verify = False
+        return session
+
+    """
+    Sends a GET request to a destination URL using the shared session
+    """
+    def get(self, url, timeout=20, stream=False, headers=None):
+        self.rate_limiter.acquire()
+        try:
+            response = self.session.get(url, timeout=timeout, stream=stream, headers=headers)
+        except Exception:
+            self.metrics.inc("logs_downloader_http_responses_total", (("status", "error"),))
+            raise
+        self.metrics.inc("logs_downloader_http_responses_total", (("status", str(response.status_code)),))
+        return response
+
+    """
+    A method for getting a destination URL file content only if it was modified since it was last downloaded.
+    Returns the content, or None if it was not modified, together with the validators of the content
+    """
+    def request_conditional_content(self, url, etag, last_modified, timeout=20):
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+        try:
+            response = self.get(url, timeout=timeout, headers=headers)
+            # if the content was not modified
+            if response.status_code == 304:
+                response.close()
+                return None, etag, last_modified
+            # raise status for any exceptions
+            response.raise_for_status()
+            self.logger.info("Successfully downloaded file from URL %s" % url)
+            return response.content, response.headers.get("ETag"), response.headers.get("Last-Modified")
+        # if we got a 401 or 404 responses
+        except requests.HTTPError as e:
+            return self.handle_http_error(url, e), None, None
+        # unexpected exception occurred
+        except Exception:
+            self.logger.error("An error has occur while making a open connection to %s. %s", url, traceback.format_exc())
+            raise Exception("Connection error")
+
+    """
+    A method for getting a destination URL file content.
+    When streaming, the response is returned so that the caller can read its content in chunks and close it
+    """
+    def request_file_content(self, url, timeout=20, stream=False):
+        # default value
+        response_content = ""
+        try:
+            # open the connection to the URL
+            response = self.get(url, timeout=timeout, stream=stream)
+            # raise status for any exceptions
+            response.raise_for_status()
+            # if we got a 200 OK response
+            if response.status_code == 200 and stream:
+                self.logger.info("Streaming file from URL %s" % url)
+                return response
+            elif response.status_code == 200:
                 self.logger.info("Successfully downloaded file from URL %s" % url)
-                # read the response content
+                # read the response content, the connection is released back to the pool once the content is consumed
                 response_content = response.content
-                response.connection.close()
                 return response_content
             # if we got another response code
             else:
                 self.logger.info("Failed to download file %s. Response code was %s.", url, response.status_code)
                 self.logger.debug("Content of Response was: %s", response.content)
-                response.connection.close()
+                response.close()
         # if we got a 401 or 404 responses
         except requests.HTTPError as e:
-            if e.response.status_code == 404:
-                self.logger.error("Could not find file %s. Response code is %s", url, e.response.status_code)
-                # return response_content
-                # response_content = "404_NOT_FOUND"
-                return "404_NOT_FOUND"
-            elif e.response.status_code == 401:
-                self.logger.error("Authorization error - Failed to download file %s. Response code is %s", url, e.response.status_code)
-                raise Exception("Authorization error")
-            elif e.response.status_code == 429:
-                self.logger.error("Rate limit exceeded - Failed to download file %s. Response code is %s", url, e.response.status_code)
-                raise Exception("Rate limit error")
-            else:
-                self.logger.error("An error has occur while making a open connection to %s. %s", url, str(e.response.status_code))
-                raise Exception("Connection error")
+            return self.handle_http_error(url, e)
         # unexpected exception occurred
         except Exception:
             self.logger.error("An error has occur while making a open connection to %s. %s", url, traceback.format_exc())
             raise Exception("Connection error")
 
+    """
+    Handles an error response, returns "404_NOT_FOUND" if the file was not found and raises an exception otherwise
+    """
+    def handle_http_error(self, url, e):
+        # the short error body of a streamed response is read, so its keep-alive connection goes back to the pool instead of being dropped
+        try:
+            e.response.content
+        except Exception:
+            pass
+        e.response.close()
+        if e.response.status_code == 404:
+            self.logger.error("Could not find file %s. Response code is %s", url, e.response.status_code)
+            return "404_NOT_FOUND"
+        elif e.response.status_code == 401:
+            self.logger.error("Authorization error - Failed to download file %s. Response code is %s", url, e.response.status_code)
+            raise Exception("Authorization error")
+        elif e.response.status_code == 429:
+            self.logger.error("Rate limit exceeded - Failed to download file %s. Response code is %s", url, e.response.status_code)
+            retry_after = FileDownloader.parse_retry_after(e.response.headers.get("Retry-After"))
+            # hold all the requests to the API until the server allows them again
+            if retry_after is not None:
+                self.rate_limiter.pause(retry_after)
+            raise RateLimitError("Rate limit error", retry_after)
+        else:
+            self.logger.error("An error has occur while making a open connection to %s. %s", url, str(e.response.status_code))
+            raise Exception("Connection error")
+
+    """
+    Parses a Retry-After header, which is either a number of seconds or a date, to a number of seconds
+    """
+    @staticmethod
+    def parse_retry_after(retry_after):
+        if retry_after is None:
+            return None
+        try:
+            return max(0, int(retry_after))
+        except ValueError:
+            retry_date = email.utils.parsedate_tz(retry_after)
+            if retry_date is None:
+                return None
+            return max(0, email.utils.mktime_tz(retry_date) - time.time())
+
+
+"""
+
+RateLimitError - An error for a request which was rejected by the API due to rate limiting
+
+"""
+
+
+class RateLimitError(Exception):
+
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        # the number of seconds to wait before the next request, None if the server did not say
+        self.retry_after = retry_after
+
 
 if __name__ == "__main__":
     # default paths
     path_to_config_folder = "/etc/incapsula/logs/config"
+    paths_to_config_folders = []
     path_to_system_logs_folder = "/var/log/incapsula/logsDownloader/"
     # default log level
     system_logs_level = "INFO"
+    # default engine
+    engine = "threads"
+    # the backfill command downloads an explicit range of log files, without touching the last known downloaded file id
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill":
+        first_file = None
+        last_file = None
+        backfill_workers = None
+        try:
+            opts, args = getopt.getopt(sys.argv[2:], 'c:l:v:w:h', ['from=', 'to=', 'configpath=', 'logpath=', 'loglevel=', 'workers=', 'help'])
+        except getopt.GetoptError:
+            print ("Error starting the backfill. The following arguments should be provided:" \
+                  " \n '--from' - the first log file id of the range, for example 123_1000" \
+                  " \n '--to' - the last log file id of the range, for example 123_5000" \
+                  " \n '-c' - path to the config folder" \
+                  " \n '-l' - path to the system logs folder" \
+                  " \n '-v' - LogsDownloader system logs level" \
+                  " \n '-w' - the number of worker processes")
+            sys.exit(2)
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                print ('LogsDownloader.py backfill --from <first_log_file_id> --to <last_log_file_id> -c <path_to_config_folder> -l <path_to_system_logs_folder> -v <system_logs_level> -w <workers>')
+                sys.exit(2)
+            elif opt == '--from':
+                first_file = arg
+            elif opt == '--to':
+                last_file = arg
+            elif opt in ('-c', '--configpath'):
+                path_to_config_folder = arg
+            elif opt in ('-l', '--logpath'):
+                path_to_system_logs_folder = arg
+            elif opt in ('-v', '--loglevel'):
+                system_logs_level = arg.upper()
+                if system_logs_level not in ["DEBUG", "INFO", "ERROR"]:
+                    sys.exit("Provided system logs level is not supported. Supported levels are DEBUG, INFO and ERROR")
+            elif opt in ('-w', '--workers'):
+                backfill_workers = int(arg)
+        if first_file is None or last_file is None:
+            sys.exit("The backfill command requires the --from and --to log file ids")
+        try:
+            backfill = Backfill(path_to_config_folder, path_to_system_logs_folder, system_logs_level, first_file, last_file, backfill_workers)
+        except Exception as e:
+            sys.exit("Error starting the backfill - %s" % e)
+        signal.signal(signal.SIGTERM, backfill.set_signal_handling)
+        signal.signal(signal.SIGINT, backfill.set_signal_handling)
+        failed_files = backfill.run()
+        if failed_files:
+            sys.exit("Failed to backfill %s files, run the same command again to retry them - %s" % (len(failed_files), ", ".join(failed_files)))
+        sys.exit(0)
+    # the query command prints the log lines of a time window from the local archive files, see LOCAL_ARCHIVE
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        start_time = None
+        end_time = None
+        site_id = None
+        output_path = None
+        try:
+            opts, args = getopt.getopt(sys.argv[2:], 'c:l:o:h', ['from=', 'to=', 'site=', 'configpath=', 'logpath=', 'output=', 'help'])
+        except getopt.GetoptError:
+            print ("Error starting the query. The following arguments should be provided:" \
+                  " \n '--from' - the start of the time window, in seconds since the epoch or a UTC time such as 2020-01-31T13:45:00" \
+                  " \n '--to' - the end of the time window, in the same format" \
+                  " \n '--site' - only the log lines of this site id" \
+                  " \n '-c' - path to the config folder" \
+                  " \n '-l' - path to the system logs folder" \
+                  " \n '-o' - the file which gets the log lines, instead of the standard output")
+            sys.exit(2)
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                print ('LogsDownloader.py query --from <time> --to <time> --site <site_id> -c <path_to_config_folder> -l <path_to_system_logs_folder> -o <output_file>')
+                sys.exit(2)
+            elif opt in ('--from', '--to'):
+                try:
+                    if opt == '--from':
+                        start_time = ArchiveQuery.parse_time(arg)
+                    else:
+                        end_time = ArchiveQuery.parse_time(arg)
+                except Exception as e:
+                    sys.exit(str(e))
+            elif opt == '--site':
+                site_id = int(arg)
+            elif opt in ('-c', '--configpath'):
+                path_to_config_folder = arg
+            elif opt in ('-l', '--logpath'):
+                path_to_system_logs_folder = arg
+            elif opt in ('-o', '--output'):
+                output_path = arg
+        if start_time is None or end_time is None:
+            sys.exit("The query command requires the --from and --to times")
+        try:
+            config = Config(path_to_config_folder, LogsDownloader.create_logger(path_to_system_logs_folder, system_logs_level)).read()
+        except Exception as e:
+            sys.exit("Error starting the query - %s" % e)
+        query = ArchiveQuery(config.PROCESS_DIR, start_time, end_time, site_id)
+        # the log lines are written as they were downloaded, without decoding them
+        out_file = open(output_path, "wb") if output_path is not None else getattr(sys.stdout, "buffer", sys.stdout)
+        try:
+            read_files, read_blocks, written_lines = query.run(out_file)
+        finally:
+            out_file.flush()
+            if output_path is not None:
+                out_file.close()
+        sys.stderr.write("Found %s log lines in %s blocks of %s archive files\n" % (written_lines, read_blocks, read_files))
+        sys.exit(0)
     # read arguments
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'c:l:v:h', ['configpath=', 'logpath=', 'loglevel=', 'help'])
+        opts, args = getopt.getopt(sys.argv[1:], 'c:l:v:e:h', ['configpath=', 'logpath=', 'loglevel=', 'engine=', 'help'])
     except getopt.GetoptError:
         print ("Error starting Logs Downloader. The following arguments should be provided:" \
-              " \n '-c' - path to the config folder" \
+              " \n '-c' - path to the config folder, can be given a few times to run a few accounts" \
               " \n '-l' - path to the system logs folder" \
               " \n '-v' - LogsDownloader system logs level" \
+              " \n '-e' - the engine which runs the downloaders, threads or asyncio" \
               " \n Or no arguments at all in order to use default paths")
         sys.exit(2)
     for opt, arg in opts:
         if opt in ('-h', '--help'):
-            print ('LogsDownloader.py -c <path_to_config_folder> -l <path_to_system_logs_folder> -v <system_logs_level>')
+            print ('LogsDownloader.py -c <path_to_config_folder> [-c <path_to_config_folder> ...] -l <path_to_system_logs_folder> -v <system_logs_level> -e <engine>')
             sys.exit(2)
         elif opt in ('-c', '--configpath'):
-            path_to_config_folder = arg
+            paths_to_config_folders.append(arg)
         elif opt in ('-l', '--logpath'):
             path_to_system_logs_folder = arg
         elif opt in ('-v', '--loglevel'):
             system_logs_level = arg.upper()
             if system_logs_level not in ["DEBUG", "INFO", "ERROR"]:
                 sys.exit("Provided system logs level is not supported. Supported levels are DEBUG, INFO and ERROR")
-    # init the LogsDownloader
-    logsDownloader = LogsDownloader(path_to_config_folder, path_to_system_logs_folder, system_logs_level)
+        elif opt in ('-e', '--engine'):
+            engine = arg.lower()
+            if engine not in ["threads", "asyncio"]:
+                sys.exit("Provided engine is not supported. Supported engines are threads and asyncio")
+    if not paths_to_config_folders:
+        paths_to_config_folders.append(path_to_config_folder)
+    # the asyncio engine is imported only when it is used, since it requires Python 3
+    if engine == "asyncio":
+        if sys.version_info < (3, 7):
+            sys.exit("The asyncio engine requires Python 3.7 or newer")
+        import AsyncioEngine
+        sys.exit(AsyncioEngine.run(paths_to_config_folders, path_to_system_logs_folder, system_logs_level))
+    # init a LogsDownloader for each config folder
+    shared_resources = SharedResources(len(paths_to_config_folders) > 1)
+    logsDownloaders = [LogsDownloader(path, path_to_system_logs_folder, system_logs_level, shared_resources) for path in paths_to_config_folders]
+
+    # handle a process termination by stopping all the downloaders
+    def set_signal_handling(sig, frame):
+        for downloader in logsDownloaders:
+            downloader.set_signal_handling(sig, frame)
     # set a handler for process termination
-    signal.signal(signal.SIGTERM, logsDownloader.set_signal_handling)
-    signal.signal(signal.SIGINT, logsDownloader.set_signal_handling)
+    signal.signal(signal.SIGTERM, set_signal_handling)
+    signal.signal(signal.SIGINT, set_signal_handling)
     try:
-        # start a dedicated thread that will run the LogsDownloader logs fetching logic
-        process_thread = threading.Thread(target=logsDownloader.get_log_files, name="process_thread")
-        # start the thread
-        process_thread.start()
-        while logsDownloader.running:
+        # start a dedicated thread for each downloader that will run the LogsDownloader logs fetching logic
+        process_threads = [threading.Thread(target=downloader.get_log_files, name="process_thread") for downloader in logsDownloaders]
+        # start the threads
+        for process_thread in process_threads:
+            process_thread.start()
+        while any(downloader.running for downloader in logsDownloaders):
             time.sleep(1)
-        process_thread.join(1)
+        for process_thread in process_threads:
+            process_thread.join(1)
     except Exception:
         sys.exit("Error starting Logs Downloader - %s" % traceback.format_exc())
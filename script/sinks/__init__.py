@@ -0,0 +1,77 @@
+"""
+
+The sink registry - each sink is a plugin module which gets the decrypted log lines of a file
+
+A plugin module is imported only when the setting which enables it is YES, so a process which only writes local
+files never loads the syslog or SFTP code and their dependencies. A plugin module has a create_sink(downloader, filename)
+function, which returns a Sink for a single log file. The plugin modules must not import LogsDownloader, they get
+the downloader and its config, logger and metrics as arguments
+
+"""
+
+import importlib
+from collections import OrderedDict
+
+# the plugin modules by sink name - (the setting which enables the sink, the module), in the order the sinks get the lines
+REGISTRY = OrderedDict([
+    ("syslog", ("SYSLOG_ENABLE", "sinks.syslog_sink")),
+    ("local", ("SAVE_LOCALLY", "sinks.local_sink")),
+    ("http", ("HTTP_SINK_ENABLE", "sinks.http_sink")),
+])
+
+
+"""
+Gets the names of the sinks which are enabled by the config
+"""
+def enabled_sinks(config):
+    return [name for name, (setting, module_name) in REGISTRY.items() if getattr(config, setting, "NO") == "YES"]
+
+
+"""
+Imports the plugin module of a sink
+"""
+def load(name):
+    if name not in REGISTRY:
+        raise Exception("Unknown sink %s" % name)
+    return importlib.import_module(REGISTRY[name][1])
+
+
+"""
+
+Sink - The interface of the sinks, a sink object gets the lines of a single log file
+
+"""
+
+
+class Sink:
+
+    """
+    Writes a batch of complete log lines, each sink overrides it
+    """
+    def write(self, lines):
+        pass
+
+    """
+    Writes a whole decrypted file content, the lines of the content are given when they were already split
+    """
+    def write_content(self, content, lines=None):
+        self.write(lines if lines is not None else content.splitlines())
+
+    """
+    Completes the delivery of the lines which were written, raises an exception if they could not be delivered
+    """
+    def flush(self):
+        pass
+
+    """
+    Starts the background work of the file once it was delivered, such as compressing and uploading the local file.
+    The uploaded callback and the failure callback are described in LogsDownloader.transfer_local_file
+    """
+    def close(self, uploaded_callback=None, failure_callback=None):
+        pass
+
+    """
+    Drops what was written when the handling of the file failed
+    """
+    def abort(self):
+        pass
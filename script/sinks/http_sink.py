@@ -0,0 +1,353 @@
+"""
+
+The HTTP sink - sends the log lines to an HTTP ingest endpoint, such as the Splunk HTTP Event Collector or the Elasticsearch
+_bulk API, in gzip compressed batches over a pool of keep-alive connections, which is shared by the files of an account
+
+"""
+
+import email.utils
+import json
+import threading
+import time
+import zlib
+
+import requests
+import requests.adapters
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+from sinks import Sink
+
+
+"""
+Creates the sink of a log file, the lines are sent by the bulk client of the downloader
+"""
+def create_sink(downloader, filename):
+    return HttpSink(downloader.http_bulk_client)
+
+
+"""
+
+HttpSink - A class for sending the lines of a log file to the HTTP collector
+
+"""
+
+
+class HttpSink(Sink):
+
+    def __init__(self, client):
+        self.client = client
+        self.delivery = HttpDelivery()
+
+    """
+    Sends a batch of complete log lines
+    """
+    def write(self, lines):
+        self.client.emit(lines, self.delivery)
+
+    """
+    Waits until all the lines were sent, the file is handled only once they were
+    """
+    def flush(self):
+        self.client.flush(self.delivery)
+        if self.delivery.failed_batches > 0:
+            raise Exception("Some of the log lines were not accepted by the HTTP collector")
+
+
+"""
+
+HttpDelivery - A class for tracking the events of a single sender of the bulk client, such as the sink of a log file.
+A batch holds the events of a few senders, so a sender waits only for the batches with its events, and fails only when its own events were not accepted
+
+"""
+
+
+class HttpDelivery:
+
+    def __init__(self):
+        # the batches with events of the sender which were not sent yet, and the batches in which some of its events were not accepted
+        self.outstanding_batches = 0
+        self.failed_batches = 0
+
+
+"""
+
+HttpBulkClient - A class for batching log lines into bulk requests and sending them with a few requests in flight.
+The batch size grows while the collector answers quickly and shrinks when it is slow or asks to slow down
+
+"""
+
+
+class HttpBulkClient:
+
+    # the statuses which mean that the collector is busy, the batch is sent again later
+    BUSY_STATUS_CODES = (429, 503)
+    MAX_RETRY_DELAY = 30
+
+    def __init__(self, config, logger, metrics):
+        self.logger = logger
+        self.metrics = metrics
+        self.url = config.HTTP_SINK_URL
+        self.format = config.HTTP_SINK_FORMAT.upper()
+        if self.format not in ("HEC", "BULK"):
+            raise Exception("HTTP_SINK_FORMAT must be HEC or BULK")
+        self.index = config.HTTP_SINK_INDEX
+        # the _bulk action line which comes before each event
+        if self.index != "":
+            self.bulk_action = json.dumps({"index": {"_index": self.index}})
+        else:
+            self.bulk_action = json.dumps({"index": {}})
+        self.min_batch_size = config.HTTP_SINK_MIN_BATCH_SIZE
+        self.max_batch_size = max(config.HTTP_SINK_MAX_BATCH_SIZE, self.min_batch_size)
+        self.batch_size = min(max(config.HTTP_SINK_BATCH_SIZE, self.min_batch_size), self.max_batch_size)
+        self.target_latency = config.HTTP_SINK_TARGET_LATENCY
+        self.flush_interval = config.HTTP_SINK_FLUSH_INTERVAL
+        self.retries = config.HTTP_SINK_RETRIES
+        self.timeout = config.HTTP_SINK_TIMEOUT
+        self.compression_level = config.HTTP_SINK_COMPRESSION_LEVEL
+        # the connections are kept open across requests, a connection for each request in flight
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=config.HTTP_SINK_CONCURRENCY)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Content-Type"] = "application/json" if self.format == "HEC" else "application/x-ndjson"
+        if config.HTTP_SINK_AUTHORIZATION != "":
+            self.session.headers["Authorization"] = config.HTTP_SINK_AUTHORIZATION
+        if self.compression_level > 0:
+            self.session.headers["Content-Encoding"] = "gzip"
+        if config.HTTP_SINK_CA_FILE != "":
+            self.session.verify = config.HTTP_SINK_CA_FILE
+        # guards the pending lines and the batch counters, and is notified whenever a batch is done
+        self.condition = threading.Condition()
+        # the encoded events which were not cut to a batch yet with the delivery of each of them, and when the oldest of them was added
+        self.pending = []
+        self.pending_deliveries = []
+        self.pending_size = 0
+        self.pending_since = None
+        self.send_queue = Queue.Queue(config.HTTP_SINK_CONCURRENCY)
+        gauge_labels = (("url", self.url), ("index", self.index))
+        metrics.add_gauge("logs_downloader_queue_depth", (("queue", "http_sink"),) + gauge_labels, self.send_queue.qsize)
+        metrics.add_gauge("logs_downloader_http_sink_batch_bytes", gauge_labels, lambda: self.batch_size)
+        for i in range(config.HTTP_SINK_CONCURRENCY):
+            send_thread = threading.Thread(target=self.send_batches, name="http_sink_send_thread")
+            send_thread.daemon = True
+            send_thread.start()
+        flush_thread = threading.Thread(target=self.send_aged_batches, name="http_sink_flush_thread")
+        flush_thread.daemon = True
+        flush_thread.start()
+
+    """
+    Encodes a log line as an event of the collector format
+    """
+    def encode(self, line):
+        if isinstance(line, bytes):
+            # the bytes which are not valid UTF-8 are replaced, JSON strings are unicode
+            line = line.decode("utf-8", "replace")
+        if self.format == "HEC":
+            event = {"event": line}
+            if self.index != "":
+                event["index"] = self.index
+            return (json.dumps(event) + "\n").encode("utf-8")
+        return (self.bulk_action + "\n" + json.dumps({"message": line}) + "\n").encode("utf-8")
+
+    """
+    Adds log lines to the pending batch, and queues the batches which reached the batch size. Waits while all the senders are busy
+    """
+    def emit(self, lines, delivery):
+        events = [self.encode(line) for line in lines if line]
+        batches = []
+        with self.condition:
+            for event in events:
+                if not self.pending:
+                    self.pending_since = time.time()
+                self.pending.append(event)
+                self.pending_deliveries.append(delivery)
+                self.pending_size += len(event)
+                if self.pending_size >= self.batch_size:
+                    batches.append(self.cut_batch())
+        for batch in batches:
+            self.send_queue.put(batch)
+
+    """
+    Takes the pending events as a batch of (events, deliveries), must be called while holding the condition
+    """
+    def cut_batch(self):
+        batch = (self.pending, self.pending_deliveries)
+        self.pending = []
+        self.pending_deliveries = []
+        self.pending_size = 0
+        self.pending_since = None
+        for delivery in set(batch[1]):
+            delivery.outstanding_batches += 1
+        return batch
+
+    """
+    Sends the pending events and waits until all the batches with events of the delivery were sent or failed
+    """
+    def flush(self, delivery):
+        batch = None
+        with self.condition:
+            if delivery in self.pending_deliveries:
+                batch = self.cut_batch()
+        if batch is not None:
+            self.send_queue.put(batch)
+        with self.condition:
+            while delivery.outstanding_batches > 0:
+                self.condition.wait(1)
+
+    """
+    Sends the pending events once the oldest of them waited for the flush interval, runs on a dedicated thread
+    """
+    def send_aged_batches(self):
+        while True:
+            time.sleep(max(0.05, self.flush_interval / 4.0))
+            batch = None
+            with self.condition:
+                if self.pending and time.time() - self.pending_since >= self.flush_interval:
+                    batch = self.cut_batch()
+            if batch is not None:
+                self.send_queue.put(batch)
+
+    """
+    Sends the queued batches, runs on a few dedicated threads so a few requests are in flight
+    """
+    def send_batches(self):
+        while True:
+            events, deliveries = self.send_queue.get()
+            failed_deliveries = self.send(events, deliveries)
+            with self.condition:
+                for delivery in set(deliveries):
+                    delivery.outstanding_batches -= 1
+                for delivery in failed_deliveries:
+                    delivery.failed_batches += 1
+                self.condition.notify_all()
+
+    """
+    Sends a batch, retrying while the collector is busy or cannot be reached. Returns the deliveries of the events which were not accepted
+    """
+    def send(self, events, deliveries):
+        failed_deliveries = set()
+        attempt = 1
+        while True:
+            retry_after = None
+            try:
+                throttled_positions, rejected_positions = self.post(events)
+                # only the senders of the rejected events of a _bulk request fail
+                if rejected_positions:
+                    self.logger.error("The HTTP collector rejected %d events of a batch of %d events", len(rejected_positions), len(events))
+                    failed_deliveries.update(deliveries[position] for position in rejected_positions)
+                if not throttled_positions:
+                    return failed_deliveries
+                # the attempts are counted again while the collector accepts some of the events
+                if len(throttled_positions) < len(events):
+                    attempt = 1
+                events = [events[position] for position in throttled_positions]
+                deliveries = [deliveries[position] for position in throttled_positions]
+                error = "%d events were throttled" % len(events)
+            except CollectorRejectedError as e:
+                self.logger.error("The HTTP collector rejected a batch of %d events - %s", len(events), e)
+                return failed_deliveries.union(deliveries)
+            except CollectorBusyError as e:
+                retry_after = e.retry_after
+                error = e
+                self.shrink_batch_size()
+            except Exception as e:
+                error = "%s: %s" % (e.__class__, e)
+            if attempt > self.retries:
+                self.logger.error("Failed to send a batch of %d events to the HTTP collector after %d attempts - %s", len(events), attempt, error)
+                return failed_deliveries.union(deliveries)
+            delay = retry_after if retry_after is not None else min(self.MAX_RETRY_DELAY, 2 ** (attempt - 1))
+            self.logger.warning("Failed to send a batch of %d events to the HTTP collector, attempt %d out of %d, retrying in %s seconds - %s",
+                                len(events), attempt, self.retries + 1, delay, error)
+            self.metrics.inc("logs_downloader_retries_total")
+            time.sleep(delay)
+            attempt += 1
+
+    """
+    Posts a batch, compressed if enabled, and adapts the batch size to the latency of the collector.
+    Returns the positions of the events which should be sent again and the positions of the events which were rejected,
+    only the events of a _bulk request are throttled or rejected one by one
+    """
+    def post(self, events):
+        content = b"".join(events)
+        body = content
+        if self.compression_level > 0:
+            compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(content) + compressor.flush()
+        start_time = time.time()
+        with self.metrics.time("http_sink"):
+            response = self.session.post(self.url, data=body, timeout=self.timeout)
+        latency = time.time() - start_time
+        self.metrics.inc("logs_downloader_http_sink_responses_total", (("code", str(response.status_code)),))
+        if response.status_code in self.BUSY_STATUS_CODES:
+            raise CollectorBusyError("The HTTP collector answered %s" % response.status_code, HttpBulkClient.parse_retry_after(response.headers.get("Retry-After")))
+        if not 200 <= response.status_code < 300:
+            raise CollectorRejectedError("The HTTP collector answered %s - %s" % (response.status_code, response.text[:200]))
+        self.metrics.inc("logs_downloader_bytes_total", (("stage", "http_sink"),), len(body))
+        self.adapt_batch_size(len(content), latency)
+        if self.format == "BULK":
+            return self.get_failed_positions(events, response)
+        return [], []
+
+    """
+    Gets the positions of the events of a _bulk request which were throttled and of the events which were rejected
+    """
+    def get_failed_positions(self, events, response):
+        result = response.json()
+        throttled_positions = []
+        rejected_positions = []
+        if not result.get("errors"):
+            return throttled_positions, rejected_positions
+        for position, item in enumerate(result.get("items", [])[:len(events)]):
+            status = list(item.values())[0].get("status", 200)
+            if status in self.BUSY_STATUS_CODES:
+                throttled_positions.append(position)
+            elif not 200 <= status < 300:
+                rejected_positions.append(position)
+        return throttled_positions, rejected_positions
+
+    """
+    Grows the batch size while full batches are sent well within the target latency, and shrinks it when they are not
+    """
+    def adapt_batch_size(self, content_size, latency):
+        if latency > self.target_latency:
+            self.shrink_batch_size()
+        elif latency < self.target_latency / 2.0 and content_size >= self.batch_size:
+            with self.condition:
+                self.batch_size = min(self.max_batch_size, int(self.batch_size * 1.25))
+
+    """
+    Shrinks the batch size, down to the min batch size
+    """
+    def shrink_batch_size(self):
+        with self.condition:
+            self.batch_size = max(self.min_batch_size, int(self.batch_size * 0.75))
+
+    """
+    Parses the value of a Retry-After header, returns the number of seconds to wait or None
+    """
+    @staticmethod
+    def parse_retry_after(retry_after):
+        if retry_after is None:
+            return None
+        try:
+            return min(HttpBulkClient.MAX_RETRY_DELAY, max(0, int(retry_after)))
+        except ValueError:
+            retry_date = email.utils.parsedate_tz(retry_after)
+            if retry_date is None:
+                return None
+            return min(HttpBulkClient.MAX_RETRY_DELAY, max(0, email.utils.mktime_tz(retry_date) - time.time()))
+
+
+class CollectorBusyError(Exception):
+
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        # the number of seconds to wait before the next request, None if the collector did not say
+        self.retry_after = retry_after
+
+
+class CollectorRejectedError(Exception):
+    pass
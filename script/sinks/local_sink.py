@@ -0,0 +1,228 @@
+"""
+
+The local sink - writes each log file to the process directory, and hands it to compression and to the SFTP uploader
+
+"""
+
+import gzip
+import os
+import re
+import zlib
+
+from sinks import Sink
+
+
+"""
+Creates the sink of a log file
+"""
+def create_sink(downloader, filename):
+    return LocalSink(downloader, filename)
+
+
+"""
+
+LocalSink - A class for saving the lines of a log file to the process directory
+
+"""
+
+
+class LocalSink(Sink):
+
+    def __init__(self, downloader, filename):
+        self.downloader = downloader
+        self.metrics = downloader.metrics
+        self.filename = filename
+        self.local_file = LocalFileWriter(downloader.config, filename)
+        # the final path of the file, once it was completed
+        self.upfile = None
+
+    """
+    Writes a batch of complete log lines
+    """
+    def write(self, lines):
+        if lines:
+            with self.metrics.time("local_write"):
+                self.local_file.write("\n".join(lines) + "\n")
+
+    """
+    Writes a whole decrypted file content as is
+    """
+    def write_content(self, content, lines=None):
+        with self.metrics.time("local_write"):
+            self.local_file.write(content)
+
+    """
+    Completes the file and moves it to its final name
+    """
+    def flush(self):
+        with self.metrics.time("local_write"):
+            self.upfile = self.local_file.close()
+
+    """
+    Sends the completed file to the SFTP server and compresses it, according to the settings
+    """
+    def close(self, uploaded_callback=None, failure_callback=None):
+        self.downloader.transfer_local_file(self.filename, self.upfile, uploaded_callback, failure_callback)
+
+    """
+    Drops the partially written file
+    """
+    def abort(self):
+        self.local_file.abort()
+
+
+"""
+
+LocalFileWriter - A class for writing a log file to the process directory through a temporary file
+
+"""
+
+
+class LocalFileWriter:
+
+    def __init__(self, config, filename):
+        self.config = config
+        self.filename = filename
+        self.path = config.PROCESS_DIR + filename
+        if config.LOCAL_WRITE_COMPRESSED == "YES" or config.LOCAL_ARCHIVE == "YES":
+            self.path += ".gz"
+        # the file is written under a temporary name, so a partially written file is never picked up
+        self.tmp_path = self.path + ".tmp"
+        self.raw_file = open(self.tmp_path, "wb", config.LOCAL_WRITE_BUFFER_SIZE)
+        self.file = self.raw_file
+        if config.LOCAL_ARCHIVE == "YES":
+            self.file = ArchiveBlockWriter(self.raw_file, config.LOCAL_ARCHIVE_BLOCK_SIZE, config.COMPRESSION_LEVEL)
+        elif config.LOCAL_WRITE_COMPRESSED == "YES":
+            self.file = gzip.GzipFile(filename=filename, mode="wb", compresslevel=config.COMPRESSION_LEVEL, fileobj=self.raw_file)
+
+    """
+    Writes decoded content
+    """
+    def write(self, content):
+        self.file.write(content)
+
+    """
+    Completes the file and moves it to its final name, returns the final path
+    """
+    def close(self):
+        if self.file is not self.raw_file:
+            self.file.close()
+        self.raw_file.flush()
+        if self.config.LOCAL_FSYNC == "YES":
+            os.fsync(self.raw_file.fileno())
+        self.raw_file.close()
+        # the index of an archive file is in place before the file itself, and the file is listed in the catalog once both are
+        if self.config.LOCAL_ARCHIVE == "YES":
+            self.file.save_index(self.path + ".idx")
+        os.rename(self.tmp_path, self.path)
+        if self.config.LOCAL_FSYNC == "YES":
+            # make the rename itself durable
+            directory_fd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+            try:
+                os.fsync(directory_fd)
+            finally:
+                os.close(directory_fd)
+        if self.config.LOCAL_ARCHIVE == "YES":
+            self.file.add_to_catalog(os.path.join(self.config.PROCESS_DIR, ArchiveBlockWriter.CATALOG_FILE_NAME), self.filename)
+        return self.path
+
+    """
+    Closes and removes the temporary file
+    """
+    def abort(self):
+        try:
+            self.raw_file.close()
+            os.unlink(self.tmp_path)
+        except Exception:
+            pass
+
+
+"""
+
+ArchiveBlockWriter - A class for writing a log file as a series of separately compressed blocks, with an index of the event time range
+and the site ids of each block. The blocks are gzip members, so the file is still a valid gzip file
+
+"""
+
+
+class ArchiveBlockWriter:
+
+    # the archive files of the process directory, a line for each file which was written
+    CATALOG_FILE_NAME = "archive.catalog"
+    # the event time of a CEF line is the start field, in milliseconds since the epoch
+    START_TIME_REGEX = re.compile(br"(?:^| )start=(\d+)", re.MULTILINE)
+    SITE_ID_REGEX = re.compile(br"(?:^| )siteid=(\d+)", re.MULTILINE)
+    # a block with more site ids than this is indexed as holding any site id
+    MAX_INDEXED_SITE_IDS = 256
+
+    def __init__(self, out_file, block_size, level):
+        self.out_file = out_file
+        self.block_size = block_size
+        self.level = level
+        self.pending = []
+        self.pending_size = 0
+        self.offset = 0
+        # (offset, compressed size, lines, min time, max time, site ids) of each block
+        self.blocks = []
+
+    """
+    Writes decoded content, a line is never split between blocks
+    """
+    def write(self, content):
+        self.pending.append(content)
+        self.pending_size += len(content)
+        if self.pending_size >= self.block_size:
+            pending = b"".join(self.pending)
+            block_end = pending.rfind(b"\n") + 1
+            self.pending = [pending[block_end:]]
+            self.pending_size = len(pending) - block_end
+            # big writes are cut to blocks of about the block size
+            block_start = 0
+            while block_start < block_end:
+                next_block_start = pending.find(b"\n", block_start + self.block_size - 1) + 1 or block_end
+                self.write_block(pending[block_start:next_block_start])
+                block_start = next_block_start
+
+    """
+    Compresses a block of complete lines to a gzip member and indexes it
+    """
+    def write_block(self, block):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        member = compressor.compress(block) + compressor.flush()
+        self.out_file.write(member)
+        start_times = [int(start_time) for start_time in self.START_TIME_REGEX.findall(block)]
+        site_ids = set(int(site_id) for site_id in self.SITE_ID_REGEX.findall(block))
+        self.blocks.append((self.offset, len(member), block.count(b"\n") + (not block.endswith(b"\n")),
+                            min(start_times) if start_times else -1, max(start_times) if start_times else -1,
+                            sorted(site_ids) if len(site_ids) <= self.MAX_INDEXED_SITE_IDS else None))
+        self.offset += len(member)
+
+    """
+    Writes the remaining lines as the last block
+    """
+    def close(self):
+        pending = b"".join(self.pending)
+        self.pending = []
+        if pending:
+            self.write_block(pending)
+
+    """
+    Writes the index of the blocks - a line for each block with its offset, compressed size, number of lines, min and max event time
+    and site ids, * when it holds too many site ids
+    """
+    def save_index(self, index_path):
+        with open(index_path + ".tmp", "w") as index_file:
+            for offset, size, lines, min_time, max_time, site_ids in self.blocks:
+                index_file.write("%d %d %d %d %d %s\n" % (offset, size, lines, min_time, max_time,
+                                                          ",".join(str(site_id) for site_id in site_ids) if site_ids is not None else "*"))
+        os.rename(index_path + ".tmp", index_path)
+
+    """
+    Appends the file to the catalog - its name, compressed size, number of lines, min and max event time
+    """
+    def add_to_catalog(self, catalog_path, filename):
+        start_times = [block[3] for block in self.blocks if block[3] >= 0]
+        with open(catalog_path, "a") as catalog_file:
+            catalog_file.write("%s %d %d %d %d\n" % (filename, self.offset, sum(block[2] for block in self.blocks),
+                                                     min(start_times) if start_times else -1,
+                                                     max(block[4] for block in self.blocks) if start_times else -1))
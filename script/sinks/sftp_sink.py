@@ -0,0 +1,103 @@
+"""
+
+The SFTP uploader - uploads the local files to the SFTP server once the local sink completed them, see LogsDownloader.transfer_local_file
+
+"""
+
+import threading
+
+import paramiko
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+
+"""
+
+SftpUploader - A class for uploading log files to the SFTP server over a persistent session, in the background
+
+"""
+
+
+class SftpUploader:
+
+    def __init__(self, config, logger, metrics):
+        self.config = config
+        self.logger = logger
+        self.metrics = metrics
+        self.transport = None
+        self.transport_lock = threading.Lock()
+        # the files waiting to be uploaded - (local path, remote file name, callback once the file was uploaded)
+        self.upload_queue = Queue.Queue(config.SFTP_QUEUE_SIZE)
+        metrics.add_gauge("logs_downloader_queue_depth", (("queue", "sftp"), ("host", config.SFTP_HOSTNAME)), self.upload_queue.qsize)
+        for i in range(config.SFTP_CONCURRENCY):
+            upload_thread = threading.Thread(target=self.upload_files, name="sftp_upload_thread")
+            upload_thread.daemon = True
+            upload_thread.start()
+
+    """
+    Queues a file for uploading, waits if the upload queue is full.
+    If all the attempts failed, the failure callback is called with a function which queues the file again
+    """
+    def upload(self, local_path, remote_file_name, callback=None, failure_callback=None):
+        self.upload_queue.put((local_path, remote_file_name, callback, failure_callback))
+
+    """
+    Waits until all the queued files were uploaded, or failed to upload
+    """
+    def wait_until_uploaded(self):
+        self.upload_queue.join()
+
+    """
+    Uploads the queued files, runs on a dedicated thread with its own SFTP channel
+    """
+    def upload_files(self):
+        sftp = None
+        while True:
+            local_path, remote_file_name, callback, failure_callback = self.upload_queue.get()
+            remote_path = self.config.SFTP_REMOTEDIR + "/" + remote_file_name
+            for attempt in range(1, self.config.SFTP_RETRIES + 1):
+                try:
+                    if sftp is None or not self.is_connected():
+                        sftp = self.open_channel()
+                    # the file is written with pipelined requests, without waiting for the server to acknowledge each block
+                    with self.metrics.time("sftp"):
+                        sftp.put(local_path, remote_path)
+                    self.logger.info("Uploaded file %s to the SFTP server", remote_file_name)
+                    if callback is not None:
+                        callback(local_path)
+                    break
+                except Exception as e:
+                    self.metrics.inc("logs_downloader_retries_total")
+                    self.logger.error("Failed to upload file %s to the SFTP server, attempt %s out of %s - %s: %s", remote_file_name, attempt, self.config.SFTP_RETRIES, e.__class__, e)
+                    # a new channel is opened for the next attempt, and the session is reconnected if it was closed
+                    try:
+                        sftp.close()
+                    except Exception:
+                        pass
+                    sftp = None
+            else:
+                if failure_callback is not None:
+                    failure_callback(lambda: self.upload(local_path, remote_file_name, callback, failure_callback))
+            self.upload_queue.task_done()
+
+    """
+    Checks whether the SFTP session is still open
+    """
+    def is_connected(self):
+        with self.transport_lock:
+            return self.transport is not None and self.transport.is_active()
+
+    """
+    Opens a new SFTP channel on the shared session, connecting and authenticating the session if needed
+    """
+    def open_channel(self):
+        with self.transport_lock:
+            if self.transport is None or not self.transport.is_active():
+                self.logger.info("Connecting to SFTP server %s:%s", self.config.SFTP_HOSTNAME, self.config.SFTP_PORT)
+                transport = paramiko.Transport((self.config.SFTP_HOSTNAME, int(self.config.SFTP_PORT)))
+                transport.connect(username=self.config.SFTP_USERNAME, password=self.config.SFTP_PASSWORD)
+                transport.set_keepalive(30)
+                self.transport = transport
+            return paramiko.SFTPClient.from_transport(self.transport)
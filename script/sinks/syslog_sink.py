@@ -0,0 +1,502 @@
+"""
+
+The syslog sink - sends the log lines to the syslog servers over long lived connections, which are shared by the files of an account
+
+"""
+
+import collections
+import os
+import platform
+import select
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from sinks import Sink
+
+
+"""
+Creates the sink of a log file, the lines are sent on the connection pool of the downloader
+"""
+def create_sink(downloader, filename):
+    return SyslogSink(downloader.syslog_pool)
+
+
+"""
+
+SyslogSink - A class for sending the lines of a log file to the syslog servers
+
+"""
+
+
+class SyslogSink(Sink):
+
+    def __init__(self, syslog_pool):
+        self.syslog_pool = syslog_pool
+        self.delivery = SyslogDelivery()
+
+    """
+    Sends a batch of complete log lines
+    """
+    def write(self, lines):
+        self.syslog_pool.emit(lines, self.delivery)
+
+    """
+    Waits until all the lines were sent, the file is handled only once they were
+    """
+    def flush(self):
+        self.syslog_pool.flush(self.delivery)
+
+
+"""
+
+SyslogDelivery - A class for tracking the batches of a single sender of the connection pool, such as the sink of a log file,
+so a sender waits only for its own batches and fails only when its own batches could not be sent
+
+"""
+
+
+class SyslogDelivery:
+
+    def __init__(self):
+        # the batches which were queued and were not sent or spilled yet, and how many of them are orphan batches
+        self.outstanding_batches = 0
+        self.orphan_batches = 0
+
+
+"""
+
+SyslogConnectionPool - A class for sending log lines over long lived connections to all the configured syslog servers
+
+"""
+
+
+class SyslogConnectionPool:
+
+    def __init__(self, config, logger, metrics, spill=True):
+        self.logger = logger
+        self.metrics = metrics
+        self.batch_size = config.SYSLOG_BATCH_SIZE
+        self.max_pending_bytes = config.SYSLOG_BATCH_SIZE * config.SYSLOG_MAX_PENDING_BATCHES
+        self.health_check_interval = config.SYSLOG_HEALTH_CHECK_INTERVAL
+        self.timeout = config.SYSLOG_TIMEOUT
+        # guards the state of all the connections, and is notified whenever it changes
+        self.condition = threading.Condition()
+        # batches which could not be sent since no server is available, with the delivery of each of them
+        self.orphan_batches = []
+        syslog_servers = [e.strip() for e in config.SYSLOG_ADDRESS.split(',')]
+        self.connections = [SyslogConnection(self, server, int(config.SYSLOG_PORT)) for server in syslog_servers]
+        metrics.add_gauge("logs_downloader_syslog_outstanding_bytes", (("port", config.SYSLOG_PORT),), lambda: sum(connection.outstanding_bytes for connection in self.connections))
+        # the batches which cannot be sent right away are kept on the disk and replayed later on, if enabled
+        self.spill_queue = None
+        if spill and config.SYSLOG_SPILL_DIR != "":
+            self.spill_queue = SyslogSpillQueue(config.SYSLOG_SPILL_DIR, config.SYSLOG_SPILL_MAX_SIZE, config.SYSLOG_SPILL_SEGMENT_SIZE, logger)
+            self.replay_rate = config.SYSLOG_SPILL_REPLAY_RATE
+            metrics.add_gauge("logs_downloader_syslog_spilled_bytes", (("port", config.SYSLOG_PORT),), lambda: self.spill_queue.size)
+        for connection in self.connections:
+            connection.connect()
+            connection.start()
+        health_check_thread = threading.Thread(target=self.check_health, name="syslog_health_check_thread")
+        health_check_thread.daemon = True
+        health_check_thread.start()
+        if self.spill_queue is not None:
+            replay_thread = threading.Thread(target=self.replay_spilled_batches, name="syslog_replay_thread")
+            replay_thread.daemon = True
+            replay_thread.start()
+
+    """
+    Sends log lines, the lines are framed with their octet count and sent in large batches
+    """
+    def emit(self, lines, delivery):
+        batch = []
+        batch_size = 0
+        for msg in lines:
+            if msg != '':
+                frame = "%d %s" % (len(msg), msg)
+                batch.append(frame)
+                batch_size += len(frame)
+                if batch_size >= self.batch_size:
+                    self.dispatch("".join(batch), delivery)
+                    batch = []
+                    batch_size = 0
+        if batch:
+            self.dispatch("".join(batch), delivery)
+
+    """
+    Queues a batch on the healthy connection with the least outstanding bytes, waits while all of them are full.
+    When spilling is enabled, a batch which cannot be queued is spilled to the disk instead, as long as the spill queue is not full
+    """
+    def dispatch(self, batch, delivery, spill=True):
+        with self.condition:
+            while True:
+                healthy_connections = [connection for connection in self.connections if connection.healthy]
+                if not healthy_connections:
+                    if spill and self.spill(batch):
+                        return
+                    self.discard(delivery)
+                    raise Exception("No syslog server is available")
+                connection = min(healthy_connections, key=lambda c: c.outstanding_bytes)
+                if connection.outstanding_bytes < self.max_pending_bytes:
+                    connection.enqueue(batch, delivery)
+                    delivery.outstanding_batches += 1
+                    return
+                if spill and self.spill(batch):
+                    return
+                self.condition.wait(1)
+
+    """
+    Appends a batch to the spill queue, returns False if spilling is disabled or the spill queue is full
+    """
+    def spill(self, batch):
+        if self.spill_queue is None or not self.spill_queue.append(batch):
+            return False
+        self.metrics.inc("logs_downloader_bytes_total", (("stage", "syslog_spill"),), len(batch))
+        return True
+
+    """
+    Queues batches that were not sent by a failed connection on the other healthy connections, the batches are (delivery, batch) pairs
+    """
+    def redispatch(self, batches):
+        with self.condition:
+            healthy_connections = [connection for connection in self.connections if connection.healthy]
+            for delivery, batch in batches:
+                if healthy_connections:
+                    min(healthy_connections, key=lambda c: c.outstanding_bytes).enqueue(batch, delivery)
+                elif self.spill(batch):
+                    delivery.outstanding_batches -= 1
+                else:
+                    self.orphan_batches.append((delivery, batch))
+                    delivery.orphan_batches += 1
+            self.condition.notify_all()
+
+    """
+    Drops the orphan batches of a delivery which failed, the orphan batches of the other deliveries are kept.
+    Must be called while holding the condition
+    """
+    def discard(self, delivery):
+        self.orphan_batches = [(orphan_delivery, batch) for orphan_delivery, batch in self.orphan_batches if orphan_delivery is not delivery]
+        delivery.outstanding_batches -= delivery.orphan_batches
+        delivery.orphan_batches = 0
+
+    """
+    Waits until all the batches of a delivery were sent, or spilled to the disk
+    """
+    def flush(self, delivery):
+        with self.condition:
+            while delivery.outstanding_batches > 0:
+                if delivery.orphan_batches and not any(connection.healthy for connection in self.connections):
+                    self.discard(delivery)
+                    raise Exception("No syslog server is available")
+                self.condition.wait(1)
+        if self.spill_queue is not None:
+            self.spill_queue.sync()
+
+    """
+    Sends the spilled batches once a syslog server is available, up to the replay rate in bytes per second. Runs on a dedicated thread
+    """
+    def replay_spilled_batches(self):
+        delivery = SyslogDelivery()
+        while True:
+            spilled = self.spill_queue.peek()
+            if spilled is None:
+                time.sleep(1)
+                continue
+            batch, next_position = spilled
+            with self.condition:
+                if not any(connection.healthy for connection in self.connections):
+                    self.condition.wait(self.health_check_interval)
+                    continue
+            try:
+                self.dispatch(batch, delivery, spill=False)
+                # the replay position moves only once the batch was sent
+                self.flush(delivery)
+            except Exception as e:
+                self.logger.error("Failed to replay spilled syslog batch - %s", e)
+                time.sleep(self.health_check_interval)
+                continue
+            self.spill_queue.commit(next_position)
+            if self.replay_rate > 0:
+                time.sleep(float(len(batch)) / self.replay_rate)
+
+    """
+    Reconnects to the failed servers and detects connections which were closed by the servers, runs on a dedicated thread
+    """
+    def check_health(self):
+        while True:
+            time.sleep(self.health_check_interval)
+            for connection in self.connections:
+                if not connection.healthy:
+                    connection.connect()
+                elif connection.is_closed_by_server():
+                    self.logger.warning("Syslog server %s:%s closed the connection", connection.host, connection.port)
+                    connection.fail()
+            # the orphan batches are moved while holding the condition, so they are always accounted for by their deliveries
+            with self.condition:
+                orphan_batches = self.orphan_batches
+                self.orphan_batches = []
+                for delivery, batch in orphan_batches:
+                    delivery.orphan_batches -= 1
+                if orphan_batches:
+                    self.redispatch(orphan_batches)
+
+
+class SyslogConnection:
+
+    def __init__(self, pool, host, port):
+        self.pool = pool
+        self.logger = pool.logger
+        self.host = host
+        self.port = port
+        self.socket = None
+        self.healthy = False
+        # the queued (delivery, batch) pairs
+        self.pending_batches = collections.deque()
+        # the size of the batches which were queued and not sent yet
+        self.outstanding_bytes = 0
+
+    """
+    Opens the connection to the server
+    """
+    def connect(self):
+        try:
+            connection_socket = socket.create_connection((self.host, self.port), self.pool.timeout)
+            connection_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except Exception as e:
+            self.logger.error("Failed to connect to syslog server %s:%s - %s", self.host, self.port, e)
+            return
+        with self.pool.condition:
+            self.socket = connection_socket
+            self.healthy = True
+            self.pool.condition.notify_all()
+        self.logger.info("Connected to syslog server %s:%s", self.host, self.port)
+
+    """
+    Starts the thread which writes the queued batches to the connection
+    """
+    def start(self):
+        writer_thread = threading.Thread(target=self.write_batches, name="syslog_writer_thread")
+        writer_thread.daemon = True
+        writer_thread.start()
+
+    """
+    Queues a batch, must be called while holding the pool condition
+    """
+    def enqueue(self, batch, delivery):
+        self.pending_batches.append((delivery, batch))
+        self.outstanding_bytes += len(batch)
+        self.pool.condition.notify_all()
+
+    """
+    Writes the queued batches to the connection, runs on a dedicated thread
+    """
+    def write_batches(self):
+        while True:
+            with self.pool.condition:
+                while not (self.healthy and self.pending_batches):
+                    self.pool.condition.wait()
+                pending_batch = self.pending_batches[0]
+                delivery, batch = pending_batch
+                connection_socket = self.socket
+            try:
+                with self.pool.metrics.time("syslog_emit"):
+                    connection_socket.sendall(batch)
+                self.pool.metrics.inc("logs_downloader_bytes_total", (("stage", "syslog_emit"),), len(batch))
+            except Exception as e:
+                self.logger.error("Failed to send logs to syslog server %s:%s - %s", self.host, self.port, e)
+                self.fail()
+                continue
+            with self.pool.condition:
+                if self.pending_batches and self.pending_batches[0] is pending_batch:
+                    self.pending_batches.popleft()
+                    self.outstanding_bytes -= len(batch)
+                    delivery.outstanding_batches -= 1
+                self.pool.condition.notify_all()
+
+    """
+    Checks whether the server closed an idle connection
+    """
+    def is_closed_by_server(self):
+        connection_socket = self.socket
+        try:
+            readable, _, _ = select.select([connection_socket], [], [], 0)
+            return bool(readable) and connection_socket.recv(1, socket.MSG_PEEK) == ""
+        except Exception:
+            return True
+
+    """
+    Marks the connection as failed, closes it and moves its queued batches to the other connections
+    """
+    def fail(self):
+        with self.pool.condition:
+            self.healthy = False
+            batches = list(self.pending_batches)
+            self.pending_batches.clear()
+            self.outstanding_bytes = 0
+            connection_socket = self.socket
+            self.socket = None
+        try:
+            connection_socket.close()
+        except Exception:
+            pass
+        self.pool.redispatch(batches)
+
+
+"""
+
+SyslogSpillQueue - A class for keeping syslog batches on the disk while the syslog servers are unavailable or slow.
+The batches are appended to segment files, and the position of the next batch to replay is kept in an offset file
+
+"""
+
+
+class SyslogSpillQueue:
+
+    # each record is the batch length and CRC32, followed by the batch
+    RECORD_HEADER = struct.Struct(">II")
+
+    def __init__(self, path, max_size, segment_size, logger):
+        self.path = path
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.logger = logger
+        self.lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.offset_file_path = os.path.join(path, "offset")
+        segments = sorted(int(name.split(".")[0]) for name in os.listdir(path) if name.endswith(".segment"))
+        # the position of the next batch to replay - a segment number and an offset in it
+        self.read_segment, self.read_position = 0, 0
+        if os.path.exists(self.offset_file_path):
+            with open(self.offset_file_path, "r") as offset_file:
+                self.read_segment, self.read_position = [int(value) for value in offset_file.read().split()]
+        if self.read_segment not in segments:
+            self.read_segment, self.read_position = (segments[0] if segments else self.read_segment), 0
+        # the segments which were already replayed are dropped
+        for segment in segments:
+            if segment < self.read_segment:
+                os.remove(self.segment_path(segment))
+        self.segments = [segment for segment in segments if segment >= self.read_segment] or [self.read_segment]
+        self.write_segment = self.segments[-1]
+        self.write_position = self.recover(self.write_segment)
+        if self.read_segment == self.write_segment:
+            self.read_position = min(self.read_position, self.write_position)
+        self.write_file = open(self.segment_path(self.write_segment), "ab")
+        self.unsynced = False
+        self.reader = None
+        # the bytes which were spilled and not replayed yet
+        self.size = sum(os.path.getsize(self.segment_path(segment)) for segment in self.segments[:-1]) + self.write_position - self.read_position
+        if self.size > 0:
+            self.logger.info("Found %s spilled syslog bytes in %s, they will be replayed", self.size, path)
+
+    """
+    Gets the path of a segment file
+    """
+    def segment_path(self, segment):
+        return os.path.join(self.path, "%020d.segment" % segment)
+
+    """
+    Truncates a record which was partially written when the process stopped, returns the size of the valid records
+    """
+    def recover(self, segment):
+        position = 0
+        if not os.path.exists(self.segment_path(segment)):
+            return position
+        with open(self.segment_path(segment), "r+b") as segment_file:
+            while True:
+                header = segment_file.read(self.RECORD_HEADER.size)
+                if len(header) < self.RECORD_HEADER.size:
+                    break
+                length, checksum = self.RECORD_HEADER.unpack(header)
+                batch = segment_file.read(length)
+                if len(batch) < length or zlib.crc32(batch) & 0xffffffff != checksum:
+                    break
+                position += self.RECORD_HEADER.size + length
+            if position < os.path.getsize(self.segment_path(segment)):
+                self.logger.warning("Dropping a partially written syslog spill record from %s", self.segment_path(segment))
+                segment_file.truncate(position)
+        return position
+
+    """
+    Appends a batch, returns False if the queue is full
+    """
+    def append(self, batch):
+        record_size = self.RECORD_HEADER.size + len(batch)
+        with self.lock:
+            if self.size + record_size > self.max_size:
+                return False
+            if self.write_position >= self.segment_size:
+                self.write_file.flush()
+                os.fsync(self.write_file.fileno())
+                self.write_file.close()
+                self.write_segment += 1
+                self.segments.append(self.write_segment)
+                self.write_file = open(self.segment_path(self.write_segment), "ab")
+                self.write_position = 0
+            self.write_file.write(self.RECORD_HEADER.pack(len(batch), zlib.crc32(batch) & 0xffffffff) + batch)
+            self.write_file.flush()
+            self.write_position += record_size
+            self.size += record_size
+            self.unsynced = True
+            return True
+
+    """
+    Syncs the appended batches to the disk
+    """
+    def sync(self):
+        with self.lock:
+            if self.unsynced:
+                os.fsync(self.write_file.fileno())
+                self.unsynced = False
+
+    """
+    Gets the next batch to replay and the position after it, or None if there is no spilled batch
+    """
+    def peek(self):
+        with self.lock:
+            # a segment which was replayed to its end is removed
+            while self.read_segment != self.write_segment and self.read_position >= os.path.getsize(self.segment_path(self.read_segment)):
+                if self.reader is not None:
+                    self.reader.close()
+                    self.reader = None
+                os.remove(self.segment_path(self.read_segment))
+                self.segments.pop(0)
+                self.read_segment, self.read_position = self.segments[0], 0
+                self.save_offset()
+            if self.read_segment == self.write_segment and self.read_position >= self.write_position:
+                return None
+            if self.reader is None:
+                self.reader = open(self.segment_path(self.read_segment), "rb")
+            self.reader.seek(self.read_position)
+            length, checksum = self.RECORD_HEADER.unpack(self.reader.read(self.RECORD_HEADER.size))
+            batch = self.reader.read(length)
+            if len(batch) < length or zlib.crc32(batch) & 0xffffffff != checksum:
+                # a damaged segment is skipped to its end
+                self.logger.error("Skipping a damaged syslog spill record in %s", self.segment_path(self.read_segment))
+                end_position = self.write_position if self.read_segment == self.write_segment else os.path.getsize(self.segment_path(self.read_segment))
+                self.size -= end_position - self.read_position
+                self.read_position = end_position
+                self.save_offset()
+                return None
+            return batch, self.read_position + self.RECORD_HEADER.size + length
+
+    """
+    Moves the replay position after a batch which was sent
+    """
+    def commit(self, position):
+        with self.lock:
+            self.size -= position - self.read_position
+            self.read_position = position
+            self.save_offset()
+
+    """
+    Writes the replay position to a temporary file which replaces the offset file, so it is never partially written
+    """
+    def save_offset(self):
+        tmp_file_path = self.offset_file_path + ".tmp"
+        with open(tmp_file_path, "w") as offset_file:
+            offset_file.write("%d %d\n" % (self.read_segment, self.read_position))
+        if platform.system() == "Windows" and os.path.exists(self.offset_file_path):
+            os.remove(self.offset_file_path)
+        os.rename(tmp_file_path, self.offset_file_path)